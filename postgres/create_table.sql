@@ -21,17 +21,66 @@ CREATE TABLE tasks (
     worker_group text,
     platform text,
     job_kind text,
-    CONSTRAINT dup_task_run UNIQUE (task_id, run_id)
-);
+    -- Unique constraints on a partitioned table must include the partition key.
+    -- created is the task's creation time, which is the same for every run of a
+    -- task, so this still rejects duplicate (task_id, run_id) pairs.
+    CONSTRAINT dup_task_run UNIQUE (task_id, run_id, created)
+) PARTITION BY RANGE (created);
+
+-- Creates the monthly partition of tasks containing month_start, if it doesn't
+-- exist yet, e.g. SELECT create_tasks_partition('2019-08-01');
+-- Partitions should be created ahead of time; rows for a month without a
+-- partition land in tasks_default until it is created. Schedule
+-- scripts/partitions.py to keep a few months ahead, e.g. daily from cron:
+--   0 3 * * * cd scripts && ./partitions.py
+CREATE OR REPLACE FUNCTION create_tasks_partition(month_start date)
+RETURNS text AS $$
+DECLARE
+    first_day date := date_trunc('month', month_start)::date;
+    next_day date := (date_trunc('month', month_start) + interval '1 month')::date;
+    partition_name text := 'tasks_' || to_char(first_day, 'YYYYMM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+    -- Rows for the month that arrived before its partition existed are in
+    -- tasks_default, and attaching the partition fails while they are there, so
+    -- move them into the new table first.
+    EXECUTE format(
+        'CREATE TABLE %I (LIKE tasks INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+        partition_name
+    );
+    IF to_regclass('tasks_default') IS NOT NULL THEN
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM tasks_default WHERE created >= %L AND created < %L RETURNING *) '
+            'INSERT INTO %I SELECT * FROM moved',
+            first_day, next_day, partition_name
+        );
+    END IF;
+    EXECUTE format(
+        'ALTER TABLE tasks ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        partition_name, first_day, next_day
+    );
+    RETURN partition_name;
+END;
+$$ language 'plpgsql';
 
+CREATE TABLE tasks_default PARTITION OF tasks DEFAULT;
+SELECT create_tasks_partition((date_trunc('month', NOW()) + n * interval '1 month')::date)
+    FROM generate_series(0, 2) AS n;
+
+-- Indexes follow the report queries in scripts/ (see report_indexes.sql, and
+-- scripts/explain_reports.py to check their plans).
 CREATE INDEX tasks_worker_id_group_idx ON tasks (worker_id, worker_group) WHERE worker_id IS NOT null AND worker_group IS NOT null;
-CREATE INDEX tasks_only_worker_id_idx ON tasks (worker_id) WHERE worker_id IS NOT null;
-CREATE INDEX project_idx ON tasks (project DESC NULLS LAST);
-CREATE INDEX revision_idx ON tasks (revision DESC NULLS LAST);
-CREATE INDEX created_year_idx ON tasks (EXTRACT(YEAR FROM created));
-CREATE INDEX created_month_idx ON tasks (EXTRACT(MONTH FROM created));
-CREATE INDEX created_year_month_idx ON tasks (EXTRACT(YEAR FROM created), EXTRACT(MONTH FROM created));
-CREATE INDEX worker_type_idx ON tasks (worker_type) WHERE worker_type IS NOT NULL;
+-- Tasks are inserted roughly in created order, so a BRIN index narrows created
+-- ranges within a partition at a tiny fraction of a btree's size.
+CREATE INDEX tasks_created_brin_idx ON tasks USING BRIN (created);
+-- Per-project and per-revision lookups in cost_per_push.py and monthly_tc_stats.py,
+-- answered from the index alone.
+CREATE INDEX tasks_project_created_idx ON tasks (project, created) INCLUDE (revision, worker_type, state, duration);
+CREATE INDEX tasks_revision_idx ON tasks (revision) INCLUDE (created, started, resolved, state);
+-- Overlap queries (started <= end AND resolved >= start) in the concurrency scripts.
+CREATE INDEX tasks_started_resolved_idx ON tasks (started, resolved);
 
 CREATE OR REPLACE FUNCTION update_modified_column()
 RETURNS TRIGGER AS $$
@@ -56,19 +105,9 @@ create TABLE cached_task_definitions (
 );
 
 create index cached_task_id_for_definition on cached_task_definitions (task_id);
-
-CREATE FUNCTION expire_old_task_definitions() RETURNS trigger
-    LANGUAGE plpgsql
-    AS $$
-BEGIN
-  DELETE FROM cached_task_definitions WHERE timestamp < NOW() - INTERVAL '3 hours';
-  RETURN NEW;
-END;
-$$;
-
-CREATE TRIGGER expire_delete_task_definitions_trigger
-    AFTER INSERT ON cached_task_definitions
-    EXECUTE PROCEDURE expire_old_task_definitions();
+-- Old definitions are removed by a periodic batch job (scripts/task_definitions.py
+-- --expire) rather than a DELETE trigger on every insert.
+create index cached_task_definitions_timestamp_idx on cached_task_definitions (timestamp);
 
 CREATE TABLE worker_type_monthly_costs (
     modified timestamp NOT NULL DEFAULT NOW(),
@@ -0,0 +1,15 @@
+-- Replaces the expire_delete_task_definitions_trigger on cached_task_definitions,
+-- which ran a DELETE of everything older than 3 hours after every insert, with a
+-- periodic batch job. New installs get this from create_table.sql directly.
+--
+-- After migrating, schedule the expiry job, e.g. every 15 minutes from cron:
+--   */15 * * * * cd scripts && ./task_definitions.py --expire
+BEGIN;
+
+DROP TRIGGER IF EXISTS expire_delete_task_definitions_trigger ON cached_task_definitions;
+DROP FUNCTION IF EXISTS expire_old_task_definitions();
+
+CREATE INDEX IF NOT EXISTS cached_task_definitions_timestamp_idx
+    ON cached_task_definitions (timestamp);
+
+COMMIT;
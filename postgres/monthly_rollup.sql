@@ -0,0 +1,44 @@
+-- Monthly task aggregates, refreshed by scripts/refresh_rollup.py.
+--
+-- Each (year, month) is stored at three grains so that distinct counts stay exact:
+--   'detail'  one row per (project, provisioner, worker_type, platform, state)
+--   'project' one row per project (dimension columns other than project are NULL)
+--   'month'   one row for the whole month (all dimension columns are NULL)
+-- Durations are in milliseconds, like tasks.duration. started_duration only counts
+-- tasks that actually started.
+CREATE TABLE IF NOT EXISTS tasks_monthly_rollup (
+    year int NOT NULL,
+    month int NOT NULL,
+    grain text NOT NULL,
+    project text,
+    provisioner text,
+    worker_type text,
+    platform text,
+    state text,
+    num_tasks bigint NOT NULL,
+    total_duration bigint,
+    started_duration bigint,
+    num_revisions bigint NOT NULL,
+    num_workers bigint NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS tasks_monthly_rollup_month_idx ON tasks_monthly_rollup (year, month, grain);
+
+CREATE TABLE IF NOT EXISTS tasks_monthly_rollup_refreshes (
+    year int NOT NULL,
+    month int NOT NULL,
+    refreshed timestamp NOT NULL,
+    CONSTRAINT dup_rollup_month UNIQUE (year, month)
+);
+
+-- When refresh_rollup.py last looked for changed months, i.e. the start of the last
+-- incremental or --full run. A single --month refresh doesn't advance it, so changes
+-- to other months made before that refresh are still found by the next incremental
+-- run.
+CREATE TABLE IF NOT EXISTS tasks_monthly_rollup_watermark (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    scanned timestamp NOT NULL
+);
+
+-- Used to find the months touched since the last refresh.
+CREATE INDEX IF NOT EXISTS tasks_modified_idx ON tasks (modified);
@@ -0,0 +1,95 @@
+-- Migrates an existing, unpartitioned tasks table to monthly range partitions on
+-- created (PostgreSQL 13 or later). New installs get the partitioned table from
+-- create_table.sql directly.
+--
+-- This copies every row, so run it during a quiet period with the event listener
+-- stopped. Afterwards, schedule scripts/partitions.py to create partitions ahead
+-- of time with create_tasks_partition(), e.g. daily from cron:
+--   0 3 * * * cd scripts && ./partitions.py
+-- and detach old months cheaply with:
+--   ALTER TABLE tasks DETACH PARTITION tasks_YYYYMM;
+BEGIN;
+
+ALTER TABLE tasks RENAME TO tasks_unpartitioned;
+ALTER TABLE tasks_unpartitioned RENAME CONSTRAINT dup_task_run TO dup_task_run_unpartitioned;
+-- Frees the index names for the partitioned table. Renames use IF EXISTS so this
+-- works whether or not report_indexes.sql has already replaced the original
+-- indexes.
+ALTER INDEX IF EXISTS tasks_worker_id_group_idx RENAME TO tasks_unpartitioned_worker_id_group_idx;
+ALTER INDEX IF EXISTS tasks_only_worker_id_idx RENAME TO tasks_unpartitioned_only_worker_id_idx;
+ALTER INDEX IF EXISTS project_idx RENAME TO tasks_unpartitioned_project_idx;
+ALTER INDEX IF EXISTS revision_idx RENAME TO tasks_unpartitioned_revision_idx;
+ALTER INDEX IF EXISTS created_year_idx RENAME TO tasks_unpartitioned_created_year_idx;
+ALTER INDEX IF EXISTS created_month_idx RENAME TO tasks_unpartitioned_created_month_idx;
+ALTER INDEX IF EXISTS created_year_month_idx RENAME TO tasks_unpartitioned_created_year_month_idx;
+ALTER INDEX IF EXISTS worker_type_idx RENAME TO tasks_unpartitioned_worker_type_idx;
+ALTER INDEX IF EXISTS tasks_created_brin_idx RENAME TO tasks_unpartitioned_created_brin_idx;
+ALTER INDEX IF EXISTS tasks_project_created_idx RENAME TO tasks_unpartitioned_project_created_idx;
+ALTER INDEX IF EXISTS tasks_revision_idx RENAME TO tasks_unpartitioned_revision_include_idx;
+ALTER INDEX IF EXISTS tasks_started_resolved_idx RENAME TO tasks_unpartitioned_started_resolved_idx;
+ALTER INDEX IF EXISTS tasks_modified_idx RENAME TO tasks_unpartitioned_modified_idx;
+
+CREATE TABLE tasks (
+    LIKE tasks_unpartitioned INCLUDING DEFAULTS,
+    -- See create_table.sql: created is fixed per task, so this still enforces
+    -- unique (task_id, run_id).
+    CONSTRAINT dup_task_run UNIQUE (task_id, run_id, created)
+) PARTITION BY RANGE (created);
+
+CREATE OR REPLACE FUNCTION create_tasks_partition(month_start date)
+RETURNS text AS $$
+DECLARE
+    first_day date := date_trunc('month', month_start)::date;
+    next_day date := (date_trunc('month', month_start) + interval '1 month')::date;
+    partition_name text := 'tasks_' || to_char(first_day, 'YYYYMM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+    -- Rows for the month that arrived before its partition existed are in
+    -- tasks_default, and attaching the partition fails while they are there, so
+    -- move them into the new table first.
+    EXECUTE format(
+        'CREATE TABLE %I (LIKE tasks INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+        partition_name
+    );
+    IF to_regclass('tasks_default') IS NOT NULL THEN
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM tasks_default WHERE created >= %L AND created < %L RETURNING *) '
+            'INSERT INTO %I SELECT * FROM moved',
+            first_day, next_day, partition_name
+        );
+    END IF;
+    EXECUTE format(
+        'ALTER TABLE tasks ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        partition_name, first_day, next_day
+    );
+    RETURN partition_name;
+END;
+$$ language 'plpgsql';
+
+SELECT create_tasks_partition(month_start)
+    FROM (SELECT DISTINCT date_trunc('month', created)::date AS month_start
+          FROM tasks_unpartitioned) AS months;
+SELECT create_tasks_partition((date_trunc('month', NOW()) + n * interval '1 month')::date)
+    FROM generate_series(0, 2) AS n;
+CREATE TABLE tasks_default PARTITION OF tasks DEFAULT;
+
+INSERT INTO tasks SELECT * FROM tasks_unpartitioned;
+DROP TABLE tasks_unpartitioned;
+
+-- Indexes on the parent are created on every partition. These are the
+-- create_table.sql indexes, so report_indexes.sql isn't needed afterwards.
+CREATE INDEX tasks_worker_id_group_idx ON tasks (worker_id, worker_group) WHERE worker_id IS NOT null AND worker_group IS NOT null;
+CREATE INDEX tasks_created_brin_idx ON tasks USING BRIN (created);
+CREATE INDEX tasks_project_created_idx ON tasks (project, created) INCLUDE (revision, worker_type, state, duration);
+CREATE INDEX tasks_revision_idx ON tasks (revision) INCLUDE (created, started, resolved, state);
+CREATE INDEX tasks_started_resolved_idx ON tasks (started, resolved);
+CREATE INDEX tasks_modified_idx ON tasks (modified);
+
+CREATE TRIGGER update_modtime BEFORE UPDATE ON tasks FOR EACH ROW EXECUTE PROCEDURE update_modified_column();
+
+COMMIT;
+
+-- Index-only scans rely on the visibility map of the freshly copied rows.
+VACUUM ANALYZE tasks;
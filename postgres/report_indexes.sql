@@ -0,0 +1,36 @@
+-- Replaces the original tasks indexes with ones matching the report queries
+-- (PostgreSQL 11 or later, for INCLUDE). New installs get these from
+-- create_table.sql directly, and partition_tasks.sql creates them on the
+-- partitioned table, so this is only needed on an unpartitioned table. Running
+-- it before partition_tasks.sql is harmless.
+--
+-- Dropped:
+--   created_year_idx, created_month_idx, created_year_month_idx: the reports filter
+--     on created ranges, which can't use EXTRACT() expression indexes.
+--   project_idx, revision_idx: superseded by the covering indexes below.
+--   tasks_only_worker_id_idx: the API always looks workers up by worker_id and
+--     worker_group, which tasks_worker_id_group_idx covers.
+--   worker_type_idx: no query filters on worker_type alone.
+--
+-- Index-only scans rely on the visibility map, hence the VACUUM at the end. Check
+-- the resulting plans with scripts/explain_reports.py.
+BEGIN;
+
+DROP INDEX IF EXISTS created_year_idx;
+DROP INDEX IF EXISTS created_month_idx;
+DROP INDEX IF EXISTS created_year_month_idx;
+DROP INDEX IF EXISTS project_idx;
+DROP INDEX IF EXISTS revision_idx;
+DROP INDEX IF EXISTS tasks_only_worker_id_idx;
+DROP INDEX IF EXISTS worker_type_idx;
+
+CREATE INDEX IF NOT EXISTS tasks_created_brin_idx ON tasks USING BRIN (created);
+CREATE INDEX IF NOT EXISTS tasks_project_created_idx
+    ON tasks (project, created) INCLUDE (revision, worker_type, state, duration);
+CREATE INDEX IF NOT EXISTS tasks_revision_idx
+    ON tasks (revision) INCLUDE (created, started, resolved, state);
+CREATE INDEX IF NOT EXISTS tasks_started_resolved_idx ON tasks (started, resolved);
+
+COMMIT;
+
+VACUUM ANALYZE tasks;
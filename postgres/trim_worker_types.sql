@@ -0,0 +1,23 @@
+-- Strips the trailing space that the old parse_monthly_stats.py kept on worker
+-- types, e.g. "gecko-t-linux-large " from a "gecko-t-linux-large (Hrs)" column.
+-- The loader now trims them, so reloading a month that was loaded before would
+-- otherwise miss dup_worker_type and add a second row for every worker type.
+--
+-- Where a month was already reloaded, the trimmed row is the newer load, so the
+-- untrimmed one is dropped rather than renamed onto it.
+BEGIN;
+
+DELETE FROM worker_type_monthly_costs AS old
+    USING worker_type_monthly_costs AS new
+    WHERE old.worker_type <> rtrim(old.worker_type)
+    AND new.worker_type = rtrim(old.worker_type)
+    AND new.year = old.year
+    AND new.month = old.month
+    AND new.provider IS NOT DISTINCT FROM old.provider
+    AND new.provisioner IS NOT DISTINCT FROM old.provisioner;
+
+UPDATE worker_type_monthly_costs
+    SET worker_type = rtrim(worker_type)
+    WHERE worker_type <> rtrim(worker_type);
+
+COMMIT;
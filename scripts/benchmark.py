@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+""" benchmark.py
+
+    Times the report scripts on synthetic data (see synthetic_data.py), so changes to
+    queries, indexes or the extract code can be compared against a recorded
+    baseline at production sizes.
+
+    Every scale (--rows, may be repeated) gets a synthetic month in its own
+    directory under --dir, which the reports are also run from, so nothing they
+    write (logs/, data/, cache/) mixes with real output. Each report is run
+    --repeat times as a subprocess; its wall-clock times and peak memory are
+    recorded in a JSON file under --dir/results:
+
+        ./benchmark.py --rows 1M --rows 10M
+        ./benchmark.py --rows 10M --source db --load
+        ./benchmark.py --rows 10M --baseline benchmarks/results/20190901-120000.json
+
+    With --source extract (the default) the reports read the synthetic extract,
+    which is generated unless one with the same rows and seed is already there.
+    With --source db they query the database in database.ini, which --load first
+    fills with the synthetic month; only use a scratch database for that.
+    platform_costs.py also calls Cost Explorer, so it's only timed against the
+    database and with --ce-replay.
+"""
+
+import argparse
+import calendar
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+
+import extract
+import result_cache
+import synthetic_data
+
+from datetime import datetime
+from shared import log_ts
+
+BENCHMARK_DIR = "benchmarks"
+# A fixed month in the past, so every day of it is processed and results stay
+# comparable between runs.
+DEFAULT_MONTH = "2019-08"
+DEFAULT_REPEAT = 3
+DEFAULT_BRANCH = "mozilla-central"
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+OK = "ok"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+
+def script(name):
+    return [sys.executable, os.path.join(SCRIPTS_DIR, name)]
+
+
+def report_commands(year, month, source, raw=False, ce_replay=None, jobs=1):
+    """ Returns (name, command) for every report to time, in order. command is
+        a string explaining why instead if the report can't be run against source.
+    """
+    num_days = calendar.monthrange(year, month)[1]
+    year_month = "%d-%02d" % (year, month)
+    first_day = "%s-01" % year_month
+    last_day = "%s-%02d" % (year_month, num_days)
+    next_month = datetime(year + month // 12, month % 12 + 1, 1)
+    use_extract = source == "extract"
+    # Reports that read the rollup fall back to tasks without it, so --raw only
+    # matters against the database.
+    mode = ["--extract"] if use_extract else (["--raw"] if raw else [])
+
+    commands = []
+    if not use_extract and not raw:
+        commands.append(
+            ("refresh_rollup", script("refresh_rollup.py") + ["--month", year_month])
+        )
+    commands += [
+        (
+            "monthly_stats",
+            script("monthly_tc_stats.py")
+            + ["--daterange", "%s to %s" % (first_day, last_day)]
+            + ["--no-cache", "--no-pushlog-sync"]
+            + mode,
+        ),
+        (
+            "cost_per_push",
+            script("cost_per_push.py")
+            + ["--month", year_month, "--branch", DEFAULT_BRANCH, "--no-cache"]
+            + mode,
+        ),
+        (
+            "cost_per_push_all_branches",
+            script("cost_per_push.py")
+            + ["--month", year_month, "--all-branches", "--no-cache"]
+            + mode,
+        ),
+        (
+            "cost_per_push_per_revision",
+            script("cost_per_push.py")
+            + ["--month", year_month, "--branch", DEFAULT_BRANCH, "--per-revision"]
+            + ["--no-cache"]
+            + mode,
+        ),
+    ]
+    if use_extract:
+        commands.append(("platform_costs", "no --extract support"))
+    elif not ce_replay:
+        commands.append(("platform_costs", "needs --ce-replay"))
+    else:
+        commands.append(
+            (
+                "platform_costs",
+                script("platform_costs.py")
+                + ["--startdate", first_day]
+                + ["--enddate", next_month.strftime("%Y-%m-%d")]
+                + ["--ce-replay", os.path.abspath(ce_replay), "--no-cache"]
+                + (["--raw"] if raw else []),
+            )
+        )
+    commands += [
+        (
+            "daily_concurrency",
+            script("concurrent_tasks.py")
+            + ["--year_month", year_month, "--refresh-json", "--no-cache"]
+            + ["--jobs", str(jobs)]
+            + (["--extract"] if use_extract else []),
+        ),
+        (
+            "minute_concurrency",
+            script("concurrency_by_minute.py")
+            + ["--start", "%s 00:00" % first_day]
+            + ["--end", next_month.strftime("%Y-%m-%d 00:00")]
+            + (["--extract"] if use_extract else ["--sweep"]),
+        ),
+    ]
+    return commands
+
+
+def run(command, cwd, log):
+    """ Runs command in cwd with its output appended to log. Returns (exit status,
+        seconds, peak RSS in MB).
+    """
+    log.write("$ %s\n" % " ".join(command))
+    log.flush()
+    start = time.time()
+    proc = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+    # wait4() reports the resource usage of this child alone.
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - start
+    if os.WIFEXITED(status):
+        proc.returncode = os.WEXITSTATUS(status)
+    else:
+        proc.returncode = -os.WTERMSIG(status)
+    # ru_maxrss is in kilobytes on Linux.
+    return proc.returncode, elapsed, usage.ru_maxrss / 1024.0
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def time_command(command, cwd, log, repeat):
+    """ Runs command repeat times, stopping at the first failure. Returns its
+        result entry.
+    """
+    seconds = []
+    max_rss = 0.0
+    for _ in range(repeat):
+        status, elapsed, rss = run(command, cwd, log)
+        if status != 0:
+            return {"status": FAILED, "exit_status": status, "seconds": seconds}
+        seconds.append(round(elapsed, 3))
+        max_rss = max(max_rss, rss)
+    return {
+        "status": OK,
+        "seconds": seconds,
+        "best": min(seconds),
+        "median": round(median(seconds), 3),
+        "max_rss_mb": round(max_rss, 1),
+    }
+
+
+def has_synthetic_extract(workdir, year, month, rows, seed):
+    """ Whether workdir already holds the synthetic extract for rows and seed.
+    """
+    path = extract.extract_path(
+        year, month, os.path.join(workdir, extract.EXTRACT_DIR)
+    )
+    try:
+        with open(os.path.join(path, "meta.json")) as infile:
+            meta = json.load(infile)
+    except (IOError, ValueError):
+        return False
+    return meta.get("version") == extract.EXTRACT_VERSION and meta.get(
+        "synthetic"
+    ) == {"rows": rows, "seed": seed}
+
+
+def prepare_workdir(workdir, database_ini):
+    for directory in ("logs", "data"):
+        path = os.path.join(workdir, directory)
+        if not os.path.exists(path):
+            os.makedirs(path)
+    if database_ini and os.path.exists(database_ini):
+        shutil.copy(database_ini, os.path.join(workdir, "database.ini"))
+
+
+def benchmark_scale(args, year, month, rows, workdir, log):
+    """ Generates (or loads) the synthetic month for rows if needed and times every
+        report against it. Returns the scale's results.
+    """
+    results = {"rows": rows, "reports": {}}
+    generate = script("synthetic_data.py") + [
+        "--month",
+        "%d-%02d" % (year, month),
+        "--rows",
+        str(rows),
+        "--seed",
+        str(args.seed),
+        "--output",
+        ".",
+    ]
+    if args.source == "db":
+        if args.load:
+            generate += ["--db", "--replace"]
+        else:
+            generate = None
+    elif has_synthetic_extract(workdir, year, month, rows, args.seed):
+        generate = None
+    if generate:
+        print("[%s] Generating %s runs..." % (log_ts(), "{:,}".format(rows)))
+        results["generate"] = time_command(generate, workdir, log, 1)
+        if results["generate"]["status"] != OK:
+            return results
+
+    for name, command in report_commands(
+        year, month, args.source, args.raw, args.ce_replay, args.jobs
+    ):
+        if args.reports and name not in args.reports:
+            continue
+        if isinstance(command, str):
+            results["reports"][name] = {"status": SKIPPED, "reason": command}
+            continue
+        print("[%s] Timing %s..." % (log_ts(), name))
+        results["reports"][name] = time_command(command, workdir, log, args.repeat)
+    return results
+
+
+def print_results(results, baseline=None):
+    row_format = "{0:<30} {1:>10} {2:>10} {3:>10} {4:>12}"
+    for scale, scale_results in sorted(
+        results["scales"].items(), key=lambda item: item[1]["rows"]
+    ):
+        base = (baseline or {}).get("scales", {}).get(scale, {}).get("reports", {})
+        print()
+        print("%s rows (%s)" % (scale, results["source"]))
+        print(
+            row_format.format(
+                "Report", "Best (s)", "Median (s)", "RSS (MB)", "vs baseline"
+            )
+        )
+        for name, result in scale_results["reports"].items():
+            if result["status"] != OK:
+                detail = result.get("reason") or "exit %s" % result.get("exit_status")
+                print("{0:<30} {1} ({2})".format(name, result["status"], detail))
+                continue
+            versus = ""
+            if base.get(name, {}).get("status") == OK:
+                versus = "%.2fx" % (result["median"] / base[name]["median"])
+            print(
+                row_format.format(
+                    name,
+                    "%.2f" % result["best"],
+                    "%.2f" % result["median"],
+                    "%.1f" % result["max_rss_mb"],
+                    versus,
+                )
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rows",
+        help="Number of synthetic task runs, e.g. 1M, 10M, 100M (may be repeated, "
+        "default: 1M)",
+        action="append",
+    )
+    parser.add_argument(
+        "--month",
+        help="Month to generate and report on, format: YYYY-MM (default: %(default)s)",
+        default=DEFAULT_MONTH,
+    )
+    parser.add_argument(
+        "--seed",
+        help="Random seed for synthetic_data.py (default: %(default)s)",
+        type=int,
+        default=synthetic_data.DEFAULT_SEED,
+    )
+    parser.add_argument(
+        "--source",
+        help="What the reports read (default: %(default)s)",
+        choices=["extract", "db"],
+        default="extract",
+    )
+    parser.add_argument(
+        "--load",
+        help="With --source db, load the synthetic month into the database first, "
+        "replacing the month's tasks",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--raw",
+        help="With --source db, have the reports aggregate tasks instead of the rollup",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--ce-replay",
+        dest="ce_replay",
+        help="Cost Explorer responses for platform_costs.py (see its --ce-record)",
+    )
+    parser.add_argument(
+        "--report",
+        dest="reports",
+        help="Only time this report (may be repeated)",
+        action="append",
+    )
+    parser.add_argument(
+        "--repeat",
+        help="Runs of each report (default: %(default)s)",
+        type=int,
+        default=DEFAULT_REPEAT,
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        help="--jobs for concurrent_tasks.py (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--dir",
+        help="Directory for the synthetic data and results (default: %(default)s)",
+        default=BENCHMARK_DIR,
+    )
+    parser.add_argument(
+        "--output",
+        help="File to write the results to (default: DIR/results/<timestamp>.json)",
+    )
+    parser.add_argument("--baseline", help="Results file to compare against")
+    args = parser.parse_args()
+
+    try:
+        parsed = datetime.strptime(args.month, "%Y-%m")
+    except ValueError:
+        print("ERROR: unable to parse month %s" % args.month)
+        sys.exit(1)
+    try:
+        scales = [synthetic_data.parse_rows(rows) for rows in args.rows or ["1M"]]
+    except ValueError:
+        print("ERROR: unable to parse --rows %s" % ", ".join(args.rows))
+        sys.exit(2)
+    if args.repeat < 1:
+        print("--repeat must be at least 1")
+        sys.exit(3)
+    if args.source == "extract" and (args.load or args.raw):
+        print("--load and --raw need --source db")
+        sys.exit(4)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+
+    started = datetime.now()
+    results = {
+        "started": started.strftime("%Y-%m-%d %H:%M:%S"),
+        "month": args.month,
+        "source": args.source,
+        "raw": args.raw,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scales": {},
+    }
+    output = args.output or os.path.join(
+        args.dir, "results", started.strftime("%Y%m%d-%H%M%S.json")
+    )
+    failures = 0
+    for rows in scales:
+        scale = synthetic_data.format_rows(rows)
+        # Scales share the database, so they can't keep their data apart there.
+        workdir = os.path.join(
+            args.dir, scale if args.source == "extract" else "db"
+        )
+        prepare_workdir(workdir, "database.ini")
+        with open(os.path.join(workdir, "benchmark.log"), "a") as log:
+            results["scales"][scale] = benchmark_scale(
+                args, parsed.year, parsed.month, rows, workdir, log
+            )
+        entries = list(results["scales"][scale]["reports"].values())
+        entries.append(results["scales"][scale].get("generate", {}))
+        failures += sum(1 for entry in entries if entry.get("status") == FAILED)
+        # Written after every scale, so finished scales survive an interrupted run.
+        result_cache.write_json_atomic(output, results, indent=4, sort_keys=True)
+
+    print_results(results, baseline)
+    print()
+    print("[%s] Wrote %s" % (log_ts(), output))
+    if failures:
+        print("%d runs failed, see benchmark.log in %s" % (failures, args.dir))
+    sys.exit(1 if failures else 0)
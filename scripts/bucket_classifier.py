@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+""" Classifies (worker type, platform) pairs into platform buckets.
+
+    A bucket table is an ordered list of (bucket, [substrings]). A pair belongs to
+    the first bucket with a substring of the platform, or failing that the first
+    bucket with a substring of the worker type, or else to the default bucket.
+
+    The whole table is compiled into one alternation regex, ordered by bucket, and
+    results are memoized per distinct pair in a bounded LRU cache, so classifying
+    raw per-task rows costs about the same as classifying pre-grouped ones.
+
+    Bucket tables can be loaded from JSON or YAML with load_buckets(), in either
+    of these forms:
+
+        [{"bucket": "Linux64", "matches": ["linux64"]}, ...]
+        {"Linux64": ["linux64"], ...}
+"""
+
+import json
+import re
+
+from functools import lru_cache
+
+DEFAULT_BUCKETS = [
+    ("Linux64", ["linux64"]),
+    ("Linux32", ["linux32"]),
+    ("OS X", ["osx"]),
+    ("Android", ["android", "Android", "mobile"]),
+    ("Windows Server 2012", ["windows2012", "win2012"]),
+    ("Windows 7", ["windows7", "win7"]),
+    ("Windows 10", ["windows10", "win10"]),
+    ("b2g", ["mulet", "gaia", "b2g", "flame"]),
+]
+
+DEFAULT_BUCKET = "Other"
+DEFAULT_CACHE_SIZE = 4096
+
+
+class BucketClassifier(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS, default=DEFAULT_BUCKET, cache_size=DEFAULT_CACHE_SIZE):
+        self.buckets = [(bucket, list(matches)) for bucket, matches in buckets]
+        self.default = default
+        # Each substring maps to the first bucket that lists it.
+        self._rank = {}
+        for index, (_, matches) in enumerate(self.buckets):
+            for match in matches:
+                self._rank.setdefault(match, index)
+        # At any one position the regex reports the first alternative that matches,
+        # so list them in bucket order. The lookahead makes finditer() try every
+        # position, including ones inside an earlier match.
+        alternatives = sorted(self._rank, key=lambda m: (self._rank[m], -len(m)))
+        if alternatives:
+            self._pattern = re.compile(
+                "(?=(%s))" % "|".join(re.escape(m) for m in alternatives)
+            )
+        else:
+            self._pattern = None
+        self.classify = lru_cache(maxsize=cache_size)(self._classify)
+
+    def _first_bucket(self, value):
+        """ Returns the index of the first bucket with a substring of value, or None.
+        """
+        if not value or self._pattern is None:
+            return None
+        ranks = [self._rank[m.group(1)] for m in self._pattern.finditer(value)]
+        return min(ranks) if ranks else None
+
+    def _classify(self, worker_type, platform):
+        index = self._first_bucket(platform)
+        if index is None:
+            index = self._first_bucket(worker_type)
+        if index is None:
+            return self.default
+        return self.buckets[index][0]
+
+    def cache_info(self):
+        return self.classify.cache_info()
+
+
+def load_buckets(filename):
+    """ Returns the bucket table in a JSON or YAML file.
+    """
+    with open(filename) as infile:
+        if filename.endswith((".yml", ".yaml")):
+            import yaml
+
+            data = yaml.safe_load(infile)
+        else:
+            data = json.load(infile)
+    if isinstance(data, dict):
+        return [(bucket, matches) for bucket, matches in data.items()]
+    return [(entry["bucket"], entry["matches"]) for entry in data]
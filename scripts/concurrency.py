@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+""" Vectorized task concurrency.
+
+    Task intervals are passed in as int64 epoch-second arrays of start and end
+    times. A task is counted in every bucket it overlaps, i.e. bucket i covers
+    [origin + i * width, origin + (i + 1) * width) and a task is in it when
+    started < bucket end and resolved >= bucket start.
+
+    Callers fetching from the database should round started up and resolved down
+    to whole seconds (see INTERVAL_COLUMNS) so that the per-bucket counts match
+    the "started <= bucket_end AND resolved >= bucket_start" SQL predicates the
+    scripts used before.
+"""
+
+import calendar
+
+import numpy as np
+
+from array import array
+from datetime import timedelta
+
+BUCKET_WIDTHS = {"second": 1, "minute": 60, "hour": 60 * 60}
+
+# Taskcluster deadlines are at most 5 days after creation, so a task running at time t
+# was created after t - MAX_TASK_LIFETIME. Adding that bound on created to overlap
+# queries lets the planner prune the monthly tasks partitions.
+MAX_TASK_LIFETIME = timedelta(days=5)
+
+INTERVAL_COLUMNS = (
+    "CEIL(EXTRACT(EPOCH FROM started))::bigint, FLOOR(EXTRACT(EPOCH FROM resolved))::bigint"
+)
+
+
+def to_epoch(ts):
+    return calendar.timegm(ts.timetuple())
+
+
+def bucket_width(bucket):
+    if bucket not in BUCKET_WIDTHS:
+        raise ValueError(
+            "Unknown bucket width %s, expected one of: %s"
+            % (bucket, ", ".join(BUCKET_WIDTHS))
+        )
+    return BUCKET_WIDTHS[bucket]
+
+
+def intervals_from_rows(rows):
+    """ Splits (started, resolved, ...) rows into int64 start and end arrays, plus
+        an array of the third column if there is one. rows can be any iterable, e.g.
+        a server-side cursor, and is consumed in a single pass.
+    """
+    starts = array("q")
+    ends = array("q")
+    groups = None
+    for row in rows:
+        starts.append(row[0])
+        ends.append(row[1])
+        if len(row) > 2:
+            if groups is None:
+                groups = []
+            groups.append(row[2])
+    if groups is not None:
+        groups = np.array(groups, dtype=object)
+    return (
+        np.frombuffer(starts, dtype=np.int64),
+        np.frombuffer(ends, dtype=np.int64),
+        groups,
+    )
+
+
+def _bucket_range(starts, ends, origin, num_buckets, width):
+    first = (np.asarray(starts, dtype=np.int64) - origin) // width
+    last = (np.asarray(ends, dtype=np.int64) - origin) // width
+    np.maximum(first, 0, out=first)
+    np.minimum(last, num_buckets - 1, out=last)
+    keep = first <= last
+    return first[keep], last[keep], keep
+
+
+def concurrency_histogram(starts, ends, origin, num_buckets, width=60):
+    """ Returns an int64 array with the number of concurrent tasks in each of
+        num_buckets buckets of width seconds starting at origin (epoch seconds).
+    """
+    first, last, _ = _bucket_range(starts, ends, origin, num_buckets, width)
+    deltas = np.zeros(num_buckets + 1, dtype=np.int64)
+    np.add.at(deltas, first, 1)
+    np.add.at(deltas, last + 1, -1)
+    return np.cumsum(deltas[:-1])
+
+
+def concurrency_by_group(starts, ends, groups, origin, num_buckets, width=60):
+    """ Like concurrency_histogram, but returns a dict of group -> histogram, e.g.
+        one series per instance type. All groups are computed in a single pass.
+    """
+    labels, codes = np.unique(np.asarray(groups), return_inverse=True)
+    first, last, keep = _bucket_range(starts, ends, origin, num_buckets, width)
+    codes = codes[keep]
+    stride = num_buckets + 1
+    deltas = np.zeros(len(labels) * stride, dtype=np.int64)
+    np.add.at(deltas, codes * stride + first, 1)
+    np.add.at(deltas, codes * stride + last + 1, -1)
+    deltas = deltas.reshape(len(labels), stride)
+    histograms = np.cumsum(deltas[:, :-1], axis=1)
+    return {label: histograms[i] for i, label in enumerate(labels)}
+
+
+def peak_concurrency(histogram, origin, width=1):
+    """ Returns (epoch seconds of the busiest bucket, number of concurrent tasks).
+    """
+    if len(histogram) == 0:
+        return origin, 0
+    busiest = int(np.argmax(histogram))
+    return origin + busiest * width, int(histogram[busiest])
@@ -3,13 +3,24 @@
 import argparse
 import csv
 import json
+import math
+import numpy as np
 import os
-import psycopg2
 import sys
 
-from db_config import db_config
+import db_session
+import extract
+import plan_capture
+import profiling
+
+from concurrency import (
+    BUCKET_WIDTHS,
+    MAX_TASK_LIFETIME,
+    concurrency_by_group,
+    intervals_from_rows,
+    to_epoch,
+)
 from datetime import date, datetime, timedelta
-from psycopg2 import extras
 from shared import timeit
 
 aws_windows_workers = [
@@ -25,7 +36,14 @@ aws_windows_workers = [
 'c5.2xlarge',
 ]
 
-psycopg2.extensions.set_wait_callback(extras.wait_select)
+# Several of these instance types also run Linux worker types, so the queries only
+# count the Windows worker types (gecko-t-win10-64, gecko-1-b-win2012, ...), like
+# the tasks_windows_201908 copy the script used to read.
+WINDOWS_WORKER_TYPE_PATTERN = "%-win%"
+
+
+def is_windows_worker_type(worker_type):
+    return worker_type is not None and "-win" in worker_type
 
 
 def initialize_entry():
@@ -45,20 +63,106 @@ def get_concurrent_tasks_for_timerange(start_ts, end_ts):
     entry = initialize_entry()
     query = (
        "SELECT w.instance_type, COUNT(t.task_id) AS num_instances \
-        FROM tasks_windows_201908 t, worker_instance_mapping w \
-        WHERE t.started<=timestamp'%s' \
-        AND t.resolved>=timestamp'%s' \
+        FROM tasks t, worker_instance_mapping w \
+        WHERE t.created>=$3 \
+        AND t.created<=$1 \
+        AND t.started<=$1 \
+        AND t.resolved>=$2 \
         AND t.worker_type=w.worker_type \
+        AND t.worker_type LIKE $4 \
+        AND w.instance_type = ANY($5) \
         GROUP BY w.instance_type"
-        % (end_ts, start_ts)
     )
-    cur.execute(query)
-    records = cur.fetchall()
+    records = db_session.fetchall_prepared(
+        "concurrent_tasks_for_timerange",
+        query,
+        (
+            end_ts,
+            start_ts,
+            start_ts - MAX_TASK_LIFETIME,
+            WINDOWS_WORKER_TYPE_PATTERN,
+            aws_windows_workers,
+        ),
+    )
     for record in records:
         entry[record[0]] += record[1]
     return entry
 
 
+@timeit
+def get_task_intervals(start_ts, end_ts):
+    """ Returns (started, resolved, instance_type) arrays for every task that overlaps
+        the period between two timestamps, streamed from a single query. started and
+        resolved are whole epoch seconds, see concurrency.INTERVAL_COLUMNS.
+    """
+    query = (
+        "SELECT CEIL(EXTRACT(EPOCH FROM t.started))::bigint, \
+            FLOOR(EXTRACT(EPOCH FROM t.resolved))::bigint, \
+            w.instance_type \
+        FROM tasks t, worker_instance_mapping w \
+        WHERE t.created>=%s \
+        AND t.created<=%s \
+        AND t.started<=%s \
+        AND t.resolved>=%s \
+        AND t.worker_type=w.worker_type \
+        AND t.worker_type LIKE %s \
+        AND w.instance_type = ANY(%s)"
+    )
+    params = (
+        start_ts - MAX_TASK_LIFETIME,
+        end_ts,
+        end_ts,
+        start_ts,
+        WINDOWS_WORKER_TYPE_PATTERN,
+        aws_windows_workers,
+    )
+    with db_session.named_cursor("task_intervals") as cur:
+        cur.execute(query, params)
+        return intervals_from_rows(cur)
+
+
+@timeit
+def get_task_intervals_from_extract(start_ts, end_ts):
+    """ Like get_task_intervals(), but reads the local extracts written by
+        extract.py instead of querying the database.
+    """
+    extracts = extract.load_range(start_ts, end_ts)
+    starts, ends, worker_types = extract.task_intervals(
+        extracts, start_ts, end_ts, group="worker_type"
+    )
+    mapping = {}
+    for ext in extracts:
+        mapping.update(ext.meta["worker_instance_mapping"])
+    instance_types = np.array(
+        [mapping.get(w) if is_windows_worker_type(w) else None for w in worker_types],
+        dtype=object,
+    )
+    # Tasks on Linux worker types, or worker types without an instance mapping, drop
+    # out like they do in the query.
+    mapped = instance_types != None  # noqa: E711
+    return starts[mapped], ends[mapped], instance_types[mapped]
+
+
+@timeit
+def sweep_concurrent_tasks(intervals, start_ts, num_buckets, width=60):
+    """ Returns a dict of instance_type -> array of concurrent task counts for
+        num_buckets buckets of width seconds starting at start_ts.
+    """
+    starts, ends, instance_types = intervals
+    series = {}
+    for instance in aws_windows_workers:
+        series[instance] = np.zeros(num_buckets, dtype=np.int64)
+    if instance_types is None:
+        return series
+    by_instance = concurrency_by_group(
+        starts, ends, instance_types, to_epoch(start_ts), num_buckets, width
+    )
+    for instance in aws_windows_workers:
+        if instance in by_instance:
+            series[instance] = by_instance[instance]
+    return series
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -73,41 +177,80 @@ if __name__ == "__main__":
         type=str,
         required=True,
     )
+    parser.add_argument(
+        "--sweep",
+        help="Fetch all task intervals once and compute every bucket in a single pass",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--bucket",
+        help="Bucket width for --sweep (default: minute)",
+        choices=sorted(BUCKET_WIDTHS),
+        default="minute",
+    )
+    parser.add_argument(
+        "--extract",
+        help="Read tasks from the local extracts written by extract.py (implies --sweep)",
+        action="store_true",
+    )
+    profiling.add_profiling_arguments(parser)
+    plan_capture.add_explain_arguments(parser)
     args = parser.parse_args()
+    profiling.configure_from_args(args)
+    plan_capture.configure_from_args(args)
     if not args.start:
         print('Must supply a start timestamp, format="YYYY-MM-DD HH:mm"')
         sys.exit(1)
     if not args.end:
         print('Must supply an end timestamp, format="YYYY-MM-DD HH:mm"')
         sys.exit(2)
+    if args.extract:
+        args.sweep = True
+    if args.bucket != "minute" and not args.sweep:
+        print("--bucket requires --sweep")
+        sys.exit(4)
     user_start = datetime.strptime(args.start, '%Y-%m-%d %H:%M')
     user_end = datetime.strptime(args.end, '%Y-%m-%d %H:%M')
 
-    conn = None
-    db_params = db_config()
-    try:
-        conn = psycopg2.connect(**db_params)
-    except psycopg2.Error:
-        print("I am unable to connect to the database")
-        sys.exit(3)
-    cur = conn.cursor()
+    if not args.extract:
+        db_session.init_pool()
     current_start = user_start
 
+    width = BUCKET_WIDTHS[args.bucket]
     csvfiles = {}
     for instance in aws_windows_workers:
-        filename = "data/concurrent_%s_by_minute_201908.csv" % instance
+        filename = "data/concurrent_%s_by_%s_%s.csv" % (
+            instance, args.bucket, user_start.strftime("%Y%m")
+        )
         csvfile = open(filename, 'a')
         my_writer = csv.writer(csvfile)
         csvfiles[instance] = {}
         csvfiles[instance]['csvfile'] = csvfile
         csvfiles[instance]['writer'] = my_writer
-    while current_start < user_end:
-        print(current_start)
-        current_end = current_start + timedelta(seconds=59)
-        entry = get_concurrent_tasks_for_timerange(current_start, current_end)
-        for instance in entry:
-            csvfiles[instance]['writer'].writerow([current_start, current_end, entry[instance]])
-            csvfiles[instance]['csvfile'].flush()
-        current_start = current_start + timedelta(minutes=1)
+    if args.sweep:
+        num_buckets = int(math.ceil((user_end - user_start).total_seconds() / width))
+        last_end = user_start + timedelta(seconds=num_buckets * width - 1)
+        if args.extract:
+            intervals = get_task_intervals_from_extract(user_start, last_end)
+        else:
+            intervals = get_task_intervals(user_start, last_end)
+        series = sweep_concurrent_tasks(intervals, user_start, num_buckets, width)
+        for bucket in range(num_buckets):
+            current_start = user_start + timedelta(seconds=bucket * width)
+            current_end = current_start + timedelta(seconds=width - 1)
+            for instance in aws_windows_workers:
+                csvfiles[instance]['writer'].writerow(
+                    [current_start, current_end, series[instance][bucket]]
+                )
+    else:
+        while current_start < user_end:
+            print(current_start)
+            current_end = current_start + timedelta(seconds=59)
+            entry = get_concurrent_tasks_for_timerange(current_start, current_end)
+            for instance in entry:
+                csvfiles[instance]['writer'].writerow([current_start, current_end, entry[instance]])
+                csvfiles[instance]['csvfile'].flush()
+            current_start = current_start + timedelta(minutes=1)
     for instance in aws_windows_workers:
         csvfiles[instance]['csvfile'].close()
+    db_session.close_pool()
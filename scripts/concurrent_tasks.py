@@ -7,29 +7,87 @@ import json
 import os
 
 # import pprint
-import psycopg2
 import sys
 
-from db_config import db_config
+import db_session
+import extract
+import plan_capture
+import profiling
+import result_cache
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrency import (
+    BUCKET_WIDTHS,
+    INTERVAL_COLUMNS,
+    MAX_TASK_LIFETIME,
+    bucket_width,
+    concurrency_histogram,
+    intervals_from_rows,
+    peak_concurrency,
+    to_epoch,
+)
 from datetime import date, datetime, timedelta
-from psycopg2 import extras
 from shared import log_ts, timeit
 
-psycopg2.extensions.set_wait_callback(extras.wait_select)
+SECONDS_PER_DAY = 24 * 60 * 60
+
+DAY_INTERVALS_QUERY = (
+    "SELECT %s \
+        FROM tasks \
+        WHERE created >= %%(created_after)s \
+        AND created < %%(day_end)s \
+        AND started < %%(day_end)s \
+        AND resolved >= %%(day_start)s"
+    % INTERVAL_COLUMNS
+)
+
+
+@timeit
+def get_task_intervals_for_day(my_date):
+    """ Returns (started, resolved) epoch second arrays for every task that ran during a given day
+    """
+    day_start = datetime.strptime(my_date, "%Y-%m-%d")
+    day_end = day_start + timedelta(days=1)
+    params = {
+        "created_after": day_start - MAX_TASK_LIFETIME,
+        "day_start": day_start,
+        "day_end": day_end,
+    }
+    with db_session.named_cursor("day_intervals") as cur:
+        cur.execute(DAY_INTERVALS_QUERY, params)
+        starts, ends, _ = intervals_from_rows(cur)
+    return starts, ends
 
 
 @timeit
-def get_concurrent_tasks_for_day(my_date):
-    """ Returns a list of tuples of the tasks with the highest concurrency for a given day
+def get_task_intervals_for_day_from_extract(my_date):
+    """ Like get_task_intervals_for_day(), but reads the local extracts written by
+        extract.py instead of querying the database.
     """
-    query = (
-        "SELECT * \
-            FROM task_overlaps_day('%s')"
-        % my_date
+    day_start = datetime.strptime(my_date, "%Y-%m-%d")
+    day_end = day_start + timedelta(days=1)
+    # The query's "started < day_end" is "started <= day_end - 1s" in whole seconds.
+    last_second = day_end - timedelta(seconds=1)
+    starts, ends, _ = extract.task_intervals(
+        extract.load_range(day_start, last_second), day_start, last_second
     )
-    cur.execute(query)
-    records = cur.fetchall()
-    return records
+    return starts, ends
+
+
+@timeit
+def get_concurrent_tasks_for_day(my_date, bucket="second", use_extract=False):
+    """ Returns a list with a single (timestamp, concurrent tasks) tuple for the bucket
+        with the highest concurrency on a given day
+    """
+    width = bucket_width(bucket)
+    origin = to_epoch(datetime.strptime(my_date, "%Y-%m-%d"))
+    if use_extract:
+        starts, ends = get_task_intervals_for_day_from_extract(my_date)
+    else:
+        starts, ends = get_task_intervals_for_day(my_date)
+    histogram = concurrency_histogram(starts, ends, origin, SECONDS_PER_DAY // width, width)
+    peak_ts, peak = peak_concurrency(histogram, origin, width)
+    return [(datetime.utcfromtimestamp(peak_ts), peak)]
 
 
 def daterange(start_date, end_date):
@@ -37,25 +95,94 @@ def daterange(start_date, end_date):
         yield start_date + timedelta(n)
 
 
+def get_cached_concurrent_tasks_for_day(my_date, bucket="second", use_extract=False):
+    """ get_concurrent_tasks_for_day() through the result cache. Days that have settled
+        don't change, so they are only recomputed on --refresh or once their entry
+        expires. Recent days aren't cached.
+    """
+    params = {"day": my_date, "bucket": bucket}
+    if use_extract:
+        params["source"] = "extract"
+    return result_cache.cached(
+        "concurrent_tasks",
+        DAY_INTERVALS_QUERY,
+        params,
+        lambda: get_concurrent_tasks_for_day(my_date, bucket, use_extract),
+        range_end=datetime.strptime(my_date, "%Y-%m-%d") + timedelta(days=1),
+    )
+
+
+def process_day(single_date, bucket, use_extract=False):
+    concurrent_tasks = get_cached_concurrent_tasks_for_day(
+        single_date, bucket, use_extract
+    )
+    print("[%s] Finished %s" % (log_ts(), single_date))
+    return concurrent_tasks
+
+
+def process_days_in_parallel(days, bucket, jobs, use_extract=False):
+    """ Computes the given days concurrently, each worker thread holding one of the
+        session pool's connections. Returns a dict of day -> result.
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            day: executor.submit(process_day, day, bucket, use_extract) for day in days
+        }
+        return {day: future.result() for day, future in futures.items()}
+
+
+def write_json(filename, data):
+    result_cache.write_json_atomic(filename, data, indent=4, sort_keys=True)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-r", "--refresh-json", help="Refresh JSON on disk", action="store_true"
     )
+    result_cache.add_cache_arguments(parser)
+    profiling.add_profiling_arguments(parser)
+    plan_capture.add_explain_arguments(parser)
     parser.add_argument(
         "--year_month",
         help='Month to process, format="YYYY-MM"',
         type=str,
         required=True,
     )
+    parser.add_argument(
+        "--bucket",
+        help="Resolution used to find the daily peak (default: second)",
+        choices=sorted(BUCKET_WIDTHS),
+        default="second",
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        help="Number of days to process concurrently (default: 1)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--extract",
+        help="Read tasks from the local extracts written by extract.py",
+        action="store_true",
+    )
     args = parser.parse_args()
+    profiling.configure_from_args(args)
+    plan_capture.configure_from_args(args)
     if not args.year_month:
         print('Must supply a month to process, format="YYYY-MM"')
         sys.exit(1)
+    if args.jobs < 1:
+        print("--jobs must be at least 1")
+        sys.exit(3)
+    # --refresh-json predates the shared cache and now means the same as --refresh.
+    if args.refresh_json:
+        args.refresh_cache = True
+    result_cache.configure_from_args(args)
 
     localfile = "logs/concurrent_tasks_%s.json" % args.year_month
     concurrent_tasks_by_day = {}
-    if os.path.exists(localfile):
+    if os.path.exists(localfile) and not args.refresh_cache:
         with open(localfile) as ct:
             concurrent_tasks_by_day = json.load(ct)
 
@@ -64,9 +191,10 @@ if __name__ == "__main__":
     _, num_days = calendar.monthrange(first_day.year, first_day.month)
     last_day = date(year, month, num_days)
 
-    conn = None
-    db_params = db_config()
+    if not args.extract:
+        db_session.init_pool(maxconn=args.jobs)
     today = datetime.now().date()
+    pending_days = []
     for working_date in daterange(first_day, last_day):
         single_date = str(working_date)
         if working_date > today:
@@ -83,21 +211,25 @@ if __name__ == "__main__":
             continue
         print("[%s] Processing %s..." % (log_ts(), single_date))
         if single_date not in concurrent_tasks_by_day:
-            try:
-                conn = psycopg2.connect(**db_params)
-            except psycopg2.Error:
-                print("I am unable to connect to the database")
-                sys.exit(2)
-            cur = conn.cursor()
-            concurrent_tasks_by_day[single_date] = get_concurrent_tasks_for_day(
-                single_date
+            if args.jobs > 1:
+                pending_days.append(single_date)
+                continue
+            concurrent_tasks_by_day[single_date] = get_cached_concurrent_tasks_for_day(
+                single_date, args.bucket, args.extract
+            )
+            write_json(localfile, concurrent_tasks_by_day)
+    if pending_days:
+        print(
+            "[%s] Processing %d days with %d jobs..."
+            % (log_ts(), len(pending_days), args.jobs)
+        )
+        concurrent_tasks_by_day.update(
+            process_days_in_parallel(
+                pending_days, args.bucket, args.jobs, args.extract
             )
-            cur.close()
-            conn.close()
-            with open(localfile, "w") as ct:
-                json.dump(
-                    concurrent_tasks_by_day, ct, indent=4, sort_keys=True, default=str
-                )
+        )
+        write_json(localfile, concurrent_tasks_by_day)
+    db_session.close_pool()
     # pp = pprint.PrettyPrinter(indent=4)
     # pp.pprint(concurrent_tasks_by_day)
     # m = max(max(concurrent_tasks_by_day[day][1])
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+""" Helpers for pulling costs out of AWS Cost Explorer.
+
+    get_cost_and_usage() follows NextPageToken until every page has been read and
+    retries throttled requests with exponential backoff. get_all() issues many
+    requests concurrently through a bounded thread pool. Results are cached in the
+    result cache on the request (see result_cache.py).
+
+    For working offline, RecordingClient saves every response (and error) it sees
+    to a JSON file and ReplayClient answers requests from such a file, in the order
+    they were recorded:
+
+        client = cost_explorer.RecordingClient(boto3.client("ce"), "ce.json")
+        ...
+        client.save()
+
+        client = cost_explorer.ReplayClient("ce.json")
+"""
+
+import hashlib
+import json
+import random
+import threading
+import time
+
+import profiling
+import result_cache
+
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+DEFAULT_JOBS = 8
+
+# Cost Explorer allows only a few requests per second per account.
+MAX_ATTEMPTS = 8
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+THROTTLING_ERRORS = (
+    "ThrottlingException",
+    "LimitExceededException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+)
+
+METRICS = ["UnblendedCost", "UsageQuantity"]
+
+
+def build_query(startdate, enddate, dimension, values, *group_by):
+    """ Returns a MONTHLY get_cost_and_usage request for usage matching any of
+        values in dimension, grouped by group_by, e.g. {"Type": "TAG", "Key": "Name"}.
+        Cost Explorer allows up to two groupings.
+    """
+    return {
+        "TimePeriod": {"Start": startdate, "End": enddate},
+        "Granularity": "MONTHLY",
+        "Filter": {"Dimensions": {"Key": dimension, "Values": list(values)}},
+        "Metrics": list(METRICS),
+        "GroupBy": [dict(g) for g in group_by],
+    }
+
+
+def _is_throttled(error):
+    return error.response.get("Error", {}).get("Code") in THROTTLING_ERRORS
+
+
+def call_with_backoff(client, request):
+    """ Calls get_cost_and_usage, sleeping and retrying with exponential backoff
+        (plus jitter) while the request is throttled.
+    """
+    with profiling.span("cost_explorer.get_cost_and_usage", profiling.NETWORK) as span:
+        for attempt in range(MAX_ATTEMPTS):
+            span.set(attempts=attempt + 1)
+            try:
+                response = client.get_cost_and_usage(**request)
+            except ClientError as error:
+                if not _is_throttled(error) or attempt == MAX_ATTEMPTS - 1:
+                    raise
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+                time.sleep(delay + random.uniform(0, delay / 2))
+                continue
+            span.set(
+                groups=sum(
+                    len(result.get("Groups", []))
+                    for result in response.get("ResultsByTime", [])
+                )
+            )
+            return response
+
+
+def fetch_all_pages(client, query):
+    """ Returns a single response with the groups of every page merged into the
+        ResultsByTime entry for their time period.
+    """
+    results = []
+    by_period = {}
+    request = dict(query)
+    while True:
+        response = call_with_backoff(client, request)
+        for result in response.get("ResultsByTime", []):
+            period = (result["TimePeriod"]["Start"], result["TimePeriod"]["End"])
+            if period in by_period:
+                by_period[period]["Groups"].extend(result.get("Groups", []))
+            else:
+                result = dict(result)
+                result["Groups"] = list(result.get("Groups", []))
+                by_period[period] = result
+                results.append(result)
+        token = response.get("NextPageToken")
+        if not token:
+            break
+        request = dict(query, NextPageToken=token)
+    return {"ResultsByTime": results}
+
+
+def get_cost_and_usage(client, query):
+    """ Cost Explorer bills per request, so responses are cached on the request, once
+        its time period has settled.
+    """
+    return result_cache.cached(
+        "cost_explorer",
+        query,
+        None,
+        lambda: fetch_all_pages(client, query),
+        range_end=datetime.strptime(query["TimePeriod"]["End"], "%Y-%m-%d"),
+    )
+
+
+def get_all(client, queries, jobs=DEFAULT_JOBS):
+    """ Returns the responses to queries, in the same order, issuing up to jobs
+        requests at a time.
+    """
+    if jobs <= 1 or len(queries) <= 1:
+        return [get_cost_and_usage(client, query) for query in queries]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(lambda q: get_cost_and_usage(client, q), queries))
+
+
+def _request_key(request):
+    # Unlike cache keys, this doesn't depend on CACHE_VERSION, so recordings stay
+    # usable when the cache is invalidated.
+    material = result_cache.to_json(request, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class RecordingClient(object):
+    """ Wraps a Cost Explorer client and remembers every response, and every error
+        such as throttling, so that save() can write them out for ReplayClient.
+        Each request maps to the list of its outcomes, in call order.
+    """
+
+    def __init__(self, client, filename):
+        self.client = client
+        self.filename = filename
+        self.responses = {}
+        self._lock = threading.Lock()
+
+    def _record(self, request, outcome):
+        with self._lock:
+            self.responses.setdefault(_request_key(request), []).append(outcome)
+
+    def get_cost_and_usage(self, **request):
+        try:
+            response = dict(self.client.get_cost_and_usage(**request))
+        except ClientError as error:
+            self._record(request, {"Error": error.response.get("Error", {})})
+            raise
+        # Request ids and HTTP headers differ on every call and aren't worth keeping.
+        response.pop("ResponseMetadata", None)
+        response = json.loads(result_cache.to_json(response))
+        self._record(request, response)
+        return response
+
+    def save(self):
+        result_cache.write_json_atomic(
+            self.filename, self.responses, indent=2, sort_keys=True
+        )
+
+
+class ReplayClient(object):
+    """ Answers get_cost_and_usage requests from a file written by RecordingClient.
+        A request's recorded outcomes are replayed in order, recorded errors raised
+        as ClientError, and the last one is repeated once they run out.
+    """
+
+    def __init__(self, filename):
+        with open(filename) as infile:
+            self.responses = json.load(infile)
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def get_cost_and_usage(self, **request):
+        key = _request_key(request)
+        if key not in self.responses:
+            raise KeyError(
+                "No recorded response for request: %s" % result_cache.to_json(request)
+            )
+        outcomes = self.responses[key]
+        with self._lock:
+            call = self.calls.get(key, 0)
+            self.calls[key] = call + 1
+        outcome = outcomes[min(call, len(outcomes) - 1)]
+        if "Error" in outcome:
+            raise ClientError({"Error": outcome["Error"]}, "GetCostAndUsage")
+        return outcome
@@ -24,33 +24,104 @@
 """
 
 import argparse
-import simplejson as json
-import os
-import psycopg2
+import heapq
 import sys
 
-from db_config import db_config
-from psycopg2 import extras
-from shared import timeit
-
-
-def open_connection():
-    try:
-        db_params = db_config()
-        psycopg2.extensions.set_wait_callback(extras.wait_select)
-        conn = psycopg2.connect(**db_params)
-        cur = conn.cursor()
-        return conn, cur
-    except psycopg2.DatabaseError as error:
-        print("Unable to connect to database: %s" % error)
-        sys.exit(1)
+from array import array
+
+import db_session
+import extract
+import plan_capture
+import profiling
+import result_cache
+
+from refresh_rollup import rollup_version, use_rollup
+from shared import month_range, timeit
+
+DEFAULT_TOP = 10
+PERCENTILES = (50, 90, 99)
+
+# Queries against tasks itself rather than the rollup. explain_reports.py checks
+# their plans.
+TC_HOURS_QUERY = (
+    "SELECT worker_type, SUM(duration)/1000/60/60 AS total_hours \
+         FROM tasks \
+         WHERE created >= %s \
+         AND created < %s \
+         GROUP BY worker_type \
+         ORDER BY total_hours DESC"
+)
+
+NUM_PUSHES_QUERY = (
+    "SELECT COUNT(DISTINCT(revision)) \
+         FROM tasks \
+         WHERE project = $1 \
+         AND created >= $2 \
+         AND created < $3"
+)
+
+BRANCH_HOURS_QUERY = (
+    "SELECT worker_type, SUM(duration)/(1000.0*60*60) \
+         FROM tasks \
+         WHERE project = %s AND \
+         created >= %s \
+         AND created < %s \
+         AND state = 'completed' \
+         GROUP BY project, worker_type"
+)
+
+PROJECT_PUSHES_QUERY = (
+    "SELECT project, COUNT(DISTINCT(revision)) \
+         FROM tasks \
+         WHERE created >= %s \
+         AND created < %s \
+         GROUP BY project"
+)
+
+PROJECT_HOURS_QUERY = (
+    "SELECT project, worker_type, SUM(duration)/(1000.0*60*60) \
+         FROM tasks \
+         WHERE created >= %s \
+         AND created < %s \
+         AND state = 'completed' \
+         GROUP BY project, worker_type"
+)
+
+REVISION_HOURS_QUERY = (
+    "SELECT revision, worker_type, SUM(duration)/(1000.0*60*60) \
+         FROM tasks \
+         WHERE project = %s \
+         AND created >= %s \
+         AND created < %s \
+         AND state = 'completed' \
+         GROUP BY revision, worker_type \
+         ORDER BY revision"
+)
+
+
+def month_cache_options(year, month, rollup=False):
+    """ result_cache keyword arguments for a query over a month: it is only cached
+        once the month has settled, and reads from the rollup are keyed on when the
+        month was last rolled up.
+    """
+    options = {"range_end": month_range(year, month)[1]}
+    if rollup:
+        options["version"] = rollup_version((year, month))
+    return options
 
 
-def close_connection(conn, cur):
-    if cur:
-        cur.close()
-    if conn:
-        conn.close()
+def costs_cache_options(year, month):
+    """ Like month_cache_options(), for reads of worker_type_monthly_costs, keyed on
+        when the month's costs were last loaded.
+    """
+    row = db_session.fetchone(
+        "SELECT MAX(modified) FROM worker_type_monthly_costs WHERE year = %s AND month = %s",
+        (year, month),
+    )
+    return {
+        "range_end": month_range(year, month)[1],
+        "version": str(row[0]) if row and row[0] else None,
+    }
 
 
 def new_efficiency_worker_type():
@@ -62,13 +133,16 @@ def new_efficiency_worker_type():
 
 
 @timeit
-def get_efficiency_factor(year, month):
+def get_efficiency_factor(year, month, rollup=True, ext=None):
     """The efficiency factor is a measure of the discrepancy between the total time reported for
     each worker type and the total time billed by AWS for that same worker type. This accounts
     for the overhead involved in setting up & tearing down workers, and also time spent just
     waiting for new tasks.
 
     Each worker type will have its own overhead, so we calculate this per worker type.
+
+    If ext is given, task durations and AWS hours are read from that local extract
+    (see extract.py) instead of the database.
     """
 
     efficiency = {}
@@ -76,13 +150,16 @@ def get_efficiency_factor(year, month):
     query = (
         "SELECT worker_type, usage_hours \
             FROM worker_type_monthly_costs \
-            WHERE year = %d \
-            AND month = %d \
+            WHERE year = %s \
+            AND month = %s \
             ORDER BY usage_hours DESC"
-        % (year, month)
     )
-    cur.execute(query)
-    rows = cur.fetchall()
+    if ext is not None:
+        rows = [(row[1], row[2]) for row in ext.meta["worker_type_monthly_costs"]]
+    else:
+        rows = result_cache.cached_fetchall(
+            "cost_per_push", query, (year, month), **costs_cache_options(year, month)
+        )
     for row in rows:
         worker_type = row[0]
         hours = row[1]
@@ -90,17 +167,29 @@ def get_efficiency_factor(year, month):
         efficiency[worker_type]["aws_hours"] = hours
 
     # Get hours per worker_type reported by Taskcluster
-    query = (
-        "SELECT worker_type, SUM(duration)/1000/60/60 AS total_hours \
-             FROM tasks \
-             WHERE DATE_PART('year', created) = %d \
-             AND DATE_PART('month', created) = %d \
-             GROUP BY worker_type \
-             ORDER BY total_hours DESC"
-        % (year, month)
-    )
-    cur.execute(query)
-    rows = cur.fetchall()
+    if rollup:
+        query = (
+            "SELECT worker_type, SUM(total_duration)::bigint/1000/60/60 AS total_hours \
+                 FROM tasks_monthly_rollup \
+                 WHERE year = %s \
+                 AND month = %s \
+                 AND grain = 'detail' \
+                 GROUP BY worker_type \
+                 ORDER BY total_hours DESC"
+        )
+        params = (year, month)
+    else:
+        query = TC_HOURS_QUERY
+        params = month_range(year, month)
+    if ext is not None:
+        rows = [
+            (worker_type, total // 1000 // 60 // 60)
+            for worker_type, total in extract.duration_by(ext, "worker_type").items()
+        ]
+    else:
+        rows = result_cache.cached_fetchall(
+            "cost_per_push", query, params, **month_cache_options(year, month, rollup)
+        )
     for row in rows:
         worker_type = row[0]
         hours = row[1]
@@ -122,17 +211,33 @@ def get_efficiency_factor(year, month):
 
 
 @timeit
-def get_num_pushes(branch, year, month):
-    query = (
-        "SELECT COUNT(DISTINCT(revision)) \
-             FROM tasks \
-             WHERE project = '%s' \
-             AND DATE_PART('year', created) = %d \
-             AND DATE_PART('month', created) = %d"
-        % (branch, year, month)
+def get_num_pushes(branch, year, month, rollup=True, ext=None):
+    if ext is not None:
+        return extract.count_distinct(
+            ext, "revision", extract.equals(ext, "project", branch)
+        )
+    if rollup:
+        name = "num_pushes_rollup"
+        query = (
+            "SELECT num_revisions \
+                 FROM tasks_monthly_rollup \
+                 WHERE project = $1 \
+                 AND year = $2 \
+                 AND month = $3 \
+                 AND grain = 'project'"
+        )
+        params = (branch, year, month)
+    else:
+        name = "num_pushes"
+        query = NUM_PUSHES_QUERY
+        params = (branch,) + month_range(year, month)
+    row = result_cache.cached(
+        "cost_per_push",
+        query,
+        params,
+        lambda: db_session.fetchone_prepared(name, query, params),
+        **month_cache_options(year, month, rollup)
     )
-    cur.execute(query)
-    row = cur.fetchone()
     if row:
         return row[0]
     else:
@@ -140,15 +245,18 @@ def get_num_pushes(branch, year, month):
 
 
 @timeit
-def get_monthly_worker_type_costs(year, month):
-    query = (
-        "SELECT provisioner, worker_type, usage_hours, cost \
-             FROM worker_type_monthly_costs \
-             WHERE year = %d AND month = %d"
-        % (year, month)
-    )
-    cur.execute(query)
-    rows = cur.fetchall()
+def get_monthly_worker_type_costs(year, month, ext=None):
+    if ext is not None:
+        rows = ext.meta["worker_type_monthly_costs"]
+    else:
+        query = (
+            "SELECT provisioner, worker_type, usage_hours, cost \
+                 FROM worker_type_monthly_costs \
+                 WHERE year = %s AND month = %s"
+        )
+        rows = result_cache.cached_fetchall(
+            "cost_per_push", query, (year, month), **costs_cache_options(year, month)
+        )
     worker_type_costs = {}
     for row in rows:
         worker_type = row[1]
@@ -166,19 +274,39 @@ def get_monthly_worker_type_costs(year, month):
 
 
 @timeit
-def get_duration_per_worker_type(branch, year, month):
-    query = (
-        "SELECT worker_type, SUM(duration/(1000*60*60)) \
-             FROM tasks \
-             WHERE project = '%s' AND \
-             DATE_PART('year', created) = %d \
-             AND DATE_PART('month', created) = %d \
-             AND state = 'completed' \
-             GROUP BY project, worker_type"
-        % (branch, year, month)
-    )
-    cur.execute(query)
-    rows = cur.fetchall()
+def get_duration_per_worker_type(
+    worker_type_costs, branch, year, month, rollup=True, ext=None
+):
+    """ Adds the hours of completed tasks on branch to worker_type_costs, per worker
+        type.
+    """
+    if rollup:
+        query = (
+            "SELECT worker_type, SUM(total_duration)/(1000.0*60*60) \
+                 FROM tasks_monthly_rollup \
+                 WHERE project = %s \
+                 AND year = %s \
+                 AND month = %s \
+                 AND grain = 'detail' \
+                 AND state = 'completed' \
+                 GROUP BY project, worker_type"
+        )
+        params = (branch, year, month)
+    else:
+        query = BRANCH_HOURS_QUERY
+        params = (branch,) + month_range(year, month)
+    if ext is not None:
+        mask = extract.equals(ext, "project", branch) & extract.equals(
+            ext, "state", "completed"
+        )
+        rows = (
+            (worker_type, total / (1000.0 * 60 * 60))
+            for worker_type, total in extract.duration_by(ext, "worker_type", mask).items()
+        )
+    else:
+        rows = result_cache.cached_fetchall(
+            "cost_per_push", query, params, **month_cache_options(year, month, rollup)
+        )
     for row in rows:
         worker_type = row[0]
         branch_hours = row[1]
@@ -192,18 +320,266 @@ def get_duration_per_worker_type(branch, year, month):
             worker_type_costs[worker_type]["branch_hours"] = branch_hours
 
 
+@timeit
+def get_num_pushes_per_project(year, month, rollup=True, ext=None):
+    """ Returns a dict of project -> number of distinct revisions for the month.
+    """
+    if ext is not None:
+        return extract.count_distinct_by(ext, "project", "revision")
+    if rollup:
+        query = (
+            "SELECT project, num_revisions \
+                 FROM tasks_monthly_rollup \
+                 WHERE year = %s \
+                 AND month = %s \
+                 AND grain = 'project'"
+        )
+        params = (year, month)
+    else:
+        query = PROJECT_PUSHES_QUERY
+        params = month_range(year, month)
+    rows = result_cache.cached_fetchall(
+        "cost_per_push", query, params, **month_cache_options(year, month, rollup)
+    )
+    return {row[0]: row[1] for row in rows}
+
+
+@timeit
+def get_duration_per_project_worker_type(year, month, rollup=True, ext=None):
+    """ Like get_duration_per_worker_type(), but for every project at once. Returns
+        a dict of project -> worker_type -> hours of completed tasks.
+    """
+    if rollup:
+        query = (
+            "SELECT project, worker_type, SUM(total_duration)/(1000.0*60*60) \
+                 FROM tasks_monthly_rollup \
+                 WHERE year = %s \
+                 AND month = %s \
+                 AND grain = 'detail' \
+                 AND state = 'completed' \
+                 GROUP BY project, worker_type"
+        )
+        params = (year, month)
+    else:
+        query = PROJECT_HOURS_QUERY
+        params = month_range(year, month)
+    if ext is not None:
+        totals = extract.duration_by_pair(
+            ext, "project", "worker_type", extract.equals(ext, "state", "completed")
+        )
+        rows = [
+            (project, worker_type, total / (1000.0 * 60 * 60))
+            for (project, worker_type), total in totals.items()
+        ]
+    else:
+        rows = result_cache.cached_fetchall(
+            "cost_per_push", query, params, **month_cache_options(year, month, rollup)
+        )
+    hours = {}
+    for row in rows:
+        hours.setdefault(row[0], {})[row[1]] = row[2]
+    return hours
+
+
+def get_total_cost(worker_type_costs, branch_hours, efficiency):
+    """ Returns the AWS spend attributed to a branch, given its hours per worker type.
+        Each worker type's cost per hour is scaled by its efficiency factor.
+    """
+    total_cost = 0
+    for worker_type in branch_hours:
+        if worker_type not in worker_type_costs:
+            continue
+        if worker_type_costs[worker_type]["total_hours"] != 0:
+            efficiency_factor = 1
+            if worker_type in efficiency:
+                efficiency_factor = efficiency[worker_type]["factor"]
+            total_cost += (
+                float(worker_type_costs[worker_type]["cost"])
+                / float(worker_type_costs[worker_type]["total_hours"])
+                * float(branch_hours[worker_type])
+                * float(efficiency_factor)
+            )
+    return total_cost
+
+
+def get_leaderboard(worker_type_costs, hours_per_project, pushes_per_project, efficiency):
+    """ Returns (project, total cost, pushes, cost per push) for every project, most
+        expensive first. Cost per push is None for projects without pushes.
+    """
+    leaderboard = []
+    for project in set(hours_per_project) | set(pushes_per_project):
+        total_cost = get_total_cost(
+            worker_type_costs, hours_per_project.get(project, {}), efficiency
+        )
+        num_pushes = pushes_per_project.get(project) or 0
+        cost_per_push = total_cost / num_pushes if num_pushes else None
+        leaderboard.append((project, total_cost, num_pushes, cost_per_push))
+    leaderboard.sort(key=lambda entry: entry[1], reverse=True)
+    return leaderboard
+
+
+def print_leaderboard(leaderboard):
+    row_format = "{0:<4} {1:<30} {2:>16} {3:>10} {4:>14}"
+    print(row_format.format("#", "Project", "Total spend", "Pushes", "Cost per push"))
+    for rank, entry in enumerate(leaderboard, 1):
+        project, total_cost, num_pushes, cost_per_push = entry
+        if cost_per_push is None:
+            cost_per_push = "n/a"
+        else:
+            cost_per_push = "${:,.2f}".format(cost_per_push)
+        print(
+            row_format.format(
+                rank,
+                str(project),
+                "${:,.2f}".format(total_cost),
+                "{:,}".format(num_pushes),
+                cost_per_push,
+            )
+        )
+
+
+def get_hourly_rates(worker_type_costs, efficiency):
+    """ Returns a dict of worker_type -> $/hour, scaled by the efficiency factor, using
+        the same formula as get_total_cost().
+    """
+    rates = {}
+    for worker_type, costs in worker_type_costs.items():
+        if costs["total_hours"] == 0:
+            continue
+        efficiency_factor = 1
+        if worker_type in efficiency:
+            efficiency_factor = efficiency[worker_type]["factor"]
+        rates[worker_type] = (
+            float(costs["cost"]) / float(costs["total_hours"]) * float(efficiency_factor)
+        )
+    return rates
+
+
+def iter_revision_hours(branch, year, month, ext=None):
+    """ Yields (revision, worker_type, hours of completed tasks) for a branch, ordered
+        by revision. The rows are streamed through a server-side cursor, since a busy
+        branch has far too many of them to fetch at once.
+    """
+    if ext is not None:
+        mask = extract.equals(ext, "project", branch) & extract.equals(
+            ext, "state", "completed"
+        )
+        totals = extract.duration_by_pair(ext, "revision", "worker_type", mask)
+        for (revision, worker_type), total in sorted(
+            totals.items(), key=lambda item: str(item[0][0])
+        ):
+            yield revision, worker_type, total / (1000.0 * 60 * 60)
+        return
+    params = (branch,) + month_range(year, month)
+    with db_session.named_cursor("revision_hours") as cur:
+        cur.execute(REVISION_HOURS_QUERY, params)
+        for row in cur:
+            yield row
+
+
+@timeit
+def get_cost_per_revision(rows, rates, top=DEFAULT_TOP):
+    """ Folds (revision, worker_type, hours) rows, grouped by revision, into the cost
+        of each revision. Returns (array of costs, [(cost, revision)] for the top
+        most expensive revisions, most expensive first).
+
+        Only one float per revision and the top revisions are kept, never the rows.
+    """
+    costs = array("d")
+    most_expensive = []
+
+    def finish(revision, cost):
+        costs.append(cost)
+        if len(most_expensive) < top:
+            heapq.heappush(most_expensive, (cost, revision))
+        elif top and cost > most_expensive[0][0]:
+            heapq.heapreplace(most_expensive, (cost, revision))
+
+    current = None
+    cost = 0.0
+    started = False
+    for revision, worker_type, hours in rows:
+        if not started or revision != current:
+            if started:
+                finish(current, cost)
+            current = revision
+            cost = 0.0
+            started = True
+        cost += rates.get(worker_type, 0.0) * float(hours or 0)
+    if started:
+        finish(current, cost)
+    return costs, sorted(most_expensive, reverse=True)
+
+
+def percentile(sorted_values, p):
+    """ Nearest-rank percentile of an already sorted sequence.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-p * len(sorted_values) // 100))
+    return sorted_values[rank - 1]
+
+
+def print_revision_costs(branch, costs, most_expensive):
+    print("Cost per push for %s over %d pushes:" % (branch, len(costs)))
+    if not costs:
+        return
+    sorted_costs = sorted(costs)
+    print("  mean: %s" % "${:,.2f}".format(sum(sorted_costs) / len(sorted_costs)))
+    for p in PERCENTILES:
+        print("  p%d:  %s" % (p, "${:,.2f}".format(percentile(sorted_costs, p))))
+    print("  max:  %s" % "${:,.2f}".format(sorted_costs[-1]))
+    print("")
+    print("Most expensive pushes:")
+    for rank, (cost, revision) in enumerate(most_expensive, 1):
+        print("{0:<4} {1:<40} {2:>14}".format(rank, str(revision), "${:,.2f}".format(cost)))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--branch",
         help="Branch to query, e.g. mozilla-central, try, ...",
-        required=True,
         type=str,
     )
+    parser.add_argument(
+        "--all-branches",
+        dest="all_branches",
+        help="Rank every project by total spend instead of reporting one --branch",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--per-revision",
+        dest="per_revision",
+        help="Report the distribution of cost across the branch's individual pushes",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--top",
+        help="Number of most expensive pushes listed by --per-revision (default: %d)"
+        % DEFAULT_TOP,
+        type=int,
+        default=DEFAULT_TOP,
+    )
     parser.add_argument(
         "--month", help="Month to process, format: YYYY-MM", required=True, type=str
     )
+    parser.add_argument(
+        "--raw",
+        help="Aggregate tasks directly instead of reading tasks_monthly_rollup",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--extract",
+        help="Read tasks and costs from the local extract written by extract.py",
+        action="store_true",
+    )
+    result_cache.add_cache_arguments(parser)
+    profiling.add_profiling_arguments(parser)
+    plan_capture.add_explain_arguments(parser)
     args = parser.parse_args()
+    profiling.configure_from_args(args)
+    plan_capture.configure_from_args(args)
 
     branch = args.branch
     year, month = args.month.split("-", 2)
@@ -212,73 +588,66 @@ if __name__ == "__main__":
     if not year or not month or month < 1 or month > 12:
         print("ERROR: unable to parse month")
         sys.exit(1)
-
-    # The main db query can be expensive, so try to use
-    # cached data if we've run with these params before.
-    cost_json_file = "logs/cost-%s-%d-%02d.json" % (branch, year, month)
-    data = {}
-    try:
-        with open(cost_json_file) as f:
-            data = json.load(f)
-    except IOError:
-        # The file may not exist, but this isn't fatal.
-        pass
-
-    efficiency_json_file = "logs/efficiency-%d-%02d.json" % (year, month)
-    efficiency = {}
-    try:
-        with open(efficiency_json_file) as f:
-            efficiency = json.load(f)
-    except IOError:
-        # The file may not exist, but this isn't fatal.
-        pass
-
-    conn = None
-    cur = None
-    if data and "num_pushes" in data and "worker_type_costs" in data:
-        num_pushes = data["num_pushes"]
-        worker_type_costs = data["worker_type_costs"]
+    if bool(branch) == args.all_branches:
+        print("ERROR: specify exactly one of --branch or --all-branches")
+        sys.exit(2)
+    if args.per_revision and args.all_branches:
+        print("ERROR: --per-revision needs a single --branch")
+        sys.exit(3)
+
+    result_cache.configure_from_args(args)
+
+    # The main db queries can be expensive, so their results are cached
+    # (see result_cache.py) and reused if we've run with these params before.
+    if args.extract:
+        ext = extract.load(year, month)
+        rollup = False
     else:
-        # Fetch our cost data from the db instead,
-        conn, cur = open_connection()
-        num_pushes = get_num_pushes(branch, year, month)
-        worker_type_costs = get_monthly_worker_type_costs(year, month)
-        get_duration_per_worker_type(branch, year, month)
-
-    if not efficiency:
-        if not conn:
-            conn, cur = open_connection()
-        efficiency = get_efficiency_factor(year, month)
-
-    close_connection(conn, cur)
-
-    total_cost = 0
-    for worker_type in worker_type_costs:
-        if worker_type_costs[worker_type]["total_hours"] != 0:
-            efficiency_factor = 1
-            if worker_type in efficiency:
-                efficiency_factor = efficiency[worker_type]["factor"]
-            total_cost += (
-                float(worker_type_costs[worker_type]["cost"])
-                / float(worker_type_costs[worker_type]["total_hours"])
-                * float(worker_type_costs[worker_type]["branch_hours"])
-                * float(efficiency_factor)
+        ext = None
+        rollup = use_rollup(year, month, args.raw)
+
+    if args.all_branches:
+        # The monthly costs and efficiency factors are shared by every project, so
+        # they're only computed once.
+        worker_type_costs = get_monthly_worker_type_costs(year, month, ext)
+        efficiency = get_efficiency_factor(year, month, rollup, ext)
+        hours_per_project = get_duration_per_project_worker_type(year, month, rollup, ext)
+        pushes_per_project = get_num_pushes_per_project(year, month, rollup, ext)
+        db_session.close_pool()
+        print_leaderboard(
+            get_leaderboard(
+                worker_type_costs, hours_per_project, pushes_per_project, efficiency
             )
+        )
+        sys.exit(0)
+
+    if args.per_revision:
+        # tasks_monthly_rollup has no per-revision grain, so this always reads tasks
+        # (or the extract) directly. Only the cost tables come from the rollup.
+        worker_type_costs = get_monthly_worker_type_costs(year, month, ext)
+        efficiency = get_efficiency_factor(year, month, rollup, ext)
+        rates = get_hourly_rates(worker_type_costs, efficiency)
+        costs, most_expensive = get_cost_per_revision(
+            iter_revision_hours(branch, year, month, ext), rates, args.top
+        )
+        db_session.close_pool()
+        print_revision_costs(branch, costs, most_expensive)
+        sys.exit(0)
+
+    num_pushes = get_num_pushes(branch, year, month, rollup, ext)
+    worker_type_costs = get_monthly_worker_type_costs(year, month, ext)
+    get_duration_per_worker_type(worker_type_costs, branch, year, month, rollup, ext)
+    efficiency = get_efficiency_factor(year, month, rollup, ext)
+
+    db_session.close_pool()
+
+    branch_hours = {
+        worker_type: costs["branch_hours"]
+        for worker_type, costs in worker_type_costs.items()
+    }
+    total_cost = get_total_cost(worker_type_costs, branch_hours, efficiency)
     cost_per_push = total_cost / num_pushes
 
     print("Total spend for %s: %s" % (branch, "${:,.2f}".format(total_cost)))
     print("Total # of pushes:  %d" % num_pushes)
     print("Cost per push:      %s" % "${:,.2f}".format(cost_per_push))
-
-    # Cache our data to a json file
-    if not os.path.exists(cost_json_file):
-        data = {}
-        data["num_pushes"] = num_pushes
-        data["efficiency"] = efficiency
-        data["worker_type_costs"] = worker_type_costs
-        with open(cost_json_file, "w") as f:
-            json.dump(data, f)
-
-    if not os.path.exists(efficiency_json_file):
-        with open(efficiency_json_file, "w") as f:
-            json.dump(efficiency, f)
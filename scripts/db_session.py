@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+""" Shared, pooled database sessions for the analysis scripts.
+
+    Connections are created once per process from database.ini (see db_config)
+    and handed out from a pool, so helpers can open a cursor whenever they need
+    one instead of relying on a module-global `cur`:
+
+        with db_session.cursor() as cur:
+            cur.execute(query, params)
+
+    named_cursor() gives a server-side cursor that streams large result sets in
+    batches of `itersize` rows rather than loading them all into memory, and
+    execute_prepared() PREPAREs a statement once per connection and EXECUTEs it on
+    every later call.
+
+    While profiling is enabled (see profiling.py), cursors record a span for every
+    execute and fetch, with the rows and approximate bytes fetched. While plan
+    capture is enabled (see plan_capture.py), they also EXPLAIN ANALYZE the first
+    execution of every distinct query.
+"""
+
+import plan_capture
+import profiling
+import psycopg2
+import sys
+import threading
+
+from contextlib import contextmanager
+from db_config import db_config
+from psycopg2 import extensions, extras, pool
+
+DEFAULT_MAXCONN = 4
+DEFAULT_ITERSIZE = 10000
+# How much of each query's text is kept in its profiling spans.
+QUERY_TEXT_LENGTH = 200
+
+psycopg2.extensions.set_wait_callback(extras.wait_select)
+
+_pool = None
+_pool_lock = threading.Lock()
+_cursor_counter = 0
+
+
+class SessionConnection(extensions.connection):
+    """ A connection that remembers which statements have been PREPAREd on it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SessionConnection, self).__init__(*args, **kwargs)
+        self.prepared = {}
+
+
+def _query_text(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    return " ".join(str(query).split())[:QUERY_TEXT_LENGTH]
+
+
+class TracedCursor(extensions.cursor):
+    """ A cursor that records a profiling span for every execute, copy and fetch,
+        and captures query plans.
+    """
+
+    def execute(self, query, params=None):
+        if plan_capture.enabled():
+            plan_capture.capture(self, query, params)
+        with profiling.span(
+            "db.execute", profiling.DB, query=_query_text(query)
+        ) as span:
+            result = super(TracedCursor, self).execute(query, params)
+            span.set(rowcount=self.rowcount)
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        with profiling.span("db.copy", profiling.DB, query=_query_text(sql)) as span:
+            result = super(TracedCursor, self).copy_expert(sql, file, size)
+            span.set(rowcount=self.rowcount)
+        return result
+
+    def _fetched(self, span, rows):
+        span.set(rows=len(rows), bytes=profiling.approximate_size(rows))
+        return rows
+
+    def fetchone(self):
+        with profiling.span("db.fetch", profiling.DB, cursor=self.name) as span:
+            row = super(TracedCursor, self).fetchone()
+            self._fetched(span, [] if row is None else [row])
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        with profiling.span("db.fetch", profiling.DB, cursor=self.name) as span:
+            return self._fetched(span, super(TracedCursor, self).fetchmany(size))
+
+    def fetchall(self):
+        with profiling.span("db.fetch", profiling.DB, cursor=self.name) as span:
+            return self._fetched(span, super(TracedCursor, self).fetchall())
+
+    def __iter__(self):
+        # A batch per round trip, so each fetch gets its own span.
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+
+
+def _cursor_factory():
+    if profiling.enabled() or plan_capture.enabled():
+        return TracedCursor
+    return extensions.cursor
+
+
+def init_pool(maxconn=DEFAULT_MAXCONN, filename="database.ini", section="postgres"):
+    """ Creates the process-wide connection pool, if it doesn't exist yet. Only the
+        first call's arguments are used.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            db_params = db_config(filename, section)
+            try:
+                _pool = pool.ThreadedConnectionPool(
+                    1, maxconn, connection_factory=SessionConnection, **db_params
+                )
+            except psycopg2.Error as error:
+                print("I am unable to connect to the database: %s" % error)
+                sys.exit(1)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+@contextmanager
+def connection():
+    """ Checks a connection out of the pool for the duration of the block. The
+        transaction is committed on success and rolled back on error.
+    """
+    db_pool = init_pool()
+    conn = db_pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        forget_prepared(conn)
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+
+@contextmanager
+def cursor():
+    with connection() as conn:
+        cur = conn.cursor(cursor_factory=_cursor_factory())
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+
+def _next_cursor_name(prefix):
+    global _cursor_counter
+    with _pool_lock:
+        _cursor_counter += 1
+        return "%s_%d" % (prefix, _cursor_counter)
+
+
+@contextmanager
+def named_cursor(prefix="stream", itersize=DEFAULT_ITERSIZE):
+    """ A server-side cursor. Iterating over it fetches `itersize` rows per round
+        trip, so memory use doesn't grow with the size of the result set.
+    """
+    with connection() as conn:
+        cur = conn.cursor(
+            name=_next_cursor_name(prefix), cursor_factory=_cursor_factory()
+        )
+        cur.itersize = itersize
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+
+def execute_prepared(cur, name, query, params=()):
+    """ Executes `query` as the prepared statement `name`. The query uses $1, $2, ...
+        placeholders; it is PREPAREd the first time it is seen on a connection and
+        reused for every later call on that connection.
+    """
+    conn = cur.connection
+    if conn.prepared.get(name) != query:
+        if name in conn.prepared:
+            cur.execute("DEALLOCATE %s" % name)
+        cur.execute("PREPARE %s AS %s" % (name, query))
+        conn.prepared[name] = query
+    if params:
+        placeholders = ", ".join(["%s"] * len(params))
+        cur.execute("EXECUTE %s (%s)" % (name, placeholders), params)
+    else:
+        cur.execute("EXECUTE %s" % name)
+
+
+def forget_prepared(conn):
+    if conn.prepared and not conn.closed:
+        try:
+            conn.cursor().execute("DEALLOCATE ALL")
+            conn.commit()
+        except psycopg2.Error:
+            pass
+    conn.prepared = {}
+
+
+def fetchall(query, params=None):
+    with cursor() as cur:
+        cur.execute(query, params)
+        return cur.fetchall()
+
+
+def fetchone(query, params=None):
+    with cursor() as cur:
+        cur.execute(query, params)
+        return cur.fetchone()
+
+
+def fetchall_prepared(name, query, params=()):
+    with cursor() as cur:
+        execute_prepared(cur, name, query, params)
+        return cur.fetchall()
+
+
+def fetchone_prepared(name, query, params=()):
+    with cursor() as cur:
+        execute_prepared(cur, name, query, params)
+        return cur.fetchone()
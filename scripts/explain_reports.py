@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+""" EXPLAINs the queries the monthly reports run against tasks, for one month, and
+    checks that they read it the way the indexes in postgres/create_table.sql
+    intend:
+
+    partition   whole-month aggregates; scanning the month's partition is expected,
+                but nothing beyond it
+    index       range lookups; must use an index rather than a sequential scan
+    index-only  per-project and per-revision lookups; must be answered from a
+                covering index without visiting the table
+
+    With --analyze the queries are actually run (and rolled back), and index-only
+    scans that still had to fetch rows from the table are reported too; those go
+    away once the table has been vacuumed.
+
+    Exits with 1 if any query doesn't match its expectation.
+"""
+
+import argparse
+import sys
+
+import concurrent_tasks
+import cost_per_push
+import db_session
+import monthly_tc_stats
+import platform_costs
+import query_plans
+import refresh_rollup
+
+from concurrency import MAX_TASK_LIFETIME
+from datetime import datetime, timedelta
+from shared import month_range
+
+PARTITION = "partition"
+INDEX = "index"
+INDEX_ONLY = "index-only"
+
+SAMPLE_REVISIONS_QUERY = (
+    "SELECT ARRAY( \
+        SELECT DISTINCT revision \
+        FROM tasks \
+        WHERE project = %s \
+        AND created >= %s \
+        AND created < %s \
+        AND revision IS NOT NULL \
+        LIMIT 20)"
+)
+
+
+def report_queries(year, month, branch, revisions):
+    """ Returns (name, query, params, expectation) for every report query.
+    """
+    month_start, month_end = month_range(year, month)
+    day_start = month_start + timedelta(days=14)
+    return [
+        (
+            "cost_per_push efficiency",
+            cost_per_push.TC_HOURS_QUERY,
+            (month_start, month_end),
+            PARTITION,
+        ),
+        (
+            "cost_per_push pushes",
+            cost_per_push.NUM_PUSHES_QUERY,
+            (branch, month_start, month_end),
+            INDEX_ONLY,
+        ),
+        (
+            "cost_per_push branch hours",
+            cost_per_push.BRANCH_HOURS_QUERY,
+            (branch, month_start, month_end),
+            INDEX_ONLY,
+        ),
+        (
+            "cost_per_push --all-branches pushes",
+            cost_per_push.PROJECT_PUSHES_QUERY,
+            (month_start, month_end),
+            PARTITION,
+        ),
+        (
+            "cost_per_push --all-branches hours",
+            cost_per_push.PROJECT_HOURS_QUERY,
+            (month_start, month_end),
+            PARTITION,
+        ),
+        (
+            "cost_per_push --per-revision",
+            cost_per_push.REVISION_HOURS_QUERY,
+            (branch, month_start, month_end),
+            INDEX_ONLY,
+        ),
+        (
+            "monthly_tc_stats end to end",
+            monthly_tc_stats.END_TO_END_QUERY,
+            (revisions,),
+            INDEX_ONLY,
+        ),
+        (
+            "monthly_tc_stats totals",
+            monthly_tc_stats.MONTHLY_TOTALS_QUERY,
+            (month_start, month_end),
+            PARTITION,
+        ),
+        (
+            "platform_costs durations",
+            platform_costs.WORKER_TYPE_DURATIONS_QUERY,
+            (month_start, month_end, platform_costs.PROVISIONERS),
+            PARTITION,
+        ),
+        (
+            "concurrent_tasks day",
+            concurrent_tasks.DAY_INTERVALS_QUERY,
+            {
+                "created_after": day_start - MAX_TASK_LIFETIME,
+                "day_start": day_start,
+                "day_end": day_start + timedelta(days=1),
+            },
+            INDEX,
+        ),
+        (
+            "refresh_rollup",
+            refresh_rollup.ROLLUP_QUERY,
+            {"year": year, "month": month, "start": month_start, "end": month_end},
+            PARTITION,
+        ),
+    ]
+
+
+def check(scans, expectation, month_partition):
+    """ Returns a list of problems with how the tasks scans in a plan match
+        expectation.
+    """
+    problems = []
+    for scan in scans:
+        relation = scan["relation"]
+        if not query_plans.is_tasks(relation):
+            continue
+        where = relation
+        if scan["index"]:
+            where += " using " + scan["index"]
+        if expectation == PARTITION:
+            if scan["node"] == query_plans.SEQ_SCAN and relation != month_partition:
+                problems.append("sequential scan of %s outside the month" % relation)
+        elif scan["node"] == query_plans.SEQ_SCAN:
+            problems.append("sequential scan of %s" % relation)
+        elif expectation == INDEX_ONLY and query_plans.is_heap_scan(scan):
+            if scan["heap_fetches"]:
+                problems.append(
+                    "%d heap fetches in %s (needs VACUUM)"
+                    % (scan["heap_fetches"], where)
+                )
+            else:
+                problems.append("%s reads the table: %s" % (scan["node"], where))
+    return problems
+
+
+def describe(scan):
+    description = "%s on %s" % (scan["node"], scan["relation"])
+    if scan["index"]:
+        description += " using %s" % scan["index"]
+    if scan["actual_rows"] is not None:
+        description += " (%s rows" % "{:,}".format(scan["actual_rows"])
+        if scan["heap_fetches"] is not None:
+            description += ", %s heap fetches" % "{:,}".format(scan["heap_fetches"])
+        description += ")"
+    elif scan["plan_rows"] is not None:
+        description += " (~%s rows)" % "{:,}".format(scan["plan_rows"])
+    return description
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--month",
+        help="Month to explain, format: YYYY-MM (default: last month)",
+        type=str,
+    )
+    parser.add_argument(
+        "--branch",
+        help="Branch for the per-project queries (default: %(default)s)",
+        default="mozilla-central",
+    )
+    parser.add_argument(
+        "--analyze",
+        help="Run the queries with EXPLAIN ANALYZE (in a rolled back transaction)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-v", "--verbose", help="List every table scan", action="store_true"
+    )
+    args = parser.parse_args()
+
+    if args.month:
+        year, month = map(int, args.month.split("-", 1))
+    else:
+        last_month = datetime.now().replace(day=1) - timedelta(days=1)
+        year, month = last_month.year, last_month.month
+    month_partition = "tasks_%04d%02d" % (year, month)
+
+    db_session.init_pool()
+    month_start, month_end = month_range(year, month)
+    revisions = db_session.fetchone(
+        SAMPLE_REVISIONS_QUERY, (args.branch, month_start, month_end)
+    )[0]
+
+    queries = report_queries(year, month, args.branch, revisions)
+    failures = 0
+    with db_session.connection() as conn:
+        cur = conn.cursor()
+        for name, query, params, expectation in queries:
+            plan = query_plans.explain(
+                cur, query, params, analyze=args.analyze, buffers=args.analyze
+            )
+            # EXPLAIN ANALYZE really runs the query, and refresh_rollup writes.
+            conn.rollback()
+            scans = query_plans.scans(plan)
+            problems = check(scans, expectation, month_partition)
+            status = "FAIL" if problems else "ok"
+            print("%-4s %-40s [%s]" % (status, name, expectation))
+            if args.verbose or problems:
+                for scan in scans:
+                    print("       %s" % describe(scan))
+            for problem in problems:
+                print("       ! %s" % problem)
+            if problems:
+                failures += 1
+        cur.close()
+    db_session.close_pool()
+
+    print("%d of %d report queries need attention" % (failures, len(queries)))
+    sys.exit(1 if failures else 0)
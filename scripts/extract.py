@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+""" extract.py
+
+    Exports a month of the tasks table to a local columnar extract, so the
+    concurrency, cost and monthly stats scripts can run with --extract instead of
+    querying Postgres.
+
+    An extract is a directory, extracts/tasks_YYYY-MM/, containing:
+      * one <column>.npy file per column, loaded memory-mapped (zero-copy)
+      * timestamps as int64 epoch microseconds, NULL stored as NULL_VALUE
+      * integer columns as int64, NULL stored as NULL_VALUE
+      * string columns dictionary-encoded as int32 codes into the column's
+        dictionary in meta.json, NULL stored as -1
+      * meta.json, which also holds the month's worker_type_monthly_costs rows
+        and the worker_instance_mapping table
+
+    Rows are sorted by created.
+"""
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+import db_session
+import plan_capture
+import profiling
+
+from array import array
+from concurrency import MAX_TASK_LIFETIME, to_epoch
+from datetime import datetime, timedelta
+from shared import log_ts, month_range, timeit
+
+EXTRACT_DIR = "extracts"
+
+# Bump this whenever the layout of an extract changes. Older extracts have to be
+# re-exported.
+EXTRACT_VERSION = 1
+
+NULL_VALUE = np.iinfo(np.int64).min
+NULL_CODE = -1
+
+TIMESTAMP_COLUMNS = ["created", "scheduled", "started", "resolved"]
+INTEGER_COLUMNS = ["run_id", "duration"]
+STRING_COLUMNS = [
+    "state",
+    "project",
+    "revision",
+    "provisioner",
+    "worker_type",
+    "worker_id",
+    "platform",
+]
+
+# COPY writes NULL as \N. csv.reader strips quotes, so it can't tell that apart
+# from a string that is literally "\N". Integers never look like it, and string
+# values are exported with STRING_PREFIX in front, so they never do either.
+COPY_NULL = "\\N"
+STRING_PREFIX = "v"
+
+MICROSECONDS = 1000000
+
+
+def extract_path(year, month, directory=EXTRACT_DIR):
+    return os.path.join(directory, "tasks_%d-%02d" % (year, month))
+
+
+def export_query(year, month):
+    columns = [
+        "(EXTRACT(EPOCH FROM %s) * %d)::bigint" % (column, MICROSECONDS)
+        for column in TIMESTAMP_COLUMNS
+    ]
+    columns += INTEGER_COLUMNS
+    # NULL || anything is NULL, so NULLs still come out as COPY_NULL.
+    columns += ["'%s' || %s" % (STRING_PREFIX, column) for column in STRING_COLUMNS]
+    return (
+        "SELECT %s \
+            FROM tasks \
+            WHERE created >= %%s \
+            AND created < %%s \
+            ORDER BY created"
+        % ", ".join(columns)
+    )
+
+
+def _parse_int(value):
+    if value == COPY_NULL:
+        return NULL_VALUE
+    return int(value)
+
+
+def extract_meta(
+    year, month, rows, dictionaries, worker_type_costs, worker_instance_mapping
+):
+    """ Returns the meta.json of an extract. dictionaries maps each string column to
+        the list of its values, indexed by code.
+    """
+    return {
+        "version": EXTRACT_VERSION,
+        "year": year,
+        "month": month,
+        "rows": rows,
+        "exported": log_ts(),
+        "timestamp_columns": TIMESTAMP_COLUMNS,
+        "integer_columns": INTEGER_COLUMNS,
+        "string_columns": STRING_COLUMNS,
+        "dictionaries": dictionaries,
+        "worker_type_monthly_costs": worker_type_costs,
+        "worker_instance_mapping": worker_instance_mapping,
+    }
+
+
+def write_extract(path, meta, write_columns):
+    """ Writes an extract to path. write_columns(directory) saves the column files
+        into a temporary directory next to path, which then replaces any existing
+        extract along with meta.json, so readers never see a partially written one.
+    """
+    parent = os.path.dirname(path)
+    if parent and not os.path.exists(parent):
+        os.makedirs(parent)
+    tmpdir = tempfile.mkdtemp(dir=parent or ".", prefix=".tmp-")
+    try:
+        write_columns(tmpdir)
+        with open(os.path.join(tmpdir, "meta.json"), "w") as outfile:
+            json.dump(meta, outfile)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(tmpdir, path)
+    except BaseException:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+
+@timeit
+def export_month(year, month):
+    """ Streams a month of tasks out of Postgres with COPY and writes it as an
+        extract. Returns the number of rows exported.
+    """
+    if not os.path.exists(EXTRACT_DIR):
+        os.makedirs(EXTRACT_DIR)
+    integer_columns = TIMESTAMP_COLUMNS + INTEGER_COLUMNS
+    integers = {column: array("q") for column in integer_columns}
+    codes = {column: array("i") for column in STRING_COLUMNS}
+    dictionaries = {column: {} for column in STRING_COLUMNS}
+
+    with db_session.cursor() as cur:
+        copy_query = cur.mogrify(export_query(year, month), month_range(year, month))
+        with tempfile.TemporaryFile(mode="w+", dir=EXTRACT_DIR) as copy_file:
+            cur.copy_expert(
+                "COPY (%s) TO STDOUT WITH (FORMAT csv, NULL '%s')"
+                % (copy_query.decode("utf-8"), COPY_NULL),
+                copy_file,
+            )
+            copy_file.seek(0)
+            for row in csv.reader(copy_file):
+                for i, column in enumerate(integer_columns):
+                    integers[column].append(_parse_int(row[i]))
+                for i, column in enumerate(STRING_COLUMNS, len(integer_columns)):
+                    value = row[i]
+                    if value == COPY_NULL:
+                        codes[column].append(NULL_CODE)
+                        continue
+                    value = value[len(STRING_PREFIX):]
+                    dictionary = dictionaries[column]
+                    if value not in dictionary:
+                        dictionary[value] = len(dictionary)
+                    codes[column].append(dictionary[value])
+        cur.execute(
+            "SELECT provisioner, worker_type, usage_hours, cost \
+                FROM worker_type_monthly_costs \
+                WHERE year = %s AND month = %s",
+            (year, month),
+        )
+        worker_type_costs = [
+            [row[0], row[1], float(row[2]), float(row[3])] for row in cur.fetchall()
+        ]
+        cur.execute("SELECT worker_type, instance_type FROM worker_instance_mapping")
+        worker_instance_mapping = dict(cur.fetchall())
+
+    def write_columns(directory):
+        for column in integer_columns:
+            np.save(
+                os.path.join(directory, column + ".npy"),
+                np.frombuffer(integers[column], dtype=np.int64),
+            )
+        for column in STRING_COLUMNS:
+            np.save(
+                os.path.join(directory, column + ".npy"),
+                np.frombuffer(codes[column], dtype=np.int32),
+            )
+
+    meta = extract_meta(
+        year,
+        month,
+        len(integers["created"]),
+        {
+            column: sorted(dictionary, key=dictionary.get)
+            for column, dictionary in dictionaries.items()
+        },
+        worker_type_costs,
+        worker_instance_mapping,
+    )
+    write_extract(extract_path(year, month), meta, write_columns)
+    return meta["rows"]
+
+
+class Extract(object):
+    """ A month of tasks loaded from an extract. Columns are memory-mapped on first
+        use, so only the columns a computation touches are ever read from disk.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as infile:
+            self.meta = json.load(infile)
+        if self.meta.get("version") != EXTRACT_VERSION:
+            raise ValueError(
+                "%s was written by an older version of extract.py, re-export it" % path
+            )
+        self.dictionaries = self.meta["dictionaries"]
+        self._columns = {}
+        self._lookups = {}
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def column(self, name):
+        if name not in self._columns:
+            self._columns[name] = np.load(
+                os.path.join(self.path, name + ".npy"), mmap_mode="r"
+            )
+        return self._columns[name]
+
+    def code(self, column, value):
+        """ Returns the dictionary code for value, or NULL_CODE if it doesn't occur.
+        """
+        if column not in self._lookups:
+            self._lookups[column] = {
+                v: i for i, v in enumerate(self.dictionaries[column])
+            }
+        return self._lookups[column].get(value, NULL_CODE)
+
+    def codes(self, column, values):
+        codes = [self.code(column, value) for value in values]
+        return np.array([c for c in codes if c != NULL_CODE], dtype=np.int32)
+
+    def decode(self, column, codes):
+        """ Returns an object array of the strings for codes, with None for NULL.
+        """
+        labels = np.array(self.dictionaries[column] + [None], dtype=object)
+        codes = np.asarray(codes)
+        # NULL_CODE (-1) indexes the trailing None.
+        return labels[codes]
+
+    def created_slice(self, start_ts, end_ts):
+        """ Returns the slice of rows created in [start_ts, end_ts).
+        """
+        created = self.column("created")
+        first, last = np.searchsorted(
+            created,
+            [to_epoch(start_ts) * MICROSECONDS, to_epoch(end_ts) * MICROSECONDS],
+        )
+        return slice(first, last)
+
+
+def months_between(start_ts, end_ts):
+    months = []
+    year, month = start_ts.year, start_ts.month
+    while (year, month) <= (end_ts.year, end_ts.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def load(year, month):
+    path = extract_path(year, month)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        print(
+            "No extract for %d-%02d, run extract.py --month %d-%02d first"
+            % (year, month, year, month)
+        )
+        sys.exit(1)
+    return Extract(path)
+
+
+def load_range(start_ts, end_ts, lookback=MAX_TASK_LIFETIME):
+    """ Returns the extracts for every month between start_ts and end_ts, plus the
+        months within lookback before start_ts if they have been extracted. Tasks
+        created in a missing lookback month are left out of the results.
+    """
+    extracts = []
+    required = months_between(start_ts, end_ts)
+    for year, month in months_between(start_ts - lookback, end_ts):
+        if (year, month) in required:
+            extracts.append(load(year, month))
+        elif os.path.exists(os.path.join(extract_path(year, month), "meta.json")):
+            extracts.append(Extract(extract_path(year, month)))
+        else:
+            print(
+                "No extract for %d-%02d, tasks created then that were still running "
+                "after %s aren't counted" % (year, month, start_ts)
+            )
+    return extracts
+
+
+def _seconds_up(us):
+    return -(-us // MICROSECONDS)
+
+
+def _seconds_down(us):
+    return us // MICROSECONDS
+
+
+def task_intervals(extracts, start_ts, end_ts, group=None):
+    """ Returns (started, resolved, group) arrays for every task that overlaps
+        [start_ts, end_ts], like the "started <= end AND resolved >= start" queries.
+        started is rounded up and resolved down to whole epoch seconds (see
+        concurrency.INTERVAL_COLUMNS). group is the decoded values of that string
+        column, or None.
+    """
+    start_epoch = to_epoch(start_ts)
+    end_epoch = to_epoch(end_ts)
+    all_starts, all_ends, all_groups = [], [], []
+    for ext in extracts:
+        rows = ext.created_slice(start_ts - MAX_TASK_LIFETIME, end_ts + timedelta(seconds=1))
+        started = ext.column("started")[rows]
+        resolved = ext.column("resolved")[rows]
+        not_null = (started != NULL_VALUE) & (resolved != NULL_VALUE)
+        starts = _seconds_up(started[not_null])
+        ends = _seconds_down(resolved[not_null])
+        keep = (starts <= end_epoch) & (ends >= start_epoch)
+        all_starts.append(starts[keep])
+        all_ends.append(ends[keep])
+        if group is not None:
+            codes = ext.column(group)[rows][not_null][keep]
+            all_groups.append(ext.decode(group, codes))
+    starts = np.concatenate(all_starts) if all_starts else np.zeros(0, dtype=np.int64)
+    ends = np.concatenate(all_ends) if all_ends else np.zeros(0, dtype=np.int64)
+    groups = None
+    if group is not None:
+        groups = np.concatenate(all_groups) if all_groups else np.zeros(0, dtype=object)
+    return starts, ends, groups
+
+
+def duration_by(ext, column, mask=None):
+    """ Returns a dict of value -> SUM(duration) in msecs, grouped on a string
+        column, skipping NULL durations like SQL's SUM. mask optionally selects rows.
+    """
+    duration = ext.column("duration")
+    keep = duration != NULL_VALUE
+    if mask is not None:
+        keep &= mask
+    codes = ext.column(column)[keep]
+    # Shift codes up by one so NULL_CODE gets its own bin, like GROUP BY does.
+    sums = np.bincount(
+        codes + 1,
+        weights=duration[keep],
+        minlength=len(ext.dictionaries[column]) + 1,
+    )
+    counts = np.bincount(codes + 1, minlength=len(ext.dictionaries[column]) + 1)
+    labels = [None] + ext.dictionaries[column]
+    return {labels[i]: int(sums[i]) for i in np.flatnonzero(counts)}
+
+
+def duration_by_pair(ext, first, second, mask=None):
+    """ Like duration_by(), but grouped on two string columns. Returns a dict of
+        (first value, second value) -> SUM(duration) in msecs.
+    """
+    duration = ext.column("duration")
+    keep = duration != NULL_VALUE
+    if mask is not None:
+        keep &= mask
+    width = len(ext.dictionaries[second]) + 1
+    keys = (ext.column(first)[keep].astype(np.int64) + 1) * width + (
+        ext.column(second)[keep] + 1
+    )
+    groups, inverse = np.unique(keys, return_inverse=True)
+    sums = np.bincount(inverse, weights=duration[keep], minlength=len(groups))
+    first_labels = [None] + ext.dictionaries[first]
+    second_labels = [None] + ext.dictionaries[second]
+    return {
+        (first_labels[key // width], second_labels[key % width]): int(total)
+        for key, total in zip(groups.tolist(), sums)
+    }
+
+
+def count_distinct_by(ext, column, distinct, mask=None):
+    """ Returns a dict of value -> COUNT(DISTINCT distinct), grouped on column.
+    """
+    group_codes = ext.column(column)
+    distinct_codes = ext.column(distinct)
+    if mask is not None:
+        group_codes = group_codes[mask]
+        distinct_codes = distinct_codes[mask]
+    keep = distinct_codes != NULL_CODE
+    width = len(ext.dictionaries[distinct]) + 1
+    pairs = np.unique(
+        (group_codes[keep].astype(np.int64) + 1) * width + distinct_codes[keep]
+    )
+    counts = np.bincount(pairs // width, minlength=len(ext.dictionaries[column]) + 1)
+    labels = [None] + ext.dictionaries[column]
+    return {labels[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+
+
+def equals(ext, column, value):
+    """ Returns a row mask for column = value.
+    """
+    code = ext.code(column, value)
+    if code == NULL_CODE:
+        return np.zeros(len(ext), dtype=bool)
+    return ext.column(column) == code
+
+
+def count_distinct(ext, column, mask=None):
+    codes = ext.column(column)
+    if mask is not None:
+        codes = codes[mask]
+    codes = np.unique(codes)
+    return int(np.count_nonzero(codes != NULL_CODE))
+
+
+def monthly_totals(ext):
+    """ Returns (number of tasks, compute years, unique workers), the same values
+        monthly_tc_stats.monthly_rollup() reads from the database.
+    """
+    duration = ext.column("duration")
+    total_duration = int(duration[duration != NULL_VALUE].sum())
+    return (
+        len(ext),
+        total_duration // 1000 // 60 // 60 // 24 // 365,
+        count_distinct(ext, "worker_id"),
+    )
+
+
+def end_to_end_seconds(extracts, revisions):
+    """ Returns the end-to-end time in seconds of each revision: the time from its
+        first task starting to its last task resolving, counting only tasks created
+        within an hour of the revision's first task and not resolved as exception.
+        See monthly_tc_stats.end_to_end().
+    """
+    created, started, resolved, revision, excluded = [], [], [], [], []
+    for ext in extracts:
+        rows = np.isin(ext.column("revision"), ext.codes("revision", revisions))
+        created.append(ext.column("created")[rows])
+        started.append(ext.column("started")[rows])
+        resolved.append(ext.column("resolved")[rows])
+        revision.append(ext.decode("revision", ext.column("revision")[rows]))
+        excluded.append(equals(ext, "state", "exception")[rows])
+    if not created:
+        return []
+    created = np.concatenate(created)
+    started = np.concatenate(started)
+    resolved = np.concatenate(resolved)
+    excluded = np.concatenate(excluded)
+    labels, revision = np.unique(np.concatenate(revision), return_inverse=True)
+
+    first_created = np.full(len(labels), np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first_created, revision, created)
+    keep = ~excluded & (created < first_created[revision] + 60 * 60 * MICROSECONDS)
+
+    # MIN()/MAX() ignore NULLs, so mask them with values that never win.
+    first_started = np.full(len(labels), np.iinfo(np.int64).max, dtype=np.int64)
+    rows = keep & (started != NULL_VALUE)
+    np.minimum.at(first_started, revision[rows], started[rows])
+    last_resolved = np.full(len(labels), NULL_VALUE, dtype=np.int64)
+    rows = keep & (resolved != NULL_VALUE)
+    np.maximum.at(last_resolved, revision[rows], resolved[rows])
+
+    valid = (first_started != np.iinfo(np.int64).max) & (last_resolved != NULL_VALUE)
+    return ((last_resolved[valid] - first_started[valid]) / float(MICROSECONDS)).tolist()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--month",
+        help="Month to export, format: YYYY-MM (may be repeated)",
+        action="append",
+        required=True,
+    )
+    profiling.add_profiling_arguments(parser)
+    plan_capture.add_explain_arguments(parser)
+    args = parser.parse_args()
+    profiling.configure_from_args(args)
+    plan_capture.configure_from_args(args)
+
+    months = []
+    for month_arg in args.month:
+        try:
+            parsed = datetime.strptime(month_arg, "%Y-%m")
+        except ValueError:
+            print("ERROR: unable to parse month %s" % month_arg)
+            sys.exit(1)
+        months.append((parsed.year, parsed.month))
+
+    for year, month in months:
+        print("[%s] Exporting %d-%02d..." % (log_ts(), year, month))
+        num_rows = export_month(year, month)
+        print(
+            "[%s] Wrote %d rows to %s" % (log_ts(), num_rows, extract_path(year, month))
+        )
+    db_session.close_pool()
@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+""" Ingests Taskcluster queue task events into the tasks table.
+
+    This does the job of src/handler.js, but instead of one INSERT ... ON CONFLICT
+    round trip per message it collects rows into micro-batches and writes each
+    batch with multi-row upserts, flushing once the batch has --batch-size rows or
+    is --max-delay seconds old. Events are parsed by task_event.py, a port of the
+    node handler's task.js. Task definitions are cached in memory by
+    task_definitions.py rather than looked up in cached_task_definitions for every
+    event.
+
+    Events are pulse messages as JSON objects ({"exchange": ..., "routes": [...],
+    "payload": {...}}), optionally with the task definition under "task". They are
+    read from a JSONL replay file, or received as JSON lines over TCP from a local
+    stand-in for the pulse exchanges:
+
+        ./ingest.py --replay events.jsonl
+        ./ingest.py --listen 5672
+
+    Several events for the same task run within one batch are folded into a single
+    row, with the same end result as applying them one at a time.
+
+    Malformed events are skipped. Events whose task definition can't be fetched
+    because the queue or the database is unavailable are held and retried with
+    backoff, much like pulse redelivers a message the node handler rejects.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+
+import db_session
+import psycopg2
+import requests
+import task_definitions
+import task_event
+
+from psycopg2.extras import execute_values
+from shared import log_ts
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_MAX_DELAY = 1.0
+# Seconds to wait before retrying a batch the database couldn't be reached for.
+FLUSH_RETRY_DELAY = 5.0
+
+# Errors that say nothing about the rows themselves, so the batch is kept and retried.
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# Errors that mean the event itself is malformed, so retrying it can't help.
+MALFORMED_EVENT_ERRORS = (KeyError, IndexError, TypeError, ValueError)
+
+# Events that hit a transient error are retried after 1, 2, 4, ... seconds, up to
+# MAX_EVENT_ATTEMPTS times in all (about 4 minutes).
+MAX_EVENT_ATTEMPTS = 9
+RETRY_BASE_DELAY = 1.0
+
+
+def upsert_query(updates):
+    """ Returns the multi-row upsert for rows that overwrite the columns in updates
+        on conflict, for use with execute_values().
+    """
+    query = "INSERT INTO tasks (%s) VALUES %%s" % ", ".join(task_event.COLUMNS)
+    if not updates:
+        # In case a duplicate pending message is received, ignore it.
+        return query + " ON CONFLICT DO NOTHING"
+    return query + " ON CONFLICT ON CONSTRAINT dup_task_run DO UPDATE SET %s" % (
+        ", ".join(
+            "%s=EXCLUDED.%s" % (column, column)
+            for column in task_event.COLUMNS
+            if column in updates
+        )
+    )
+
+
+class UpsertBatcher(object):
+    """ Collects task rows and writes them in batches.
+
+        Rows are keyed on dup_task_run. A row for a run that is already in the batch
+        is merged into it: its updated columns overwrite the batched ones and the
+        batched row then updates the union of both sets on conflict, which is what
+        applying the two upserts in order would have done.
+
+        If the database rejects a batch, its rows are written one at a time and only
+        the rejected ones are dropped. If it can't be reached, the batch is kept and
+        isn't due again for FLUSH_RETRY_DELAY seconds.
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, max_delay=DEFAULT_MAX_DELAY):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pending = {}
+        self.first_added = None
+        self.retry_at = None
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.flushes = 0
+        self._queries = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, row, updates):
+        key = (row["task_id"], row["run_id"], row["created"])
+        if key not in self.pending:
+            if not self.pending:
+                self.first_added = time.time()
+            self.pending[key] = (dict(row), frozenset(updates))
+            return
+        batched, batched_updates = self.pending[key]
+        for column in updates:
+            batched[column] = row[column]
+        self.pending[key] = (batched, batched_updates | updates)
+
+    def due(self):
+        if not self.pending:
+            return False
+        if self.retry_at is not None and time.time() < self.retry_at:
+            return False
+        if len(self.pending) >= self.batch_size:
+            return True
+        return time.time() - self.first_added >= self.max_delay
+
+    def time_left(self):
+        """ Seconds until the batch comes due on age, or is retried after a failed
+            flush. None if it's empty.
+        """
+        if not self.pending:
+            return None
+        if self.retry_at is not None:
+            return max(0, self.retry_at - time.time())
+        return max(0, self.first_added + self.max_delay - time.time())
+
+    def _write(self, entries):
+        """ Writes (row, updates) entries, one statement per set of updated columns,
+            in a single transaction.
+        """
+        groups = {}
+        for row, updates in entries:
+            groups.setdefault(updates, []).append(
+                tuple(row[column] for column in task_event.COLUMNS)
+            )
+        with db_session.cursor() as cur:
+            for updates, rows in groups.items():
+                if updates not in self._queries:
+                    self._queries[updates] = upsert_query(updates)
+                execute_values(cur, self._queries[updates], rows, page_size=len(rows))
+
+    def _write_one_at_a_time(self):
+        written = 0
+        for key in list(self.pending):
+            try:
+                self._write([self.pending[key]])
+                written += 1
+                self.rows_written += 1
+            except CONNECTION_ERRORS:
+                raise
+            except psycopg2.Error as error:
+                print(
+                    "[%s] Dropping row for %s run %s: %s"
+                    % (log_ts(), key[0], key[1], str(error).strip())
+                )
+                self.rows_dropped += 1
+            del self.pending[key]
+        return written
+
+    def flush(self):
+        """ Writes every batched row. Returns the number written. Raises one of
+            CONNECTION_ERRORS, with the unwritten rows still batched, if the database
+            can't be reached.
+        """
+        if not self.pending:
+            return 0
+        try:
+            try:
+                self._write(self.pending.values())
+                written = len(self.pending)
+                self.rows_written += written
+                self.pending = {}
+            except CONNECTION_ERRORS:
+                raise
+            except psycopg2.Error as error:
+                print(
+                    "[%s] Batch rejected, writing its rows one at a time: %s"
+                    % (log_ts(), str(error).strip())
+                )
+                written = self._write_one_at_a_time()
+        except CONNECTION_ERRORS:
+            self.retry_at = time.time() + FLUSH_RETRY_DELAY
+            raise
+        self.first_added = None
+        self.retry_at = None
+        self.flushes += 1
+        return written
+
+
+def is_transient(error):
+    """ Whether error from looking up a task definition is worth retrying: network
+        and database errors and server-side HTTP errors are, but a task the queue
+        doesn't know about (HTTP 4xx other than 429) isn't.
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status == 429
+    return isinstance(error, (requests.RequestException, psycopg2.Error))
+
+
+class RetryQueue(object):
+    """ Events held after a transient error, each due again after an exponential
+        backoff.
+    """
+
+    def __init__(self, max_attempts=MAX_EVENT_ATTEMPTS, base_delay=RETRY_BASE_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self._heap = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def hold(self, message, attempts):
+        """ Holds message, which has failed attempts times. Returns False, without
+            holding it, once it has used up max_attempts.
+        """
+        if attempts >= self.max_attempts:
+            return False
+        retry_at = time.time() + self.base_delay * 2 ** (attempts - 1)
+        heapq.heappush(self._heap, (retry_at, next(self._order), message, attempts))
+        return True
+
+    def pop_due(self):
+        """ Returns the (message, attempts) pairs that are due again.
+        """
+        due = []
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, message, attempts = heapq.heappop(self._heap)
+            due.append((message, attempts))
+        return due
+
+    def time_left(self):
+        """ Seconds until the next held event is due, or None if there are none.
+        """
+        if not self._heap:
+            return None
+        return max(0, self._heap[0][0] - time.time())
+
+
+def next_wakeup(batcher, retries):
+    """ Seconds until either the batch or a held event comes due, or None.
+    """
+    waits = [w for w in (batcher.time_left(), retries.time_left()) if w is not None]
+    return min(waits) if waits else None
+
+
+def read_replay(filename):
+    """ Yields the events in a JSONL file.
+    """
+    with open(filename) as infile:
+        for line in infile:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class EventHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                self.server.events.put(json.loads(line.decode("utf-8")))
+            except ValueError as error:
+                print("[%s] Dropping malformed event: %s" % (log_ts(), error))
+
+
+class EventServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """ Receives events as JSON lines over TCP and queues them for the ingester.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, maxsize=0):
+        socketserver.TCPServer.__init__(self, address, EventHandler)
+        self.events = queue.Queue(maxsize=maxsize)
+
+
+def read_listener(server, batcher, retries):
+    """ Yields events received by server, or None whenever the current batch or a
+        held event comes due while waiting, so the ingester can deal with it.
+    """
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    while True:
+        try:
+            yield server.events.get(timeout=next_wakeup(batcher, retries))
+        except queue.Empty:
+            yield None
+
+
+def flush(batcher, definitions):
+    """ Flushes batcher and saves new task definitions. Returns the number of rows
+        written, or None if the database couldn't be reached and the rows are still
+        batched.
+    """
+    try:
+        written = batcher.flush()
+        definitions.persist()
+    except CONNECTION_ERRORS as error:
+        print(
+            "[%s] Flush failed, keeping %d rows to retry: %s"
+            % (log_ts(), len(batcher), str(error).strip())
+        )
+        return None
+    return written
+
+
+def ingest(events, batcher, definitions, retries=None):
+    """ Parses events and writes their rows through batcher. Events that don't carry
+        their task definition get it from definitions, a TaskDefinitionCache (see
+        task_definitions.py). Malformed events are skipped; events that hit a
+        transient error are held in retries, a RetryQueue, and processed again
+        later. Returns the number of events ingested and skipped.
+    """
+    if retries is None:
+        retries = RetryQueue()
+    counts = {"ingested": 0, "skipped": 0}
+
+    def process(message, attempts):
+        try:
+            definition = message.get("task")
+            if definition is None:
+                definition = definitions.get(message["payload"]["status"]["taskId"])
+            event = task_event.TaskEvent(message, definition)
+            upserts = event.upserts()
+        except MALFORMED_EVENT_ERRORS as error:
+            print("[%s] Skipping event: %r" % (log_ts(), error))
+            counts["skipped"] += 1
+            return
+        except (requests.RequestException, psycopg2.Error) as error:
+            if is_transient(error) and retries.hold(message, attempts + 1):
+                print(
+                    "[%s] Holding event after attempt %d: %r"
+                    % (log_ts(), attempts + 1, error)
+                )
+            else:
+                print(
+                    "[%s] Giving up on event after %d attempts: %r"
+                    % (log_ts(), attempts + 1, error)
+                )
+                counts["skipped"] += 1
+            return
+        for row, updates in upserts:
+            batcher.add(row, updates)
+        counts["ingested"] += 1
+
+    def process_due():
+        for message, attempts in retries.pop_due():
+            process(message, attempts)
+        if batcher.due():
+            written = flush(batcher, definitions)
+            if written is not None:
+                print(
+                    "[%s] Wrote %d rows (%d events); %s"
+                    % (
+                        log_ts(),
+                        written,
+                        counts["ingested"],
+                        definitions.format_stats(),
+                    )
+                )
+
+    try:
+        for message in events:
+            if message is not None:
+                process(message, 0)
+            process_due()
+        # A replay has run out of events, but some may still be held.
+        while len(retries):
+            time.sleep(retries.time_left())
+            process_due()
+    except KeyboardInterrupt:
+        print("[%s] Interrupted, flushing" % log_ts())
+    finally:
+        if len(retries):
+            print("[%s] Lost %d held events" % (log_ts(), len(retries)))
+        if flush(batcher, definitions) is None:
+            print("[%s] Lost %d unflushed rows" % (log_ts(), len(batcher)))
+    return counts["ingested"], counts["skipped"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--replay", help="JSONL file of task events to ingest")
+    source.add_argument(
+        "--listen",
+        help="Receive task events as JSON lines on this TCP port",
+        type=int,
+    )
+    parser.add_argument(
+        "--host",
+        help="Address for --listen (default: %(default)s)",
+        default="localhost",
+    )
+    parser.add_argument(
+        "--batch-size",
+        help="Flush after this many rows (default: %(default)s)",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+    )
+    parser.add_argument(
+        "--max-delay",
+        help="Flush rows older than this many seconds (default: %(default)s)",
+        type=float,
+        default=DEFAULT_MAX_DELAY,
+    )
+    parser.add_argument(
+        "--root-url",
+        help="Taskcluster root url for task definitions (default: $TASKCLUSTER_ROOT_URL"
+        " or %s)" % task_definitions.DEFAULT_ROOT_URL,
+        default=os.environ.get(
+            "TASKCLUSTER_ROOT_URL", task_definitions.DEFAULT_ROOT_URL
+        ),
+    )
+    parser.add_argument(
+        "--definition-cache-size",
+        help="Task definitions to keep in memory (default: %(default)s)",
+        type=int,
+        default=task_definitions.DEFAULT_MAX_SIZE,
+    )
+    parser.add_argument(
+        "--definition-ttl",
+        help="Seconds to keep a task definition in memory (default: %(default)s)",
+        type=int,
+        default=task_definitions.DEFAULT_TTL,
+    )
+    parser.add_argument(
+        "--warm-start",
+        help="Warm the task definition cache from, and save new definitions to, "
+        "cached_task_definitions",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.batch_size < 1 or args.max_delay <= 0:
+        print("--batch-size and --max-delay must be positive")
+        sys.exit(1)
+    if args.definition_cache_size < 1:
+        print("--definition-cache-size must be at least 1")
+        sys.exit(2)
+
+    db_session.init_pool()
+    batcher = UpsertBatcher(args.batch_size, args.max_delay)
+    retries = RetryQueue()
+    session = requests.Session()
+    definitions = task_definitions.TaskDefinitionCache(
+        lambda task_id: task_definitions.fetch_task_definition(
+            task_id, args.root_url, session
+        ),
+        args.definition_cache_size,
+        args.definition_ttl,
+        use_db=args.warm_start,
+    )
+    if args.warm_start:
+        print(
+            "[%s] Loaded %d task definitions" % (log_ts(), definitions.warm_start())
+        )
+
+    if args.replay:
+        events = read_replay(args.replay)
+    else:
+        server = EventServer((args.host, args.listen))
+        print("[%s] Listening on %s:%d" % (log_ts(), args.host, args.listen))
+        events = read_listener(server, batcher, retries)
+
+    start = time.time()
+    ingested, skipped = ingest(events, batcher, definitions, retries)
+    db_session.close_pool()
+    elapsed = time.time() - start
+    print("Ingested %d events (%d skipped)" % (ingested, skipped))
+    if batcher.rows_dropped:
+        print("Dropped %d rows the database rejected" % batcher.rows_dropped)
+    print(
+        "Wrote %d rows in %d flushes, %.2f s"
+        % (batcher.rows_written, batcher.flushes, elapsed)
+    )
+    print(definitions.format_stats())
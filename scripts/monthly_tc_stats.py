@@ -3,30 +3,44 @@
 import argparse
 import json
 import os
-import psycopg2
-import requests
-import sys
 
-from db_config import db_config
+import db_session
+import extract
+import plan_capture
+import profiling
+import pushlog
+import result_cache
+
 from datetime import datetime, timedelta
-from psycopg2 import extras
+from refresh_rollup import rollup_version, use_rollup
 from scipy import stats
-from shared import timeit
+from shared import month_range, timeit
 
 REPO = "mozilla-central"
-PUSHES_DIR = "logs"
 
 HASHTAGS = ["#Mozilla", "#ContinuousIntegration", "#Taskcluster"]
 
-psycopg2.extensions.set_wait_callback(extras.wait_select)
-
-
-def download_push_data(url, localfile):
-    resp = requests.get(url=url)
-    data = json.loads(resp.text)
-    if data:
-        with open(localfile, "w") as outfile:
-            json.dump(data, outfile)
+END_TO_END_QUERY = (
+    "SELECT revision, EXTRACT(EPOCH FROM (MAX(resolved)-MIN(started))) \
+        FROM ( \
+            SELECT revision, state, created, started, resolved, \
+                MIN(created) OVER (PARTITION BY revision) AS first_created \
+            FROM tasks \
+            WHERE revision = ANY(%s) \
+        ) AS merge_tasks \
+        WHERE state != 'exception' \
+        AND created < first_created + interval '1hr' \
+        GROUP BY revision"
+)
+
+MONTHLY_TOTALS_QUERY = (
+    "SELECT COUNT(task_id), \
+        SUM(duration)/1000/60/60/24/365, \
+        COUNT(DISTINCT worker_id) \
+        FROM tasks \
+        WHERE created >= %s \
+        AND created < %s"
+)
 
 
 def get_last_day_of_previous_month(from_date=None):
@@ -42,32 +56,14 @@ def get_first_day_of_month(from_date=None):
     return from_date.replace(day=1)
 
 
-def get_merge_csets(daterange):
-    if not os.path.exists(PUSHES_DIR):
-        os.makedirs(PUSHES_DIR)
-    pushes_json = "%s-pushes-%s.json" % (REPO, daterange[:7])
-    pushes_path = os.path.join(PUSHES_DIR, pushes_json)
-    if not os.path.isfile(pushes_path) or args.refresh_json:
-        # Download the push data as a json blob
-        first_day, last_day = daterange.split(" to ")
-        url = "https://hg.mozilla.org/%s/json-pushes?full=1&startdate=%s&enddate=%s" % (
-            REPO,
-            first_day,
-            last_day,
-        )
-        print("Donwloading %s data for %s" % (REPO, daterange))
-        download_push_data(url, pushes_path)
-
-    with open(pushes_path) as pp:
-        pushes = json.load(pp)
-    merges = []
-    if pushes:
-        for push in pushes:
-            p = pushes[push]
-            for cset in p["changesets"]:
-                if cset["desc"].startswith("Merge inbound"):
-                    merges.append(cset["node"])
-    return merges
+def get_merge_csets(daterange, pushlog_url=pushlog.DEFAULT_URL, sync=True):
+    """ Returns the merge changesets pushed to REPO in daterange, from the local push
+        log store (see pushlog.py), which is first brought up to date.
+    """
+    first_day, last_day = daterange.split(" to ")
+    return pushlog.get_merge_csets(
+        first_day, last_day, REPO, url=pushlog_url, sync=sync
+    )
 
 
 def convert_daterange_to_string(daterange):
@@ -76,40 +72,65 @@ def convert_daterange_to_string(daterange):
 
 @timeit
 def avg_duration(merges):
-    formatted_merges = "'" + "', '".join(merges) + "'"
     query = (
         "SELECT revision, SUM(duration)/1000/60/60 \
             FROM tasks \
-            WHERE revision IN (%s) \
+            WHERE revision = ANY(%s) \
             GROUP BY revision"
-        % formatted_merges
     )
-    cur.execute(query)
-    records = cur.fetchall()
+    records = db_session.fetchall(query, (list(merges),))
     durations = [record[1] for record in records]
     return float(round(stats.hmean(durations), 1))
 
 
 @timeit
-def end_to_end(merges):
+def end_to_end(merges, range_end=None):
+    """ Returns the harmonic mean end-to-end time in hours across all merge changesets,
+        computed in a single query.
+
+        All tasks are created when the initial decision task for a given changeset runs and
+        the task graph is generated. We want to exclude any tasks created AFTER that initial
+        flurry, so a window function finds each revision's first created time and only tasks
+        created within 1 hour of it are included. range_end is the end of the
+        daterange the merges were pushed in (see result_cache.cached()).
+    """
+    query = END_TO_END_QUERY
+    records = result_cache.cached_fetchall(
+        "monthly_tc_stats", query, (list(merges),), range_end=range_end
+    )
+    e2e_secs = [record[1] for record in records if record[1] is not None]
+    # We want to convert our value in seconds to hours for display.
+    return float(round(stats.hmean(e2e_secs) / 60 / 60, 1))
+
+
+@timeit
+def end_to_end_from_extract(merges, start_ts, end_ts):
+    """ Like end_to_end(), but computed from the local extracts written by extract.py
+        for the months between start_ts and end_ts.
+    """
+    extracts = extract.load_range(start_ts, end_ts, lookback=timedelta(0))
+    e2e_secs = extract.end_to_end_seconds(extracts, merges)
+    return float(round(stats.hmean(e2e_secs) / 60 / 60, 1))
+
+
+@timeit
+def end_to_end_per_cset(merges):
     e2e_secs = []
+    query = (
+        "SELECT EXTRACT(EPOCH FROM (MAX(resolved)-MIN(started))) \
+            FROM tasks \
+            WHERE revision = $1 \
+            AND state != 'exception' \
+            AND created < \
+            (SELECT MIN(created) + interval '1hr' FROM tasks WHERE revision = $1) \
+            GROUP BY revision"
+    )
     for cset in merges:
         # All tasks are created when the initial decision task for a given changeset runs and the task
         # graph is generated. We execute separate queries for each merge changeset because we want to
         # exclude any tasks created AFTER that initial flurry. I've arbitrarily chosen a cutoff of
         # 1 hour for this.
-        query = (
-            "SELECT EXTRACT(EPOCH FROM (MAX(resolved)-MIN(started))) \
-                FROM tasks \
-                WHERE revision = '%s' \
-                AND state != 'exception' \
-                AND created < \
-                (SELECT MIN(created) + interval '1hr' FROM tasks WHERE revision = '%s') \
-                GROUP BY revision"
-            % (cset, cset)
-        )
-        cur.execute(query)
-        records = cur.fetchone()
+        records = db_session.fetchone_prepared("end_to_end", query, (cset,))
         if records:
             # print("# of tasks: %d" % records[0])
             e2e_secs.append(records[0])
@@ -120,67 +141,52 @@ def end_to_end(merges):
 
 
 @timeit
-def tasks_per_month(year, month):
-    query = (
-        "SELECT COUNT(task_id) \
-            FROM tasks \
-            WHERE DATE_PART('year', created) = %s \
-            AND DATE_PART('month', created) = %s"
-        % (year, month)
-    )
-    cur.execute(query)
-    records = cur.fetchone()
-    if records:
-        # print("# of tasks: %d" % records[0])
-        return records[0]
-    else:
-        return 0
-
-
-@timeit
-def compute_years_per_month(year, month):
-    query = (
-        "SELECT SUM(duration)/1000/60/60/24/365 \
-            FROM tasks \
-            WHERE DATE_PART('year', created) = %s \
-            AND DATE_PART('month', created) = %s"
-        % (year, month)
+def monthly_rollup(year, month, raw=False):
+    """ Returns (number of tasks, compute years, unique workers) for a month.
+
+        This is read from the 'month' grain row of tasks_monthly_rollup (see
+        refresh_rollup.py). If the month hasn't been rolled up, or raw is set, it is
+        computed from a single pass over the month's tasks instead.
+    """
+    month_start, month_end = month_range(int(year), int(month))
+    if use_rollup(int(year), int(month), raw):
+        query = (
+            "SELECT num_tasks, total_duration/1000/60/60/24/365, num_workers \
+                FROM tasks_monthly_rollup \
+                WHERE year = %s \
+                AND month = %s \
+                AND grain = 'month'"
+        )
+        return result_cache.cached_fetchone(
+            "monthly_tc_stats",
+            query,
+            (int(year), int(month)),
+            version=rollup_version((int(year), int(month))),
+            range_end=month_end,
+        )
+    query = MONTHLY_TOTALS_QUERY
+    return result_cache.cached_fetchone(
+        "monthly_tc_stats", query, (month_start, month_end), range_end=month_end
     )
-    cur.execute(query)
-    records = cur.fetchone()
-    if records:
-        # print("Compute years: %s" % records[0])
-        return records[0]
-    else:
-        return 0
 
 
 @timeit
-def unique_workers_per_month(year, month):
-    query = (
-        "SELECT COUNT(DISTINCT worker_id) \
-            FROM tasks \
-            WHERE DATE_PART('year', created) = %s \
-            AND DATE_PART('month', created) = %s"
-        % (year, month)
-    )
-    cur.execute(query)
-    records = cur.fetchone()
-    if records:
-        # print("# of unique workers: %d" % records[0])
-        return records[0]
-    else:
-        return 0
+def monthly_totals_from_extract(year, month):
+    return extract.monthly_totals(extract.load(int(year), int(month)))
 
 
 @timeit
 def concurrent_tasks_per_month(year, month):
+    """ Returns the peak concurrency for the month from the daily peaks computed by
+        concurrent_tasks.py (see concurrency.py).
+    """
     ct_file = "logs/concurrent_tasks_%s-%s.json" % (year, month)
     concurrent_tasks_by_day = {}
     if os.path.exists(ct_file):
         with open(ct_file) as ct:
             concurrent_tasks_by_day = json.load(ct)
     else:
+        print("%s not found, run concurrent_tasks.py --year_month %s-%s first" % (ct_file, year, month))
         return 0
     return max(j for day in concurrent_tasks_by_day for i, j in concurrent_tasks_by_day[day])
 
@@ -218,17 +224,46 @@ if __name__ == "__main__":
         help='Daterange to process, format="YYYY-MM-DD to YYYY-MM-DD"',
         type=str,
     )
+    parser.add_argument(
+        "--per-cset-e2e",
+        help="Compute end-to-end times with one query per merge changeset",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--raw",
+        help="Compute monthly totals from tasks instead of tasks_monthly_rollup",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--extract",
+        help="Compute task stats from the local extracts written by extract.py",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--pushlog-url",
+        help="Push log server to sync merge changesets from (default: %s)"
+        % pushlog.DEFAULT_URL,
+        default=pushlog.DEFAULT_URL,
+    )
+    parser.add_argument(
+        "--no-pushlog-sync",
+        dest="pushlog_sync",
+        help="Read merge changesets from the local push log without syncing it",
+        action="store_false",
+    )
+    result_cache.add_cache_arguments(parser)
+    profiling.add_profiling_arguments(parser)
+    plan_capture.add_explain_arguments(parser)
     args = parser.parse_args()
+    profiling.configure_from_args(args)
+    plan_capture.configure_from_args(args)
 
-    conn = None
-    try:
-        db_params = db_config()
-        conn = psycopg2.connect(**db_params)
-    except psycopg2.Error:
-        print("I am unable to connect to the database")
-        sys.exit(1)
-
-    cur = conn.cursor()
+    # --refresh-json predates the shared cache and now means the same as --refresh.
+    if args.refresh_json:
+        args.refresh_cache = True
+    result_cache.configure_from_args(args)
+    if not args.extract:
+        db_session.init_pool()
 
     if args.daterange:
         daterange = args.daterange
@@ -242,21 +277,33 @@ if __name__ == "__main__":
         )
 
     print("Processing %s" % daterange)
-    merges = get_merge_csets(daterange)
-    # duration = avg_duration(merges)
-    end_to_end_time = end_to_end(merges)
-
     first_date, last_date = daterange.split(" to ")
     first_day = datetime.strptime(first_date, "%Y-%m-%d")
     year = first_day.strftime("%Y")
     month = first_day.strftime("%m")
-    num_tasks = tasks_per_month(year, month)
-    compute_years = compute_years_per_month(year, month)
-    num_workers = unique_workers_per_month(year, month)
+
+    merges = get_merge_csets(daterange, args.pushlog_url, args.pushlog_sync)
+    # duration = avg_duration(merges)
+    if args.extract:
+        end_to_end_time = end_to_end_from_extract(
+            merges, first_day, datetime.strptime(last_date, "%Y-%m-%d")
+        )
+    elif args.per_cset_e2e:
+        end_to_end_time = end_to_end_per_cset(merges)
+    else:
+        end_to_end_time = end_to_end(
+            merges, datetime.strptime(last_date, "%Y-%m-%d") + timedelta(days=1)
+        )
+
+    if args.extract:
+        rollup = monthly_totals_from_extract(year, month)
+    else:
+        rollup = monthly_rollup(year, month, args.raw)
+    # A month without tasks has no rollup row and NULL compute years.
+    num_tasks, compute_years, num_workers = [value or 0 for value in rollup or (0, 0, 0)]
     concurrent_tasks = concurrent_tasks_per_month(year, month)
 
-    cur.close()
-    conn.close()
+    db_session.close_pool()
 
     print(format_numtasks_tweet(first_day, num_tasks, compute_years, num_workers, concurrent_tasks))
     print(format_endtoend_tweet(first_day, end_to_end_time))
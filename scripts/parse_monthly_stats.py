@@ -1,24 +1,88 @@
 #!/usr/bin/env python
+""" Loads the "Monthly EC2 running hours costs and usage" CSVs exported from Cost
+    Explorer into worker_type_monthly_costs.
 
+    The CSV is wide: after the date column there is one "<provisioner>/<worker
+    type> (Hrs)" and one "<provisioner>/<worker type> ($)" column per worker type.
+    The first data row is the total over the whole export, followed by one row per
+    month, so a single export can cover a year of history. A single month export
+    may not have a dated row, in which case the month comes from the filename,
+    e.g. worker_type_hours_cost_jul2018.csv.
+
+    Every row of every file is COPYed into a temporary staging table and upserted
+    on dup_worker_type in a single transaction. --sql prints the equivalent INSERT
+    statements instead of touching the database.
+
+    Worker types are trimmed of surrounding whitespace. Months loaded before that
+    kept a trailing space, so run postgres/trim_worker_types.sql once before
+    reloading them, or they get a second row per worker type.
+"""
+
+import argparse
 import csv
+import io
 import os
 import re
 import sys
 
+import db_session
+
 from datetime import datetime
 
-worker_types = []
-values = []
+PROVIDER = "aws"
+
+HOURS_COLUMN = re.compile(r"^(.*)\(Hrs\)\s*$")
+COST_COLUMN = re.compile(r"^(.*)\(\$\)\s*$")
+
+ROW_DATE_FORMATS = ["%Y-%m-%d", "%Y-%m", "%m/%d/%Y", "%b %Y", "%B %Y"]
+
+COLUMNS = [
+    "year",
+    "month",
+    "provider",
+    "provisioner",
+    "worker_type",
+    "usage_hours",
+    "cost",
+]
+
+UPSERT_QUERY = (
+    "INSERT INTO worker_type_monthly_costs (%s) \
+        SELECT %s FROM worker_type_monthly_costs_staging \
+        ON CONFLICT ON CONSTRAINT dup_worker_type DO UPDATE \
+        SET usage_hours = EXCLUDED.usage_hours, \
+            cost = EXCLUDED.cost, \
+            modified = NOW() \
+        RETURNING (xmax = 0)"
+    % (", ".join(COLUMNS), ", ".join(COLUMNS))
+)
 
 
 def get_month_year_from_filename(filepath):
-    # filename e.g. worker_type_hours_cost_jul2018.csv
+    """ Returns (month, year) from a filename like worker_type_hours_cost_jul2018.csv,
+        or None if it isn't named that way.
+    """
     filename = os.path.basename(filepath)
     try:
-        parsed_date = datetime.strptime(filename, "worker_type_hours_cost_%B%Y.csv")
-        return parsed_date.month, parsed_date.year
+        parsed_date = datetime.strptime(filename, "worker_type_hours_cost_%b%Y.csv")
     except ValueError:
-        sys.exit("Unable to parse month from filepath: %s" % filepath)
+        try:
+            parsed_date = datetime.strptime(
+                filename, "worker_type_hours_cost_%B%Y.csv"
+            )
+        except ValueError:
+            return None
+    return parsed_date.month, parsed_date.year
+
+
+def get_month_year_from_row(label):
+    for date_format in ROW_DATE_FORMATS:
+        try:
+            parsed_date = datetime.strptime(label.strip(), date_format)
+        except ValueError:
+            continue
+        return parsed_date.month, parsed_date.year
+    return None
 
 
 def extract_provisioner_from_worker_type(worker_type):
@@ -30,77 +94,173 @@ def extract_provisioner_from_worker_type(worker_type):
     raise ValueError
 
 
-if __name__ == "__main__":
-    if len(sys.argv) == 1:
-        sys.exit("Please pass in the path of the csv file to parse.")
-    filename = sys.argv[1]
-
-    parsed_month, parsed_year = get_month_year_from_filename(filename)
-
-    with open(filename, "rb") as csvfile:
-        cost_data = csv.reader(csvfile, delimiter=",")
-        rownum = 0
-        colnum = 0
-
-        for row in cost_data:
-            for entry in row:
-                if rownum == 0:
-                    worker_types.append(entry)
-                else:
-                    values.append(entry)
-                colnum += 1
-            rownum += 1
-            # The default csv download for a month has two rows: one for total
-            # and one for the month. This is redundant in the single month case
-            # so we just read the first data row.
-            if rownum > 1:
+def parse_header(header):
+    """ Returns a list of (column index, provisioner, worker type, "hours" or "cost")
+        for the value columns of a header row.
+    """
+    columns = []
+    for i, name in enumerate(header):
+        if i == 0:
+            continue
+        for kind, pattern, total in (
+            ("hours", HOURS_COLUMN, "Total usage"),
+            ("cost", COST_COLUMN, "Total cost"),
+        ):
+            m = pattern.search(name)
+            if m:
+                provisioner, worker_type = extract_provisioner_from_worker_type(
+                    m.group(1).strip()
+                )
+                if re.search(total, worker_type):
+                    worker_type = "Total"
+                columns.append((i, provisioner, worker_type, kind))
                 break
+    return columns
 
-    worker_type_costs = {}
 
-    for i in range(len(worker_types)):
-        if i == 0:
-            continue
-        # Figure out what the worker type is, and whether the value represents cost or hours
-        m = re.search("^(.*)\s*\(Hrs\)", worker_types[i])
-        if m:
-            provisioner, worker_type = extract_provisioner_from_worker_type(m.group(1))
-            if re.search("Total usage", worker_type):
-                worker_type = "Total"
-            if provisioner not in worker_type_costs:
-                worker_type_costs[provisioner] = {}
-            if worker_type not in worker_type_costs[provisioner]:
-                worker_type_costs[provisioner][worker_type] = {}
-            worker_type_costs[provisioner][worker_type]["hours"] = values[i]
-            continue
-        m = re.search("^(.*)\(\$\)", worker_types[i])
-        if m:
-            provisioner, worker_type = extract_provisioner_from_worker_type(m.group(1))
-            if re.search("Total cost", worker_type):
-                worker_type = "Total"
-            if provisioner not in worker_type_costs:
-                worker_type_costs[provisioner] = {}
-            if worker_type not in worker_type_costs[provisioner]:
-                worker_type_costs[provisioner][worker_type] = {}
-            worker_type_costs[provisioner][worker_type]["cost"] = values[i]
-            continue
+def parse_value(value):
+    value = value.strip().replace(",", "").lstrip("$")
+    if not value:
+        return None
+    return float(value)
 
-    for provisioner in worker_type_costs:
-        for worker_type in worker_type_costs[provisioner]:
-            coopthing = worker_type_costs[provisioner][worker_type]
-            if "hours" in coopthing and "cost" in coopthing:
-                print(
-                    "INSERT INTO worker_type_monthly_costs \
-                        (year, month, provider, provisioner, worker_type, usage_hours, cost) \
-                        VALUES (%d, %d, 'aws', '%s', '%s', %.2f, %.2f);"
-                    % (
-                        parsed_year,
-                        parsed_month,
+
+def parse_file(filename):
+    """ Returns a list of (year, month, provider, provisioner, worker_type, hours,
+        cost) rows for every month in an exported CSV.
+    """
+    with open(filename, newline="") as csvfile:
+        reader = csv.reader(csvfile, delimiter=",")
+        header = next(reader, None)
+        data_rows = [row for row in reader if row]
+    if not header or not data_rows:
+        sys.exit("No data in %s" % filename)
+    columns = parse_header(header)
+
+    months = []
+    for row in data_rows:
+        month_year = get_month_year_from_row(row[0])
+        if month_year:
+            months.append((month_year, row))
+    if not months:
+        # The default csv download for a month has two rows: one for total and one
+        # for the month. This is redundant in the single month case so we just read
+        # the first data row.
+        month_year = get_month_year_from_filename(filename)
+        if not month_year:
+            sys.exit("Unable to parse month from filepath: %s" % filename)
+        months.append((month_year, data_rows[0]))
+
+    rows = []
+    for (month, year), row in months:
+        worker_type_costs = {}
+        for i, provisioner, worker_type, kind in columns:
+            value = parse_value(row[i]) if i < len(row) else None
+            if value is None:
+                continue
+            worker_type_costs.setdefault((provisioner, worker_type), {})[kind] = value
+        for (provisioner, worker_type), values in worker_type_costs.items():
+            if "hours" in values and "cost" in values:
+                rows.append(
+                    (
+                        year,
+                        month,
+                        PROVIDER,
                         provisioner,
                         worker_type,
-                        float(coopthing["hours"]),
-                        float(coopthing["cost"]),
+                        values["hours"],
+                        values["cost"],
                     )
                 )
             else:
-                print(worker_type + " missing an expected key")
+                print(
+                    "%d-%02d: %s missing an expected key" % (year, month, worker_type)
+                )
+    return rows
+
+
+def print_sql(rows):
+    for year, month, provider, provisioner, worker_type, hours, cost in rows:
+        print(
+            "INSERT INTO worker_type_monthly_costs \
+                (year, month, provider, provisioner, worker_type, usage_hours, cost) \
+                VALUES (%d, %d, '%s', '%s', '%s', %.2f, %.2f);"
+            % (year, month, provider, provisioner, worker_type, hours, cost)
+        )
+
+
+def load_rows(rows):
+    """ Upserts rows into worker_type_monthly_costs in one transaction. Returns
+        (inserted, updated).
+    """
+    copy_file = io.StringIO()
+    writer = csv.writer(copy_file)
+    for year, month, provider, provisioner, worker_type, hours, cost in rows:
+        writer.writerow(
+            [
+                year,
+                month,
+                provider,
+                provisioner,
+                worker_type,
+                "%.2f" % hours,
+                "%.2f" % cost,
+            ]
+        )
+    copy_file.seek(0)
+    with db_session.cursor() as cur:
+        cur.execute(
+            "CREATE TEMP TABLE worker_type_monthly_costs_staging \
+                (LIKE worker_type_monthly_costs INCLUDING DEFAULTS) \
+                ON COMMIT DROP"
+        )
+        cur.copy_expert(
+            "COPY worker_type_monthly_costs_staging (%s) FROM STDIN WITH (FORMAT csv)"
+            % ", ".join(COLUMNS),
+            copy_file,
+        )
+        cur.execute(UPSERT_QUERY)
+        results = [row[0] for row in cur.fetchall()]
+    inserted = results.count(True)
+    return inserted, len(results) - inserted
+
+
+def print_summary(rows, inserted, updated):
+    per_month = {}
+    for row in rows:
+        per_month[(row[0], row[1])] = per_month.get((row[0], row[1]), 0) + 1
+    for year, month in sorted(per_month):
+        print("%d-%02d: %d worker types" % (year, month, per_month[(year, month)]))
+    print(
+        "Loaded %d rows for %d months: %d inserted, %d updated"
+        % (len(rows), len(per_month), inserted, updated)
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("csvfiles", help="Cost Explorer CSV exports", nargs="+")
+    parser.add_argument(
+        "--sql",
+        help="Print INSERT statements instead of loading the database",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    rows = []
+    for filename in args.csvfiles:
+        rows.extend(parse_file(filename))
+    if not rows:
+        sys.exit("No worker type costs found in %s" % ", ".join(args.csvfiles))
+
+    # A later file (or month row) wins if the same worker type month appears twice,
+    # like it would if the files were loaded one at a time.
+    rows = list({row[:5]: row for row in rows}.values())
+
+    if args.sql:
+        print_sql(rows)
+        sys.exit(0)
+
+    inserted, updated = load_rows(rows)
+    db_session.close_pool()
+    print_summary(rows, inserted, updated)
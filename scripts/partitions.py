@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+""" Creates the monthly tasks partitions ahead of time.
+
+    Rows for a month without a partition land in tasks_default (see
+    postgres/create_table.sql). Run this periodically, e.g. daily from cron, so the
+    partitions for the coming months already exist when their tasks arrive:
+
+        0 3 * * * cd scripts && ./partitions.py
+
+    create_tasks_partition() moves any rows for the month out of tasks_default, so
+    this also catches up on months that were missed.
+"""
+
+import argparse
+import sys
+
+import db_session
+
+from datetime import date
+from shared import log_ts
+
+DEFAULT_MONTHS_AHEAD = 3
+
+
+def months_ahead(num_months, today=None):
+    """ Returns the first days of the current month and the num_months after it.
+    """
+    today = today or date.today()
+    months = []
+    for n in range(num_months + 1):
+        year, month = divmod(today.month - 1 + n, 12)
+        months.append(date(today.year + year, month + 1, 1))
+    return months
+
+
+def create_partitions(num_months=DEFAULT_MONTHS_AHEAD):
+    """ Creates the partitions from the current month up to num_months ahead that
+        don't exist yet. Returns their names.
+    """
+    names = []
+    with db_session.cursor() as cur:
+        for month_start in months_ahead(num_months):
+            cur.execute("SELECT create_tasks_partition(%s)", (month_start,))
+            names.append(cur.fetchone()[0])
+    return names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--months-ahead",
+        help="Months after the current one to create partitions for "
+        "(default: %(default)s)",
+        type=int,
+        default=DEFAULT_MONTHS_AHEAD,
+    )
+    args = parser.parse_args()
+    if args.months_ahead < 0:
+        print("--months-ahead can't be negative")
+        sys.exit(1)
+
+    db_session.init_pool()
+    names = create_partitions(args.months_ahead)
+    db_session.close_pool()
+    print("[%s] Tasks partitions up to date: %s" % (log_ts(), ", ".join(names)))
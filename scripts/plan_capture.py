@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+""" Captures the query plan of every distinct query a script runs.
+
+    With --explain DIR, the first time each query is executed through a
+    db_session cursor it is also run under EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON),
+    inside a savepoint that is rolled back, so statements that write are undone.
+    Each plan is stored as DIR/plans/NN.json and, at exit, the queries are ranked
+    by execution time, rows returned and shared buffers read from disk in
+    DIR/summary.json and on stdout, flagging sequential scans of tasks:
+
+        ./cost_per_push.py --month 2019-08 --refresh --explain explain/2019-08
+
+    Every captured query runs twice, so only use this to look at plans. Results
+    served from the result cache never reach the database; pass --refresh (or
+    --no-cache) to capture all of them. Queries sent as bytes, such as the pages
+    of execute_values(), are skipped since their values are part of the text.
+"""
+
+import atexit
+import json
+import os
+import threading
+
+import profiling
+import psycopg2
+import query_plans
+
+PLANS_DIR = "plans"
+SUMMARY_FILE = "summary.json"
+# Statements that are worth a plan; PREPARE, SET, DDL and the like are not.
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "EXECUTE")
+QUERY_TEXT_LENGTH = 60
+TOP_ENTRIES = 10
+
+_settings = {"directory": None}
+_state = {"queries": {}}
+_lock = threading.Lock()
+
+
+def add_explain_arguments(parser):
+    parser.add_argument(
+        "--explain",
+        metavar="DIR",
+        help="EXPLAIN ANALYZE every distinct query and store the plans and a summary "
+        "in DIR",
+    )
+
+
+def configure_from_args(args):
+    configure(args.explain)
+
+
+def configure(directory=None):
+    """ Enables plan capture into directory. The summary is written at exit.
+    """
+    if _settings["directory"] or not directory:
+        return
+    plans = os.path.join(directory, PLANS_DIR)
+    if not os.path.exists(plans):
+        os.makedirs(plans)
+    _settings["directory"] = directory
+    atexit.register(finish)
+
+
+def enabled():
+    return _settings["directory"] is not None
+
+
+def _claim(query):
+    """ Returns the entry for query if its plan should be captured now, counting
+        every execution of it.
+    """
+    if isinstance(query, bytes):
+        return None
+    text = " ".join(str(query).split())
+    if text.split(" ", 1)[0].upper() not in EXPLAINABLE:
+        return None
+    with _lock:
+        entry = _state["queries"].get(text)
+        if entry is not None:
+            entry["calls"] += 1
+            return None
+        entry = {"id": len(_state["queries"]) + 1, "query": text, "calls": 1}
+        _state["queries"][text] = entry
+    return entry
+
+
+def capture(cur, query, params=None):
+    """ Stores the plan of query, run with params on cur's connection, unless it
+        has been captured before.
+    """
+    entry = _claim(query)
+    if entry is None:
+        return
+    conn = cur.connection
+    prepared = getattr(conn, "prepared", {})
+    words = entry["query"].split(" ")
+    if words[0].upper() == "EXECUTE" and words[1] in prepared:
+        entry["prepared"] = " ".join(prepared[words[1]].split())
+    explain_cur = conn.cursor()
+    with profiling.span("db.explain", profiling.DB, query=entry["query"][:200]):
+        explain_cur.execute("SAVEPOINT plan_capture")
+        try:
+            plan = query_plans.explain(
+                explain_cur, query, params, analyze=True, buffers=True
+            )
+        except psycopg2.Error as error:
+            entry["error"] = str(error).strip()
+            plan = None
+        explain_cur.execute("ROLLBACK TO SAVEPOINT plan_capture")
+        explain_cur.execute("RELEASE SAVEPOINT plan_capture")
+    explain_cur.close()
+    if plan is not None:
+        entry.update(summarize(plan))
+    entry["plan"] = plan
+
+
+def summarize(plan):
+    """ Returns the execution time (ms), rows, shared buffers and tasks scans of an
+        EXPLAIN ANALYZE plan with buffers.
+    """
+    top = plan["Plan"]
+    scans = query_plans.scans(plan)
+    return {
+        "planning_ms": plan.get("Planning Time"),
+        "execution_ms": plan.get("Execution Time"),
+        "rows": top.get("Actual Rows", 0) * top.get("Actual Loops", 1),
+        "shared_hit": top.get("Shared Hit Blocks", 0),
+        "shared_read": top.get("Shared Read Blocks", 0),
+        "seq_scans": sorted(
+            set(
+                scan["relation"]
+                for scan in scans
+                if scan["node"] == query_plans.SEQ_SCAN
+                and query_plans.is_tasks(scan["relation"])
+            )
+        ),
+    }
+
+
+def format_summary(entries):
+    captured = [entry for entry in entries if entry.get("plan")]
+    lines = ["Query plans: %d distinct queries" % len(entries)]
+    row_format = "{0:>3} {1:>6} {2:>11} {3:>12} {4:>12} {5:>12}  {6}"
+    lines.append(
+        row_format.format(
+            "#", "Calls", "Time (ms)", "Rows", "Shared read", "Shared hit", "Query"
+        )
+    )
+    by_time = sorted(captured, key=lambda entry: entry["execution_ms"], reverse=True)
+    for entry in by_time:
+        flag = "! " if entry["seq_scans"] else ""
+        lines.append(
+            row_format.format(
+                entry["id"],
+                entry["calls"],
+                "%.1f" % entry["execution_ms"],
+                "{:,}".format(entry["rows"]),
+                "{:,}".format(entry["shared_read"]),
+                "{:,}".format(entry["shared_hit"]),
+                flag + entry.get("prepared", entry["query"])[:QUERY_TEXT_LENGTH],
+            )
+        )
+    for title, key in (("Most rows", "rows"), ("Most shared reads", "shared_read")):
+        ranked = sorted(captured, key=lambda entry: entry[key], reverse=True)
+        lines.append(
+            "%s: %s"
+            % (
+                title,
+                ", ".join(
+                    "#%d (%s)" % (entry["id"], "{:,}".format(entry[key]))
+                    for entry in ranked[:TOP_ENTRIES]
+                ),
+            )
+        )
+    for entry in captured:
+        if entry["seq_scans"]:
+            lines.append(
+                "! #%d sequential scan of %s"
+                % (entry["id"], ", ".join(entry["seq_scans"]))
+            )
+    for entry in entries:
+        if "error" in entry:
+            lines.append(
+                "#%d could not be explained: %s" % (entry["id"], entry["error"])
+            )
+    return "\n".join(lines)
+
+
+def finish():
+    """ Writes the captured plans and the summary, and prints the summary.
+    """
+    directory = _settings["directory"]
+    if directory is None:
+        return
+    _settings["directory"] = None
+    with _lock:
+        entries = sorted(_state["queries"].values(), key=lambda entry: entry["id"])
+    summary = []
+    for entry in entries:
+        filename = os.path.join(directory, PLANS_DIR, "%02d.json" % entry["id"])
+        with open(filename, "w") as f:
+            json.dump(entry, f, indent=2, default=str)
+        summary.append(dict((k, v) for k, v in entry.items() if k != "plan"))
+    with open(os.path.join(directory, SUMMARY_FILE), "w") as f:
+        json.dump(summary, f, indent=2, default=str)
+    print(format_summary(entries))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+""" Per-platform cost aggregation for platform_costs.py.
+
+    aggregate() splits each worker type's AWS cost across the platforms it ran,
+    in proportion to their task time, and groups the platforms into buckets:
+
+        PlatformAggregation
+          BucketCost          (e.g. "Windows 10")
+            WorkerTypeCost    (e.g. "gecko-t-win10-64")
+              PlatformCost    (e.g. "windows10-64")
+
+    The records use __slots__ and are built in a single pass. Buckets and worker
+    types are sorted once by cost and once by time, and the CSV, text and JSON
+    renderers all walk those precomputed orders.
+"""
+
+# Worker type durations carry a "total" entry alongside their platforms. It is
+# aggregated like a platform (so it counts towards bucket and worker type totals)
+# but isn't listed as one.
+TOTAL = "total"
+
+
+class PlatformCost(object):
+    __slots__ = ("name", "msecs", "cost")
+
+    def __init__(self, name):
+        self.name = name
+        self.msecs = 0
+        self.cost = 0
+
+    def to_dict(self):
+        return {"platform": self.name, "msecs": self.msecs, "cost": self.cost}
+
+
+class WorkerTypeCost(object):
+    __slots__ = ("name", "msecs", "cost", "platforms", "_platforms_by_name")
+
+    def __init__(self, name):
+        self.name = name
+        self.msecs = 0
+        self.cost = 0
+        # In the order the platforms were first seen.
+        self.platforms = []
+        self._platforms_by_name = {}
+
+    def platform(self, name):
+        record = self._platforms_by_name.get(name)
+        if record is None:
+            record = self._platforms_by_name[name] = PlatformCost(name)
+            self.platforms.append(record)
+        return record
+
+    def platform_names(self):
+        return [p.name for p in self.platforms if p.name != TOTAL]
+
+    def to_dict(self):
+        return {
+            "worker_type": self.name,
+            "msecs": self.msecs,
+            "cost": self.cost,
+            "platforms": [p.to_dict() for p in self.platforms if p.name != TOTAL],
+        }
+
+
+class BucketCost(object):
+    __slots__ = (
+        "name",
+        "msecs",
+        "cost",
+        "worker_types",
+        "_worker_types_by_name",
+        "worker_types_by_cost",
+        "worker_types_by_msecs",
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.msecs = 0
+        self.cost = 0
+        self.worker_types = []
+        self._worker_types_by_name = {}
+        self.worker_types_by_cost = None
+        self.worker_types_by_msecs = None
+
+    def worker_type(self, name):
+        record = self._worker_types_by_name.get(name)
+        if record is None:
+            record = self._worker_types_by_name[name] = WorkerTypeCost(name)
+            self.worker_types.append(record)
+        return record
+
+    def to_dict(self):
+        return {
+            "bucket": self.name,
+            "msecs": self.msecs,
+            "cost": self.cost,
+            "worker_types": [w.to_dict() for w in self.worker_types_by_cost],
+        }
+
+
+class PlatformAggregation(object):
+    """ The buckets of a month, with precomputed sort orders. Use aggregate() to
+        build one.
+    """
+
+    __slots__ = ("buckets", "_buckets_by_name", "buckets_by_cost", "buckets_by_msecs")
+
+    def __init__(self):
+        self.buckets = []
+        self._buckets_by_name = {}
+        self.buckets_by_cost = []
+        self.buckets_by_msecs = []
+
+    def bucket(self, name):
+        record = self._buckets_by_name.get(name)
+        if record is None:
+            record = self._buckets_by_name[name] = BucketCost(name)
+            self.buckets.append(record)
+        return record
+
+    def sort(self):
+        # sorted() is stable, so ties keep the order records were first seen in.
+        self.buckets_by_cost = sorted(self.buckets, key=_cost, reverse=True)
+        self.buckets_by_msecs = sorted(self.buckets, key=_msecs, reverse=True)
+        for bucket in self.buckets:
+            bucket.worker_types_by_cost = sorted(
+                bucket.worker_types, key=_cost, reverse=True
+            )
+            bucket.worker_types_by_msecs = sorted(
+                bucket.worker_types, key=_msecs, reverse=True
+            )
+
+    def to_dict(self):
+        return {"buckets": [b.to_dict() for b in self.buckets_by_cost]}
+
+
+def _cost(record):
+    return record.cost
+
+
+def _msecs(record):
+    return record.msecs
+
+
+def aggregate(worker_types, worker_type_durations, bucket_for):
+    """ Returns a PlatformAggregation of worker_type_durations (worker type ->
+        platform -> msecs, see platform_costs.get_worker_type_durations()) costed with
+        worker_types (worker type -> {"cost": ...}, from Cost Explorer).
+        bucket_for(worker_type, platform) names the bucket a platform belongs to.
+    """
+    aggregation = PlatformAggregation()
+    for worker_type, durations in worker_type_durations.items():
+        total = durations[TOTAL]
+        worker_type_cost = None
+        if worker_type in worker_types:
+            worker_type_cost = worker_types[worker_type]["cost"]
+        for platform, msecs in durations.items():
+            bucket = aggregation.bucket(bucket_for(worker_type, platform))
+            worker_type_record = bucket.worker_type(worker_type)
+            platform_record = worker_type_record.platform(platform)
+            if worker_type_cost is not None:
+                cost = msecs / total * worker_type_cost
+            else:
+                cost = 0
+            bucket.msecs += msecs
+            bucket.cost += cost
+            worker_type_record.msecs += msecs
+            worker_type_record.cost += cost
+            platform_record.msecs += msecs
+            platform_record.cost = cost
+    aggregation.sort()
+    return aggregation
+
+
+def csv_rows(aggregation, year, month):
+    rows = []
+    for bucket in aggregation.buckets_by_cost:
+        for worker_type in bucket.worker_types_by_cost:
+            for platform in worker_type.platforms:
+                if platform.name == TOTAL:
+                    continue
+                rows.append(
+                    [
+                        bucket.name,
+                        worker_type.name,
+                        platform.name,
+                        platform.cost,
+                        platform.msecs,
+                        round(float(platform.msecs / 1000 / 60 / 60), 2),
+                        year,
+                        month,
+                        "",
+                        "",
+                        "",
+                    ]
+                )
+    return rows
+
+
+def _hours(msecs):
+    return float(msecs / 1000 / 60 / 60)
+
+
+def render_text(aggregation):
+    lines = ["Platforms sorted by cost", "========================"]
+    for bucket in aggregation.buckets_by_cost:
+        lines.append("{0:<25s} ${1:>15,.2f}".format(bucket.name + ":", float(bucket.cost)))
+        for worker_type in bucket.worker_types_by_cost:
+            lines.append(
+                "\t{0:<25s} ${1:>15,.2f} (platforms: {2})".format(
+                    worker_type.name + ":",
+                    float(worker_type.cost),
+                    ", ".join(worker_type.platform_names()),
+                )
+            )
+        lines.append("")
+
+    lines += ["Platforms sorted by time", "========================"]
+    for bucket in aggregation.buckets_by_msecs:
+        lines.append(
+            "{0:<25s} {1:>15,.2f} hrs".format(bucket.name + ":", _hours(bucket.msecs))
+        )
+        for worker_type in bucket.worker_types_by_msecs:
+            lines.append(
+                "\t{0:<25s} {1:>15,.2f} hrs (platforms: {2})".format(
+                    worker_type.name + ":",
+                    _hours(worker_type.msecs),
+                    ", ".join(worker_type.platform_names()),
+                )
+            )
+        lines.append("")
+    return "\n".join(lines)
+
+
+def to_json(aggregation, year, month):
+    data = aggregation.to_dict()
+    data["year"] = year
+    data["month"] = month
+    return data
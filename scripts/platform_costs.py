@@ -2,19 +2,24 @@
 
 import argparse
 import boto3
-import copy
 import csv
-import json
 import os
 import pprint
-import psycopg2
 import re
 import sys
 
-from datetime import datetime
-from db_config import db_config
-from psycopg2 import extras
-from shared import timeit
+import bucket_classifier
+import cost_explorer
+import db_session
+import plan_capture
+import platform_aggregation
+import profiling
+import result_cache
+
+from datetime import datetime, timedelta
+from functools import lru_cache
+from refresh_rollup import rollup_version, use_rollup
+from shared import month_range, timeit
 
 instance_type_query = {
     "TimePeriod": {"Start": "", "End": ""},
@@ -26,30 +31,77 @@ instance_type_query = {
     "GroupBy": [{"Type": "DIMENSION", "Key": "INSTANCE_TYPE"}],
 }
 
-worker_type_query = {
-    "TimePeriod": {"Start": "", "End": ""},
-    "Granularity": "MONTHLY",
-    "Filter": {"Dimensions": {"Key": "INSTANCE_TYPE", "Values": []}},
-    "Metrics": ["UnblendedCost", "UsageQuantity"],
-    "GroupBy": [{"Type": "TAG", "Key": "WorkerType"}],
-}
+WORKER_TYPE_TAG = {"Type": "TAG", "Key": "WorkerType"}
+# See get_worker_types_transitional()
+NAME_TAG = {"Type": "TAG", "Key": "Name"}
+
+WORKER_KEY_PREFIX = re.compile(r"^(?:WorkerType\$)?(?:Name\$)?")
+
+classifier = bucket_classifier.BucketClassifier()
+
+# Only tasks from these provisioners are included in the per-platform breakdown.
+PROVISIONERS = [
+    "app-services-1",
+    "app-services-3",
+    "aws-provisioner-v1",
+    "ci-1",
+    "comm-1",
+    "comm-3",
+    "comm-t",
+    "gecko-1",
+    "gecko-2",
+    "gecko-3",
+    "gecko-t",
+    "mobile-1",
+    "mobile-3",
+    "mozillaonline-3",
+    "mpd001-3",
+    "nss-1",
+    "nss-3",
+    "infra",
+    "l10n-3",
+    "pmoore-test",
+    "project-relman",
+    "releng-3",
+    "releng-t",
+    "sandbox-1",
+    "scriptworker-prov-v1",
+    "taskcluster-imaging",
+    "taskgraph-1",
+    "taskgraph-3",
+    "taskgraph-t",
+    "xpi-1",
+    "xpi-3",
+]
 
+DATA_DIR = "./data"
 
-buckets = [
-    ("Linux64", ["linux64"]),
-    ("Linux32", ["linux32"]),
-    ("OS X", ["osx"]),
-    ("Android", ["android", "Android", "mobile"]),
-    ("Windows Server 2012", ["windows2012", "win2012"]),
-    ("Windows 7", ["windows7", "win7"]),
-    ("Windows 10", ["windows10", "win10"]),
-    ("b2g", ["mulet", "gaia", "b2g", "flame"]),
+CSV_HEADER = [
+    "Bucket",
+    "Worker Type",
+    "Platform",
+    "Cost ($)",
+    "Duration (msecs)",
+    "Duration (hours)",
+    "Year",
+    "Month",
+    "YYYY-MM",
+    "Product",
+    "Provider",
+    "Worker Pool ID"
 ]
 
-DATA_DIR = "./data"
+WORKER_TYPE_DURATIONS_QUERY = (
+    "SELECT worker_type, platform, SUM(duration) AS total_time \
+        FROM tasks \
+        WHERE created >= %s AND created < %s \
+        AND provisioner = ANY(%s) \
+        AND started IS NOT NULL \
+        GROUP BY worker_type, platform \
+        ORDER BY worker_type ASC, platform ASC, total_time DESC"
+)
 
 pp = pprint.PrettyPrinter(indent=4)
-psycopg2.extensions.set_wait_callback(extras.wait_select)
 worker_type_duration_totals_tc = {}
 
 
@@ -68,269 +120,400 @@ def is_valid_date(in_date):
     return False
 
 
+@lru_cache(maxsize=4096)
 def split_worker_key(key):
-    key = re.sub(r"^WorkerType\$", "", key)
     # Name is the new tag we use, so strip both prefixes.
-    key = re.sub(r"^Name\$", "", key)
+    key = WORKER_KEY_PREFIX.sub("", key)
     if key == "":
         return "None", "None"
     if key.find("/") == -1:
         return "None", key
-    return key.split("/", 2)
+    return tuple(key.split("/", 2))
 
 
 def get_bucket_for_db_platform(worker_type, db_platform):
-    for bucket, matches in buckets:
-        if any(match in db_platform for match in matches):
-            return bucket
-    for bucket, matches in buckets:
-        if any(match in worker_type for match in matches):
-            return bucket
-    return "Other"
+    return classifier.classify(worker_type, db_platform)
+
+
+def get_worker_type_responses(client, instance_types, startdate, enddate, group_by, jobs):
+    """ Returns the Cost Explorer responses for each instance type grouped by a tag,
+        in instance type order. The requests are issued concurrently.
+    """
+    queries = [
+        cost_explorer.build_query(
+            startdate, enddate, "INSTANCE_TYPE", [instance_type], group_by
+        )
+        for instance_type in instance_types
+    ]
+    return zip(instance_types, cost_explorer.get_all(client, queries, jobs))
+
+
+def add_instance_types(instance_types, groups):
+    for entry in groups:
+        key = entry["Keys"][0]
+        instance_types[key] = {}
+        instance_types[key]["cost"] = entry["Metrics"]["UnblendedCost"]["Amount"]
+        instance_types[key]["hours"] = entry["Metrics"]["UsageQuantity"]["Amount"]
+        instance_types[key]["worker_types"] = {}
+
+
+def add_worker_type_costs(worker_types, instance_types, instance_type, groups, new_only=False):
+    """ Adds the cost of each worker type tag in groups to worker_types and to the
+        instance type's breakdown. With new_only, worker types that have already been
+        seen are skipped, see get_worker_types_transitional().
+    """
+    for entry in groups:
+        # The tag is the last key, whether or not the groups are also split by
+        # instance type.
+        key = entry["Keys"][-1]
+        provisioner, worker_type = split_worker_key(key)
+        if worker_type not in worker_types:
+            worker_types[worker_type] = {"cost": 0, "hours": 0}
+        elif new_only:
+            continue
+        worker_types[worker_type]["cost"] += float(
+            entry["Metrics"]["UnblendedCost"]["Amount"]
+        )
+        worker_types[worker_type]["hours"] += float(
+            entry["Metrics"]["UsageQuantity"]["Amount"]
+        )
+        instance_types[instance_type]["worker_types"][worker_type] = {
+            "provisioner": provisioner,
+            "cost": entry["Metrics"]["UnblendedCost"]["Amount"],
+            "hours": entry["Metrics"]["UsageQuantity"]["Amount"],
+        }
 
 
 @timeit
-def get_instance_types(json_file, startdate, enddate):
+def get_instance_types(client, startdate, enddate):
     instance_types = {}
-    if os.path.exists(json_file):
-        with open(json_file) as infile:
-            instance_types = json.load(infile)
-    else:
-        instance_type_query["TimePeriod"]["Start"] = args.startdate
-        instance_type_query["TimePeriod"]["End"] = args.enddate
-        client = boto3.client("ce")
-        response = client.get_cost_and_usage(**instance_type_query)
+    query = dict(
+        instance_type_query, TimePeriod={"Start": startdate, "End": enddate}
+    )
+    response = cost_explorer.get_cost_and_usage(client, query)
 
-        if response and "ResultsByTime" in response:
-            for entry in response["ResultsByTime"][0]["Groups"]:
-                key = entry["Keys"][0]
-                instance_types[key] = {}
-                instance_types[key]["cost"] = entry["Metrics"]["UnblendedCost"][
-                    "Amount"
-                ]
-                instance_types[key]["hours"] = entry["Metrics"]["UsageQuantity"][
-                    "Amount"
-                ]
-                instance_types[key]["worker_types"] = {}
+    if response and "ResultsByTime" in response:
+        add_instance_types(instance_types, response["ResultsByTime"][0]["Groups"])
 
     return instance_types
 
 
 @timeit
-def get_worker_types(json_file, instance_types, startdate, enddate):
+def get_worker_types(client, instance_types, startdate, enddate, jobs=1):
     worker_types = {}
-    if os.path.exists(json_file):
-        with open(json_file) as infile:
-            worker_types = json.load(infile)
-    else:
-        worker_type_query["TimePeriod"]["Start"] = args.startdate
-        worker_type_query["TimePeriod"]["End"] = args.enddate
-        client = boto3.client("ce")
-        for instance_type in instance_types:
-            current_worker_type_query = copy.deepcopy(worker_type_query)
-            current_worker_type_query["Filter"]["Dimensions"]["Values"].append(
-                instance_type
+    responses = get_worker_type_responses(
+        client, instance_types, startdate, enddate, WORKER_TYPE_TAG, jobs
+    )
+    for instance_type, response in responses:
+        if response and "ResultsByTime" in response:
+            add_worker_type_costs(
+                worker_types,
+                instance_types,
+                instance_type,
+                response["ResultsByTime"][0]["Groups"],
             )
 
-            response = client.get_cost_and_usage(**current_worker_type_query)
-
-            if response and "ResultsByTime" in response:
-                for entry in response["ResultsByTime"][0]["Groups"]:
-                    key = entry["Keys"][0]
-                    provisioner, worker_type = split_worker_key(key)
-                    if worker_type not in worker_types:
-                        worker_types[worker_type] = {"cost": 0, "hours": 0}
-                    worker_types[worker_type]["cost"] += float(
-                        entry["Metrics"]["UnblendedCost"]["Amount"]
-                    )
-                    worker_types[worker_type]["hours"] += float(
-                        entry["Metrics"]["UsageQuantity"]["Amount"]
-                    )
-                    instance_types[instance_type]["worker_types"][worker_type] = {
-                        "provisioner": provisioner,
-                        "cost": entry["Metrics"]["UnblendedCost"]["Amount"],
-                        "hours": entry["Metrics"]["UsageQuantity"]["Amount"],
-                    }
-
     return worker_types, instance_types
 
 
 @timeit
-def get_worker_types_transitional(worker_types, instance_types, startdate, enddate):
+def get_worker_types_transitional(
+    client, worker_types, instance_types, startdate, enddate, jobs=1
+):
     """
     In late October 2019, we changed how instances were provisioned as part of a
     redeploying Taskcluster. The WorkerType tag was abandoned in favor of the Name
     tag. The old method of provisioning wasn't disabled until early November 2019,
     so for October/November 2019, we need to support both instance tagging methods
     in cost look-ups.
-    """
-    worker_type_query["TimePeriod"]["Start"] = args.startdate
-    worker_type_query["TimePeriod"]["End"] = args.enddate
-    worker_type_query["GroupBy"] = [{"Type": "TAG", "Key": "Name"}]
-    client = boto3.client("ce")
-    for instance_type in instance_types:
-        current_worker_type_query = copy.deepcopy(worker_type_query)
-        current_worker_type_query["Filter"]["Dimensions"]["Values"].append(
-            instance_type
-        )
-
-        response = client.get_cost_and_usage(**current_worker_type_query)
 
+    Responses are applied in instance type order, so the first instance type to
+    report a worker type under the Name tag still wins.
+    """
+    responses = get_worker_type_responses(
+        client, instance_types, startdate, enddate, NAME_TAG, jobs
+    )
+    for instance_type, response in responses:
         if response and "ResultsByTime" in response:
-            for entry in response["ResultsByTime"][0]["Groups"]:
-                key = entry["Keys"][0]
-                provisioner, worker_type = split_worker_key(key)
-                if worker_type not in worker_types:
-                    worker_types[worker_type] = {"cost": 0, "hours": 0}
-                else:
-                    continue
-                worker_types[worker_type]["cost"] += float(
-                    entry["Metrics"]["UnblendedCost"]["Amount"]
-                )
-                worker_types[worker_type]["hours"] += float(
-                    entry["Metrics"]["UsageQuantity"]["Amount"]
-                )
-                instance_types[instance_type]["worker_types"][worker_type] = {
-                    "provisioner": provisioner,
-                    "cost": entry["Metrics"]["UnblendedCost"]["Amount"],
-                    "hours": entry["Metrics"]["UsageQuantity"]["Amount"],
-                }
+            add_worker_type_costs(
+                worker_types,
+                instance_types,
+                instance_type,
+                response["ResultsByTime"][0]["Groups"],
+                new_only=True,
+            )
 
     return worker_types, instance_types
 
 
+def result_month(result):
+    return result["TimePeriod"]["Start"][:7]
+
+
+@timeit
+def get_instance_types_by_month(client, startdate, enddate):
+    """ Like get_instance_types(), but for every month between startdate and enddate
+        from a single request. Returns a dict of "YYYY-MM" -> instance types.
+    """
+    instance_types_by_month = {}
+    query = dict(
+        instance_type_query, TimePeriod={"Start": startdate, "End": enddate}
+    )
+    response = cost_explorer.get_cost_and_usage(client, query)
+    for result in response.get("ResultsByTime", []):
+        instance_types = instance_types_by_month.setdefault(result_month(result), {})
+        add_instance_types(instance_types, result["Groups"])
+    return instance_types_by_month
+
+
+@timeit
+def get_worker_types_by_month(
+    client, instance_types_by_month, startdate, enddate, group_by, worker_types_by_month=None
+):
+    """ Like get_worker_types() (or get_worker_types_transitional(), when
+        worker_types_by_month is passed in) for every month between startdate and
+        enddate. Instead of one request per instance type, a single request is grouped
+        by both instance type and tag.
+    """
+    new_only = worker_types_by_month is not None
+    if worker_types_by_month is None:
+        worker_types_by_month = {}
+    all_instance_types = sorted(
+        set(
+            instance_type
+            for instance_types in instance_types_by_month.values()
+            for instance_type in instance_types
+        )
+    )
+    if not all_instance_types:
+        return worker_types_by_month
+    query = cost_explorer.build_query(
+        startdate,
+        enddate,
+        "INSTANCE_TYPE",
+        all_instance_types,
+        {"Type": "DIMENSION", "Key": "INSTANCE_TYPE"},
+        group_by,
+    )
+    response = cost_explorer.get_cost_and_usage(client, query)
+    for result in response.get("ResultsByTime", []):
+        month = result_month(result)
+        instance_types = instance_types_by_month.setdefault(month, {})
+        worker_types = worker_types_by_month.setdefault(month, {})
+        groups_by_instance_type = {}
+        for entry in result["Groups"]:
+            groups_by_instance_type.setdefault(entry["Keys"][0], []).append(entry)
+        # Apply instance types in the same order as the per instance type requests.
+        for instance_type in instance_types:
+            if instance_type in groups_by_instance_type:
+                add_worker_type_costs(
+                    worker_types,
+                    instance_types,
+                    instance_type,
+                    groups_by_instance_type[instance_type],
+                    new_only,
+                )
+    return worker_types_by_month
+
+
 @timeit
-def get_worker_type_durations(json_file, year, month):
+def get_worker_type_durations(year, month, rollup=True):
+    """ Returns a dict of worker_type -> platform -> duration (ms), plus "total".
+    """
     worker_type_durations = {}
-    if os.path.exists(json_file):
-        with open(json_file) as infile:
-            worker_type_durations = json.load(infile)
-    else:
-        conn = None
-        try:
-            db_params = db_config()
-            conn = psycopg2.connect(**db_params)
-        except psycopg2.Error:
-            print("I am unable to connect to the database")
-            sys.exit(1)
-
-        cur = conn.cursor()
+    if rollup:
         query = (
-            "SELECT worker_type, platform, SUM(duration) AS total_time \
-                FROM tasks \
-                WHERE DATE_PART('year', created) = %d AND DATE_PART('month', created) = %d \
-                AND provisioner IN ( \
-                  'app-services-1', \
-                  'app-services-3', \
-                  'aws-provisioner-v1', \
-                  'ci-1',\
-                  'comm-1', \
-                  'comm-3', \
-                  'comm-t', \
-                  'gecko-1', \
-                  'gecko-2', \
-                  'gecko-3', \
-                  'gecko-t', \
-                  'mobile-1', \
-                  'mobile-3', \
-                  'mozillaonline-3', \
-                  'mpd001-3', \
-                  'nss-1', \
-                  'nss-3', \
-                  'infra', \
-                  'l10n-3', \
-                  'pmoore-test', \
-                  'project-relman', \
-                  'releng-3', \
-                  'releng-t', \
-                  'sandbox-1', \
-                  'scriptworker-prov-v1', \
-                  'taskcluster-imaging', \
-                  'taskgraph-1', \
-                  'taskgraph-3', \
-                  'taskgraph-t', \
-                  'xpi-1', \
-                  'xpi-3' \
-                ) \
-                AND started IS NOT NULL \
+            "SELECT worker_type, platform, SUM(started_duration) AS total_time \
+                FROM tasks_monthly_rollup \
+                WHERE year = %s AND month = %s \
+                AND grain = 'detail' \
+                AND provisioner = ANY(%s) \
                 GROUP BY worker_type, platform \
+                HAVING SUM(started_duration) IS NOT NULL \
                 ORDER BY worker_type ASC, platform ASC, total_time DESC"
-            % (year, month)
         )
-        cur.execute(query)
-        records = cur.fetchall()
-        for record in records:
-            if record:
-                worker_type = record[0]
-                platform = record[1]
-                if not platform:
-                    if worker_type.endswith("andrcmp"):
-                        platform = "Components"
-                    else:
-                        platform = "None"
-                duration_ms = record[2]
-                if worker_type not in worker_type_durations:
-                    worker_type_durations[worker_type] = {}
-                    worker_type_durations[worker_type]["total"] = 0
-                worker_type_durations[worker_type][platform] = duration_ms
-                worker_type_durations[worker_type]["total"] += duration_ms
-
-        cur.close()
-        conn.close()
+        params = (year, month, PROVISIONERS)
+        version = rollup_version((year, month))
+    else:
+        query = WORKER_TYPE_DURATIONS_QUERY
+        month_start, month_end = month_range(year, month)
+        params = (month_start, month_end, PROVISIONERS)
+        version = None
+    records = result_cache.cached_fetchall(
+        "platform_costs",
+        query,
+        params,
+        version=version,
+        range_end=month_range(year, month)[1],
+    )
+    add_worker_type_durations(worker_type_durations, records)
 
     return worker_type_durations
 
 
 @timeit
-def generate_csv_output(platform_buckets, use_header=False):
-    output = []
-    csv_header = [
-        "Bucket",
-        "Worker Type",
-        "Platform",
-        "Cost ($)",
-        "Duration (msecs)",
-        "Duration (hours)",
-        "Year",
-        "Month",
-        "YYYY-MM",
-        "Product",
-        "Provider",
-        "Worker Pool ID"
-    ]
-    if use_header:
-        output.append(csv_header)
-    for bucket in sorted(
-          platform_buckets,
-          key=lambda x: (platform_buckets[x]["bucket_cost"]),
-          reverse=True):
-        for worker_type in sorted(
-              platform_buckets[bucket]["worker_types"],
-              key=lambda y: (platform_buckets[bucket]["worker_types"][y]["cost"]),
-              reverse=True):
-            for p in platform_buckets[bucket]["worker_types"][worker_type]["platforms"]:
-                if p != "total":
-                    output.append(
-                        [
-                            bucket,
-                            worker_type,
-                            p,
-                            platform_buckets[bucket]["worker_types"][worker_type]["platforms"][p]["cost"],
-                            platform_buckets[bucket]["worker_types"][worker_type]["platforms"][p]["msecs"],
-                            round(float(platform_buckets[bucket]["worker_types"][worker_type]["platforms"][p]["msecs"]
-                                        / 1000 / 60 / 60), 2),
-                            year,
-                            month,
-                            # '{0:d}-{1:02d}'.format(year, month)
-                            '',
-                            '',
-                            '',
-
-                        ]
-                    )
+def get_worker_type_durations_by_month(months, rollup=True):
+    """ Like get_worker_type_durations(), but for every (year, month) in months from
+        a single query. Returns a dict of "YYYY-MM" -> worker type durations.
+    """
+    (first_year, first_month), (last_year, last_month) = months[0], months[-1]
+    if rollup:
+        query = (
+            "SELECT year, month, worker_type, platform, SUM(started_duration) AS total_time \
+                FROM tasks_monthly_rollup \
+                WHERE (year, month) >= (%s, %s) AND (year, month) <= (%s, %s) \
+                AND grain = 'detail' \
+                AND provisioner = ANY(%s) \
+                GROUP BY year, month, worker_type, platform \
+                HAVING SUM(started_duration) IS NOT NULL \
+                ORDER BY year, month, worker_type ASC, platform ASC, total_time DESC"
+        )
+        params = (first_year, first_month, last_year, last_month, PROVISIONERS)
+        version = rollup_version(months[0], months[-1])
+    else:
+        query = (
+            "SELECT DATE_PART('year', month_start)::int, DATE_PART('month', month_start)::int, \
+                worker_type, platform, total_time \
+                FROM ( \
+                    SELECT date_trunc('month', created) AS month_start, worker_type, platform, \
+                        SUM(duration) AS total_time \
+                    FROM tasks \
+                    WHERE created >= %s AND created < %s \
+                    AND provisioner = ANY(%s) \
+                    AND started IS NOT NULL \
+                    GROUP BY date_trunc('month', created), worker_type, platform \
+                ) AS monthly \
+                ORDER BY month_start, worker_type ASC, platform ASC, total_time DESC"
+        )
+        params = (
+            month_range(first_year, first_month)[0],
+            month_range(last_year, last_month)[1],
+            PROVISIONERS,
+        )
+        version = None
+    records = result_cache.cached_fetchall(
+        "platform_costs",
+        query,
+        params,
+        version=version,
+        range_end=month_range(last_year, last_month)[1],
+    )
+    worker_type_durations_by_month = {}
+    for record in records:
+        month = "{}-{:0>2}".format(record[0], record[1])
+        add_worker_type_durations(
+            worker_type_durations_by_month.setdefault(month, {}), [record[2:]]
+        )
+    return worker_type_durations_by_month
+
+
+def add_worker_type_durations(worker_type_durations, records):
+    for record in records:
+        if record:
+            worker_type = record[0]
+            platform = record[1]
+            if not platform:
+                if worker_type.endswith("andrcmp"):
+                    platform = "Components"
+                else:
+                    platform = "None"
+            duration_ms = record[2]
+            if worker_type not in worker_type_durations:
+                worker_type_durations[worker_type] = {}
+                worker_type_durations[worker_type]["total"] = 0
+            worker_type_durations[worker_type][platform] = duration_ms
+            worker_type_durations[worker_type]["total"] += duration_ms
+
+
+@timeit
+def build_platform_costs(worker_types, worker_type_durations):
+    return platform_aggregation.aggregate(
+        worker_types, worker_type_durations, get_bucket_for_db_platform
+    )
+
+
+def write_csv(csv_filename, output):
+    tmp_filename = csv_filename + ".tmp"
+    with open(tmp_filename, "w") as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter=",")
+        csvwriter.writerows(output)
+    os.replace(tmp_filename, csv_filename)
+
+
+def write_outputs(platform_costs, year, month, verbose=False, write_json=False):
+    """ Writes the month's CSV (and JSON) to DATA_DIR. Returns the CSV rows.
+    """
+    output = platform_aggregation.csv_rows(platform_costs, year, month)
+    if verbose:
+        print(platform_aggregation.render_text(platform_costs))
+    basename = os.path.join(DATA_DIR, "platform_costs_{}-{:0>2}".format(year, month))
+    write_csv(basename + ".csv", output)
+    if write_json:
+        result_cache.write_json_atomic(
+            basename + ".json",
+            platform_aggregation.to_json(platform_costs, year, month),
+            indent=2,
+        )
     return output
 
 
+def get_months(startdate, enddate):
+    """ Returns the (year, month) pairs covered by [startdate, enddate). Like Cost
+        Explorer, enddate is exclusive.
+    """
+    first_day = datetime.strptime(startdate, "%Y-%m-%d")
+    last_day = datetime.strptime(enddate, "%Y-%m-%d") - timedelta(days=1)
+    months = []
+    year, month = first_day.year, first_day.month
+    while (year, month) <= (last_day.year, last_day.month):
+        months.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+@timeit
+def process_months(
+    client, startdate, enddate, raw=False, verbose=False, combined_csv=None, write_json=False
+):
+    """ Writes the platform costs CSV for every month between startdate and enddate
+        from one Cost Explorer request per dimension and one durations query for the
+        whole range.
+    """
+    months = get_months(startdate, enddate)
+    instance_types_by_month = get_instance_types_by_month(client, startdate, enddate)
+    worker_types_by_month = get_worker_types_by_month(
+        client, instance_types_by_month, startdate, enddate, WORKER_TYPE_TAG
+    )
+    # See comment for get_worker_types_transitional()
+    worker_types_by_month = get_worker_types_by_month(
+        client,
+        instance_types_by_month,
+        startdate,
+        enddate,
+        NAME_TAG,
+        worker_types_by_month,
+    )
+    rollup = all(use_rollup(year, month, raw) for year, month in months)
+    worker_type_durations_by_month = get_worker_type_durations_by_month(months, rollup)
+    db_session.close_pool()
+
+    combined = [CSV_HEADER]
+    for year, month in months:
+        key = "{}-{:0>2}".format(year, month)
+        platform_costs = build_platform_costs(
+            worker_types_by_month.get(key, {}),
+            worker_type_durations_by_month.get(key, {}),
+        )
+        if verbose:
+            print(key)
+            print("=======")
+        combined.extend(
+            write_outputs(platform_costs, year, month, verbose, write_json)
+        )
+    if combined_csv:
+        write_csv(combined_csv, combined)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -351,49 +534,132 @@ if __name__ == "__main__":
         action="store_true",
         help="Display verbose output (default:False)"
     )
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        help="Aggregate tasks directly instead of reading tasks_monthly_rollup",
+    )
+    parser.add_argument(
+        "--ce-jobs",
+        dest="ce_jobs",
+        type=int,
+        default=cost_explorer.DEFAULT_JOBS,
+        help="Number of concurrent Cost Explorer requests (default: %d)"
+        % cost_explorer.DEFAULT_JOBS,
+    )
+    parser.add_argument(
+        "--ce-record",
+        dest="ce_record",
+        type=str,
+        help="Save every Cost Explorer response to this JSON file (implies --refresh)",
+    )
+    parser.add_argument(
+        "--ce-replay",
+        dest="ce_replay",
+        type=str,
+        help="Answer Cost Explorer requests from a file written by --ce-record",
+    )
+    parser.add_argument(
+        "--by-month",
+        dest="by_month",
+        action="store_true",
+        help="Write a CSV for every month between --startdate and --enddate "
+        "(exclusive) using bulk requests",
+    )
+    parser.add_argument(
+        "--combined-csv",
+        dest="combined_csv",
+        type=str,
+        help="With --by-month, also write every month's rows to this CSV",
+    )
+    parser.add_argument(
+        "--buckets-config",
+        dest="buckets_config",
+        type=str,
+        help="Load the platform bucket table from this JSON or YAML file",
+    )
+    parser.add_argument(
+        "--json",
+        dest="write_json",
+        action="store_true",
+        help="Also write each month's breakdown as JSON next to its CSV",
+    )
+    result_cache.add_cache_arguments(parser)
+    profiling.add_profiling_arguments(parser)
+    plan_capture.add_explain_arguments(parser)
     parser.set_defaults(verbose=False)
 
     args = parser.parse_args()
+    profiling.configure_from_args(args)
+    plan_capture.configure_from_args(args)
     if not is_valid_date(args.startdate):
         parser.print_help(sys.stderr)
         sys.exit(1)
     if not is_valid_date(args.enddate):
         parser.print_help(sys.stderr)
         sys.exit(2)
-    if args.startdate > args.enddate:
-        sys.stderr.write("Start date is later than end date")
+    if args.startdate >= args.enddate:
+        # Like Cost Explorer, the end date is exclusive, so equal dates are an empty
+        # range.
+        sys.stderr.write("End date must be later than start date\n")
         sys.exit(3)
+    if args.ce_record and args.ce_replay:
+        print("--ce-record and --ce-replay can't be used together")
+        sys.exit(4)
+    if args.combined_csv and not args.by_month:
+        print("--combined-csv requires --by-month")
+        sys.exit(5)
 
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
-    instance_types_file = os.path.join(
-        DATA_DIR, "instance_types_" + args.startdate + "_" + args.enddate + ".json"
-    )
-    worker_types_file = os.path.join(
-        DATA_DIR, "worker_types_" + args.startdate + "_" + args.enddate + ".json"
-    )
-    worker_type_durations_file = os.path.join(
-        DATA_DIR,
-        "worker_type_durations_" + args.startdate + "_" + args.enddate + ".json",
-    )
+    if args.ce_record:
+        # Cached responses would never reach the recording client.
+        args.refresh_cache = True
+    result_cache.configure_from_args(args)
+    if args.buckets_config:
+        classifier = bucket_classifier.BucketClassifier(
+            bucket_classifier.load_buckets(args.buckets_config)
+        )
 
     first_day = datetime.strptime(args.startdate, "%Y-%m-%d")
     year = int(first_day.strftime("%Y"))
     month = int(first_day.strftime("%m"))
 
-    instance_types = get_instance_types(
-        instance_types_file, args.startdate, args.enddate
-    )
+    if args.ce_replay:
+        client = cost_explorer.ReplayClient(args.ce_replay)
+    else:
+        client = boto3.client("ce")
+        if args.ce_record:
+            client = cost_explorer.RecordingClient(client, args.ce_record)
+
+    if args.by_month:
+        process_months(
+            client,
+            args.startdate,
+            args.enddate,
+            args.raw,
+            args.verbose,
+            args.combined_csv,
+            args.write_json,
+        )
+        if args.ce_record:
+            client.save()
+        sys.exit(0)
+
+    instance_types = get_instance_types(client, args.startdate, args.enddate)
     worker_types, instance_types = get_worker_types(
-        worker_types_file, instance_types, args.startdate, args.enddate
+        client, instance_types, args.startdate, args.enddate, args.ce_jobs
     )
     # See comment for get_worker_types_transitional()
     worker_types, instance_types = get_worker_types_transitional(
-        worker_types, instance_types, args.startdate, args.enddate
+        client, worker_types, instance_types, args.startdate, args.enddate, args.ce_jobs
     )
+    if args.ce_record:
+        client.save()
     worker_type_durations = get_worker_type_durations(
-        worker_type_durations_file, year, month
+        year, month, use_rollup(year, month, args.raw)
     )
+    db_session.close_pool()
 
     # calculate overhead
     for worker_type in worker_types:
@@ -415,166 +681,5 @@ if __name__ == "__main__":
     # for worker_type in sorted(worker_types, key=lambda x: (worker_types[x]['cost']), reverse=True):
     #    print("worker type: %s - cost: $%.2f" % (worker_type, worker_types[worker_type]['cost']))
 
-    # Calculate cost per platforms by bucket
-    platform_buckets = {}
-    for worker_type in worker_type_durations:
-        for platform in worker_type_durations[worker_type]:
-            bucket = get_bucket_for_db_platform(worker_type, platform)
-            if bucket not in platform_buckets:
-                platform_buckets[bucket] = {}
-                platform_buckets[bucket]["bucket_msecs"] = 0
-                platform_buckets[bucket]["bucket_cost"] = 0
-                platform_buckets[bucket]["worker_types"] = {}
-            platform_buckets[bucket]["bucket_msecs"] += worker_type_durations[
-                worker_type
-            ][platform]
-            if worker_type not in platform_buckets[bucket]["worker_types"]:
-                platform_buckets[bucket]["worker_types"][worker_type] = {
-                    "platforms": {},
-                    "cost": 0,
-                    "msecs": 0,
-                }
-            platform_buckets[bucket]["worker_types"][worker_type][
-                "msecs"
-            ] += worker_type_durations[worker_type][platform]
-            if (
-                platform
-                not in platform_buckets[bucket]["worker_types"][worker_type][
-                    "platforms"
-                ]
-            ):
-                platform_buckets[bucket]["worker_types"][worker_type]["platforms"][
-                    platform
-                ] = {}
-                platform_buckets[bucket]["worker_types"][worker_type]["platforms"][
-                    platform
-                ]["msecs"] = 0
-            platform_buckets[bucket]["worker_types"][worker_type]["platforms"][
-                platform
-            ]["msecs"] += worker_type_durations[worker_type][platform]
-            if worker_type in worker_types:
-                platform_cost = (
-                    worker_type_durations[worker_type][platform]
-                    / worker_type_durations[worker_type]["total"]
-                    * worker_types[worker_type]["cost"]
-                )
-                # print(bucket, worker_type, platform,
-                #      worker_type_durations[worker_type][platform], ' / ',
-                #      worker_type_durations[worker_type]['total'], ' x ',
-                #      worker_types[worker_type]['cost'], ' = ',
-                #      platform_cost)
-            else:
-                platform_cost = 0
-            platform_buckets[bucket]["worker_types"][worker_type]["platforms"][
-                platform
-            ]["cost"] = platform_cost
-            platform_buckets[bucket]["worker_types"][worker_type][
-                "cost"
-            ] += platform_cost
-            platform_buckets[bucket]["bucket_cost"] += platform_cost
-
-    output = generate_csv_output(platform_buckets)
-
-    if args.verbose:
-        print("Platforms sorted by cost")
-        print("========================")
-        for bucket in sorted(
-            platform_buckets,
-            key=lambda x: (platform_buckets[x]["bucket_cost"]),
-            reverse=True,
-        ):
-            print(
-                "{0:<25s} ${1:>15,.2f}".format(
-                    bucket + ":", float(platform_buckets[bucket]["bucket_cost"])
-                )
-            )
-            for worker_type in sorted(
-                platform_buckets[bucket]["worker_types"],
-                key=lambda y: (platform_buckets[bucket]["worker_types"][y]["cost"]),
-                reverse=True,
-            ):
-                print(
-                    "\t{0:<25s} ${1:>15,.2f} (platforms: {2})".format(
-                        worker_type + ":",
-                        float(
-                            platform_buckets[bucket]["worker_types"][worker_type]["cost"]
-                        ),
-                        ", ".join(
-                            [
-                                p
-                                for p in platform_buckets[bucket]["worker_types"][
-                                    worker_type
-                                ]["platforms"]
-                                if p != "total"
-                            ]
-                        ),
-                    )
-                )
-            print("")
-
-        print("Platforms sorted by time")
-        print("========================")
-        for bucket in sorted(
-            platform_buckets,
-            key=lambda x: (platform_buckets[x]["bucket_msecs"]),
-            reverse=True,
-        ):
-            print(
-                "{0:<25s} {1:>15,.2f} hrs".format(
-                    bucket + ":",
-                    float(platform_buckets[bucket]["bucket_msecs"] / 1000 / 60 / 60),
-                )
-            )
-            for worker_type in sorted(
-                platform_buckets[bucket]["worker_types"],
-                key=lambda y: (platform_buckets[bucket]["worker_types"][y]["msecs"]),
-                reverse=True,
-            ):
-                print(
-                    "\t{0:<25s} {1:>15,.2f} hrs (platforms: {2})".format(
-                        worker_type + ":",
-                        float(
-                            platform_buckets[bucket]["worker_types"][worker_type]["msecs"]
-                            / 1000
-                            / 60
-                            / 60
-                        ),
-                        ", ".join(
-                            [
-                                p
-                                for p in platform_buckets[bucket]["worker_types"][
-                                    worker_type
-                                ]["platforms"]
-                                if p != "total"
-                            ]
-                        ),
-                    )
-                )
-            print("")
-        # pp.pprint(output)
-
-        # Double-check cost per platform bucket
-        # cost_check = 0
-        # for worker_type in platform_buckets['windows7']['worker_types']:
-        #     for platform in platform_buckets['windows7']['worker_types'][worker_type]['platforms']:
-        #         cost_check += platform_buckets['windows7']['worker_types'][worker_type]['platforms'][platform]['cost']
-        # print(platform_buckets['windows7']['bucket_cost'], cost_check)
-
-        # pp.pprint(platform_buckets)
-
-    csv_filename = os.path.join(
-        DATA_DIR, "platform_costs_{}-{:0>2}.csv".format(year, month)
-    )
-    with open(csv_filename, "w") as csvfile:
-        csvwriter = csv.writer(csvfile, delimiter=",")
-        csvwriter.writerows(output)
-
-    if not os.path.exists(instance_types_file):
-        with open(instance_types_file, "w") as outfile:
-            json.dump(instance_types, outfile)
-    if not os.path.exists(worker_types_file):
-        with open(worker_types_file, "w") as outfile:
-            json.dump(worker_types, outfile)
-    if not os.path.exists(worker_type_durations_file):
-        with open(worker_type_durations_file, "w") as outfile:
-            json.dump(worker_type_durations, outfile)
+    platform_costs = build_platform_costs(worker_types, worker_type_durations)
+    write_outputs(platform_costs, year, month, args.verbose, args.write_json)
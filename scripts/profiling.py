@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+""" Structured timing for the analysis scripts.
+
+    Work is recorded as nested spans: every report phase (a @timeit function, see
+    shared.py) and, inside it, every database execute and fetch, Cost Explorer or
+    push log request and result cache lookup, with attributes such as row counts
+    and bytes fetched:
+
+        with profiling.span("db.fetch", profiling.DB) as span:
+            rows = cur.fetchall()
+            span.set(rows=len(rows))
+
+    Spans are only kept once profiling has been enabled. Scripts wire up the
+    switches with add_profiling_arguments() and configure_from_args():
+        --trace FILE   write every span to FILE, as a Chrome trace (for
+                       chrome://tracing or Perfetto) if FILE ends in .json, else as
+                       JSON lines
+        --profile      also run cProfile and tracemalloc, and add their top
+                       functions and allocations to the summary and the trace
+
+    At exit a summary is printed of where the time went: the time spent in each
+    category of span (db, network, cache, python) excluding nested spans, and the
+    busiest spans, along with the peak RSS of the process. Report phases record
+    the peak RSS so far too, to show which phase grew it.
+"""
+
+import atexit
+import cProfile
+import itertools
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+from datetime import datetime
+
+DB = "db"
+NETWORK = "network"
+CACHE = "cache"
+PYTHON = "python"
+
+TOP_ENTRIES = 15
+
+_settings = {"enabled": False}
+_state = {
+    "started": None,
+    "trace": None,
+    "events": None,
+    "header": None,
+    "profiler": None,
+    "totals": {},
+    "threads": {},
+}
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+
+
+def add_profiling_arguments(parser):
+    parser.add_argument(
+        "--trace",
+        help="Write timing spans to this file: a Chrome trace if it ends in .json, "
+        "otherwise JSON lines",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Also profile with cProfile and tracemalloc, and summarize where the "
+        "time went at exit",
+    )
+
+
+def configure_from_args(args):
+    configure(args.trace, args.profile)
+
+
+def configure(trace=None, profile=False):
+    """ Enables profiling if a trace file or profile is requested. The trace is
+        finished and the summary printed at exit.
+    """
+    if _settings["enabled"] or not (trace or profile):
+        return
+    _state["started"] = time.perf_counter()
+    if trace:
+        directory = os.path.dirname(trace)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        _state["trace"] = open(trace, "w")
+        header = {
+            "type": "trace",
+            "started": datetime.now().isoformat(),
+            "argv": sys.argv,
+            "pid": os.getpid(),
+        }
+        if trace.endswith(".json"):
+            _state["events"] = []
+            _state["header"] = header
+        else:
+            _write(header)
+    if profile:
+        tracemalloc.start()
+        # cProfile only sees the main thread.
+        _state["profiler"] = cProfile.Profile()
+        _state["profiler"].enable()
+    _settings["enabled"] = True
+    atexit.register(finish)
+
+
+def enabled():
+    return _settings["enabled"]
+
+
+def peak_rss():
+    """ Returns the peak resident set size of this process so far, in bytes.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS.
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _thread_id():
+    ident = threading.get_ident()
+    threads = _state["threads"]
+    if ident not in threads:
+        with _lock:
+            name = threading.current_thread().name
+            threads.setdefault(ident, (len(threads) + 1, name))
+    return threads[ident][0]
+
+
+class Span(object):
+    """ A timed piece of work, used as a context manager. set() and add() attach
+        attributes such as row counts. Spans nest within the spans open on the same
+        thread.
+    """
+
+    def __init__(self, name, category=PYTHON, **args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.id = None
+        self.parent = None
+        self.start = None
+        self.duration = None
+        self.children = 0.0
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.args[key] = self.args.get(key, 0) + value
+
+    def __enter__(self):
+        stack = _stack()
+        if stack:
+            self.parent = stack[-1]
+        stack.append(self)
+        if _settings["enabled"]:
+            self.id = next(_ids)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self.start
+        _stack().pop()
+        if self.parent is not None:
+            self.parent.children += self.duration
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        if _settings["enabled"] and self.id is not None:
+            _record(self)
+        return False
+
+
+def span(name, category=PYTHON, **args):
+    return Span(name, category, **args)
+
+
+def approximate_size(rows):
+    """ A rough size in bytes of fetched rows: the length of string and bytes
+        values, and 8 bytes for any other value that isn't NULL.
+    """
+    size = 0
+    for row in rows:
+        for value in row:
+            if value is None:
+                continue
+            if isinstance(value, (str, bytes)):
+                size += len(value)
+            else:
+                size += 8
+    return size
+
+
+def _write(record):
+    _state["trace"].write(json.dumps(record, default=str) + "\n")
+
+
+def _record(span):
+    own = span.duration - span.children
+    thread = _thread_id()
+    with _lock:
+        totals = _state["totals"].setdefault(
+            span.name,
+            {"category": span.category, "count": 0, "total": 0.0, "self": 0.0},
+        )
+        totals["count"] += 1
+        totals["total"] += span.duration
+        totals["self"] += own
+        for key in ("rows", "bytes"):
+            if key in span.args:
+                totals[key] = totals.get(key, 0) + span.args[key]
+        if _state["trace"] is None:
+            return
+        start = span.start - _state["started"]
+        if _state["events"] is not None:
+            _state["events"].append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": round(start * 1000000, 1),
+                    "dur": round(span.duration * 1000000, 1),
+                    "pid": os.getpid(),
+                    "tid": thread,
+                    "args": span.args,
+                }
+            )
+        else:
+            _write(
+                {
+                    "type": "span",
+                    "name": span.name,
+                    "category": span.category,
+                    "id": span.id,
+                    "parent": span.parent.id if span.parent is not None else None,
+                    "thread": thread,
+                    "start": round(start, 6),
+                    "duration": round(span.duration, 6),
+                    "self": round(own, 6),
+                    "args": span.args,
+                }
+            )
+
+
+def _profile_summary():
+    """ Returns the top cProfile functions and tracemalloc allocations, if profiling.
+    """
+    profiler = _state["profiler"]
+    if profiler is None:
+        return None
+    profiler.disable()
+    stats = pstats.Stats(profiler).stats
+    functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+    summary = {
+        "functions": [
+            {
+                "function": "%s:%d(%s)" % key,
+                "calls": calls,
+                "total": round(total, 6),
+                "cumulative": round(cumulative, 6),
+            }
+            for key, (_, calls, total, cumulative, _) in functions[:TOP_ENTRIES]
+        ]
+    }
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        summary["allocated_bytes"] = current
+        summary["peak_allocated_bytes"] = peak
+        summary["allocations"] = [
+            {"location": str(stat.traceback), "bytes": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:TOP_ENTRIES]
+        ]
+    return summary
+
+
+def format_summary(wall, totals, profile=None, rss=None):
+    lines = ["Profile: %.2f s wall" % wall]
+    if rss is not None:
+        lines.append("Peak RSS: %.1f MB" % (rss / 1024.0 / 1024.0))
+    categories = {}
+    for entry in totals.values():
+        categories[entry["category"]] = (
+            categories.get(entry["category"], 0.0) + entry["self"]
+        )
+    for category, seconds in sorted(
+        categories.items(), key=lambda item: item[1], reverse=True
+    ):
+        lines.append("  {0:<16} {1:>10.2f} s".format(category, seconds))
+    outside = wall - sum(categories.values())
+    if outside > 0:
+        lines.append("  {0:<16} {1:>10.2f} s".format("outside spans", outside))
+
+    row_format = "{0:<40} {1:>8} {2:>10} {3:>10} {4:>14}"
+    lines.append("")
+    lines.append(row_format.format("Span", "Count", "Total (s)", "Self (s)", "Rows"))
+    for name, entry in sorted(
+        totals.items(), key=lambda item: item[1]["self"], reverse=True
+    )[:TOP_ENTRIES]:
+        lines.append(
+            row_format.format(
+                name[:40],
+                entry["count"],
+                "%.2f" % entry["total"],
+                "%.2f" % entry["self"],
+                "{:,}".format(entry["rows"]) if "rows" in entry else "-",
+            )
+        )
+    if profile:
+        lines.append("")
+        lines.append("{0:<70} {1:>12}".format("Function", "Cumul. (s)"))
+        for function in profile["functions"]:
+            lines.append(
+                "{0:<70} {1:>12.2f}".format(
+                    function["function"][-70:], function["cumulative"]
+                )
+            )
+        if "allocations" in profile:
+            lines.append("")
+            lines.append(
+                "Peak traced memory: %.1f MB"
+                % (profile["peak_allocated_bytes"] / 1024.0 / 1024.0)
+            )
+            for allocation in profile["allocations"][:5]:
+                lines.append(
+                    "  %-66s %10.1f KB"
+                    % (allocation["location"][-66:], allocation["bytes"] / 1024.0)
+                )
+    return "\n".join(lines)
+
+
+def finish():
+    """ Stops profiling, completes the trace and prints the summary.
+    """
+    if not _settings["enabled"]:
+        return
+    _settings["enabled"] = False
+    wall = time.perf_counter() - _state["started"]
+    rss = peak_rss()
+    profile = _profile_summary()
+    trace = _state["trace"]
+    if trace is not None:
+        if _state["events"] is not None:
+            events = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in _state["threads"].values()
+            ]
+            json.dump(
+                {
+                    "traceEvents": events + _state["events"],
+                    "displayTimeUnit": "ms",
+                    "otherData": dict(
+                        _state["header"], wall=wall, peak_rss=rss, profile=profile
+                    ),
+                },
+                trace,
+                default=str,
+            )
+        else:
+            _write({"type": "summary", "wall": round(wall, 6), "peak_rss": rss})
+            if profile:
+                _write(dict(profile, type="profile"))
+        trace.close()
+        _state["trace"] = None
+    print(format_summary(wall, _state["totals"], profile, rss))
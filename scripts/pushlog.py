@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+""" A local, incrementally updated copy of an hg push log.
+
+    Pushes and their changesets are kept in a SQLite database (one per repo under
+    PUSHLOG_DIR). sync() only asks hg.mozilla.org for pushes after the last push ID
+    already stored, a page of PAGE_SIZE pushes at a time over one pooled session,
+    and writes each page as it arrives. Pushes are indexed by date and by whether
+    they contain a merge, so merge_csets() for any date range is a local query.
+
+    A store is seeded from the date a report first asks for: the first sync only
+    fetches pushes from that date on, and later syncs fetch newer pushes, or
+    backfill older ones if an earlier date is asked for. sync() without a date
+    on an empty store reads the repo's whole push log.
+
+    Any server speaking json-pushes version 2 can be used instead of hg.mozilla.org.
+    For working offline, serve a fixture file (the "pushes" object of a version 2
+    response) locally and point --url at it:
+
+        ./pushlog.py --serve fixture.json --port 8000
+        ./pushlog.py --url http://localhost:8000 --sync
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+import profiling
+import requests
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from requests.adapters import HTTPAdapter
+from urllib.parse import parse_qs, urlparse
+from urllib3.util.retry import Retry
+
+DEFAULT_URL = "https://hg.mozilla.org"
+DEFAULT_REPO = "mozilla-central"
+PUSHLOG_DIR = "pushlog"
+
+PAGE_SIZE = 200
+TIMEOUT = 60
+MAX_RETRIES = 5
+
+MERGE_PREFIX = "Merge inbound"
+
+# json-pushes reads dates in the server's local time, so seed a little before the
+# requested date to be sure its first pushes are stored.
+SEED_MARGIN = timedelta(days=1)
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS pushes (
+        push_id INTEGER PRIMARY KEY,
+        date INTEGER NOT NULL,
+        user TEXT,
+        has_merge INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS changesets (
+        node TEXT NOT NULL,
+        push_id INTEGER NOT NULL REFERENCES pushes (push_id),
+        position INTEGER NOT NULL,
+        description TEXT,
+        is_merge INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (push_id, position)
+    );
+    CREATE INDEX IF NOT EXISTS pushes_date ON pushes (date);
+    CREATE INDEX IF NOT EXISTS pushes_merge_date ON pushes (has_merge, date);
+    CREATE INDEX IF NOT EXISTS changesets_node ON changesets (node);
+    CREATE TABLE IF NOT EXISTS sync_state (
+        synced_after INTEGER NOT NULL
+    );
+"""
+
+
+def is_merge(description):
+    return (description or "").startswith(MERGE_PREFIX)
+
+
+def default_db_path(repo=DEFAULT_REPO):
+    return os.path.join(PUSHLOG_DIR, "%s.db" % repo)
+
+
+def new_session():
+    """ A session that reuses its connection between pages and retries transient
+        server errors.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=1,
+        status_forcelist=(500, 502, 503, 504),
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class PushlogClient(object):
+    """ Reads pages of a repo's json-pushes (version 2) feed.
+    """
+
+    def __init__(self, url=DEFAULT_URL, repo=DEFAULT_REPO, session=None):
+        self.url = "%s/%s/json-pushes" % (url.rstrip("/"), repo)
+        self.session = session or new_session()
+
+    def _get(self, params):
+        params = dict(params, version=2)
+        with profiling.span("pushlog.get", profiling.NETWORK, **params) as span:
+            resp = self.session.get(self.url, params=params, timeout=TIMEOUT)
+            span.set(status=resp.status_code, bytes=len(resp.content))
+            resp.raise_for_status()
+            return resp.json()
+
+    def last_push_id(self):
+        # An empty range still reports the newest push ID.
+        return int(self._get({"startID": 0, "endID": 0})["lastpushid"])
+
+    def push_id_before(self, ts):
+        """ Returns the ID of the last push before ts, i.e. the after_id for pages()
+            to start from. The window searched grows until it finds a push, or runs
+            past now, in which case there are no pushes after ts yet.
+        """
+        window = timedelta(days=1)
+        while True:
+            end_ts = ts + window
+            data = self._get(
+                {
+                    "startdate": ts.strftime(DATE_FORMAT),
+                    "enddate": end_ts.strftime(DATE_FORMAT),
+                }
+            )
+            pushes = data.get("pushes", {})
+            if pushes:
+                return min(int(push_id) for push_id in pushes) - 1
+            if end_ts >= datetime.utcnow():
+                return int(data["lastpushid"])
+            window *= 2
+
+    def pages(self, after_id, last_id, page_size=PAGE_SIZE):
+        """ Yields lists of (push_id, push) for the pushes after after_id up to
+            last_id, in push ID order, page_size pushes per request.
+        """
+        start = after_id
+        while start < last_id:
+            end = min(start + page_size, last_id)
+            # startID is exclusive and endID inclusive.
+            data = self._get({"full": 1, "startID": start, "endID": end})
+            pushes = data.get("pushes", {})
+            yield sorted((int(push_id), push) for push_id, push in pushes.items())
+            start = end
+
+
+class PushlogStore(object):
+    def __init__(self, filename):
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def last_push_id(self):
+        row = self.conn.execute("SELECT MAX(push_id) FROM pushes").fetchone()
+        return row[0] or 0
+
+    def synced_after(self):
+        """ Returns the push ID after which every push is stored, or None for an
+            empty store. Stores from before sync_state was kept hold the whole log.
+        """
+        row = self.conn.execute("SELECT synced_after FROM sync_state").fetchone()
+        if row:
+            return row[0]
+        return 0 if self.last_push_id() else None
+
+    def set_synced_after(self, push_id):
+        with self.conn:
+            self.conn.execute("DELETE FROM sync_state")
+            self.conn.execute(
+                "INSERT INTO sync_state (synced_after) VALUES (?)", (push_id,)
+            )
+
+    def first_push_date(self):
+        row = self.conn.execute("SELECT MIN(date) FROM pushes").fetchone()
+        return row[0]
+
+    def add_pushes(self, pushes):
+        """ Stores a page of (push_id, push) pairs in one transaction.
+        """
+        with self.conn:
+            for push_id, push in pushes:
+                changesets = push.get("changesets", [])
+                merges = [is_merge(cset.get("desc")) for cset in changesets]
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO pushes (push_id, date, user, has_merge) \
+                        VALUES (?, ?, ?, ?)",
+                    (push_id, push["date"], push.get("user"), int(any(merges))),
+                )
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO changesets \
+                        (node, push_id, position, description, is_merge) \
+                        VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (cset["node"], push_id, position, cset.get("desc"), int(merge))
+                        for position, (cset, merge) in enumerate(
+                            zip(changesets, merges)
+                        )
+                    ],
+                )
+
+    def _fetch(self, client, after_id, last_id):
+        added = 0
+        for page in client.pages(after_id, last_id):
+            self.add_pushes(page)
+            added += len(page)
+        return added
+
+    def sync(self, client, since=None):
+        """ Fetches and stores every push newer than the last one stored, and with
+            since (a datetime), every push from since on that isn't stored yet. An
+            empty store synced without since fetches the whole push log. Returns the
+            number of pushes added.
+        """
+        synced_after = self.synced_after()
+        added = 0
+        if since is not None and synced_after != 0:
+            first_date = self.first_push_date()
+            if first_date is None or first_date > _to_epoch(since):
+                since_id = client.push_id_before(since - SEED_MARGIN)
+                if synced_after is None:
+                    synced_after = since_id
+                elif since_id < synced_after:
+                    added += self._fetch(client, since_id, synced_after)
+                    synced_after = since_id
+                self.set_synced_after(synced_after)
+        after_id = max(self.last_push_id(), synced_after or 0)
+        added += self._fetch(client, after_id, client.last_push_id())
+        return added
+
+    def merge_csets(self, start_ts, end_ts):
+        """ Returns the merge changesets pushed in [start_ts, end_ts), in push order.
+        """
+        rows = self.conn.execute(
+            "SELECT c.node \
+                FROM pushes p \
+                JOIN changesets c ON c.push_id = p.push_id \
+                WHERE p.has_merge = 1 \
+                AND p.date >= ? \
+                AND p.date < ? \
+                AND c.is_merge = 1 \
+                ORDER BY p.push_id, c.position",
+            (_to_epoch(start_ts), _to_epoch(end_ts)),
+        )
+        return [row[0] for row in rows]
+
+
+def _to_epoch(ts):
+    return int((ts - datetime(1970, 1, 1)).total_seconds())
+
+
+def get_merge_csets(
+    first_day, last_day, repo=DEFAULT_REPO, url=DEFAULT_URL, db=None, sync=True
+):
+    """ Returns the merge changesets pushed between first_day and last_day
+        ("YYYY-MM-DD", both inclusive, UTC), syncing the local store first.
+    """
+    store = PushlogStore(db or default_db_path(repo))
+    try:
+        start = datetime.strptime(first_day, "%Y-%m-%d")
+        end = datetime.strptime(last_day, "%Y-%m-%d") + timedelta(days=1)
+        if sync:
+            added = store.sync(PushlogClient(url, repo), since=start)
+            print("Added %d pushes to the %s push log" % (added, repo))
+        return store.merge_csets(start, end)
+    finally:
+        store.close()
+
+
+def fixture_handler(pushes):
+    """ Returns a request handler answering json-pushes version 2 requests for any
+        repo from pushes, a dict of push ID -> push.
+    """
+    pushes = {int(push_id): push for push_id, push in pushes.items()}
+    last_id = max(pushes) if pushes else 0
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            request = urlparse(self.path)
+            if not request.path.endswith("/json-pushes"):
+                self.send_error(404)
+                return
+            query = parse_qs(request.query)
+            start = int(query.get("startID", [0])[0])
+            end = int(query.get("endID", [last_id])[0])
+            full = query.get("full", ["0"])[0] == "1"
+            dates = [
+                _to_epoch(datetime.strptime(query[param][0], DATE_FORMAT))
+                if param in query
+                else None
+                for param in ("startdate", "enddate")
+            ]
+            page = {}
+            for push_id in range(start + 1, end + 1):
+                if push_id not in pushes:
+                    continue
+                date = pushes[push_id]["date"]
+                if dates[0] is not None and date < dates[0]:
+                    continue
+                if dates[1] is not None and date > dates[1]:
+                    continue
+                push = dict(pushes[push_id])
+                if not full:
+                    push["changesets"] = [c["node"] for c in push.get("changesets", [])]
+                page[str(push_id)] = push
+            body = json.dumps({"lastpushid": last_id, "pushes": page}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return FixtureHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--repo", help="Repository (default: %(default)s)", default=DEFAULT_REPO
+    )
+    parser.add_argument(
+        "--url", help="Push log server (default: %(default)s)", default=DEFAULT_URL
+    )
+    parser.add_argument(
+        "--db", help="Push log database (default: %s)" % default_db_path("<repo>")
+    )
+    parser.add_argument(
+        "--sync", help="Fetch pushes newer than the last stored push", action="store_true"
+    )
+    parser.add_argument(
+        "--since",
+        help="With --sync, also fetch pushes from this date on, format=YYYY-MM-DD "
+        "(an empty store otherwise fetches the whole push log)",
+        type=str,
+    )
+    parser.add_argument(
+        "--merges",
+        help='List merge changesets for a daterange, format="YYYY-MM-DD to YYYY-MM-DD"',
+        type=str,
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="FIXTURE",
+        help="Serve the pushes in a JSON fixture file instead of syncing",
+    )
+    parser.add_argument(
+        "--port", help="Port for --serve (default: %(default)s)", type=int, default=8000
+    )
+    args = parser.parse_args()
+
+    if args.serve:
+        with open(args.serve) as infile:
+            fixture = json.load(infile)
+        server = HTTPServer(("localhost", args.port), fixture_handler(fixture))
+        print("Serving %d pushes on http://localhost:%d" % (len(fixture), args.port))
+        server.serve_forever()
+
+    if not args.sync and not args.merges:
+        print("Nothing to do, pass --sync and/or --merges")
+        sys.exit(1)
+
+    db = args.db or default_db_path(args.repo)
+    if args.sync:
+        since = datetime.strptime(args.since, "%Y-%m-%d") if args.since else None
+        store = PushlogStore(db)
+        added = store.sync(PushlogClient(args.url, args.repo), since)
+        store.close()
+        print("Added %d pushes to %s" % (added, db))
+    if args.merges:
+        first_day, last_day = args.merges.split(" to ")
+        for node in get_merge_csets(
+            first_day, last_day, args.repo, args.url, db, sync=False
+        ):
+            print(node)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+""" Helpers for reading PostgreSQL EXPLAIN (FORMAT JSON) plans.
+
+    explain() runs EXPLAIN on a query, and scans() flattens a plan into the scans
+    of tables it contains, so callers can check how a report reads tasks:
+
+        plan = query_plans.explain(cur, query, params)
+        for scan in query_plans.scans(plan):
+            print(scan["node"], scan["relation"], scan["index"])
+"""
+
+import itertools
+import json
+
+SEQ_SCAN = "Seq Scan"
+INDEX_ONLY_SCAN = "Index Only Scan"
+# Scans that read rows from the table itself.
+HEAP_SCANS = ("Seq Scan", "Index Scan", "Bitmap Heap Scan", "Tid Scan")
+
+# next() on a count is atomic, so threads sharing it still get distinct names.
+_statement_ids = itertools.count(1)
+
+
+def explain(cur, query, params=None, analyze=False, buffers=False):
+    """ Returns the JSON plan of query. With analyze, the query is executed, so run
+        statements that write inside a transaction that is rolled back.
+
+        Queries written with $1, $2, ... placeholders are PREPAREd under a name of
+        their own and EXPLAINed through EXECUTE.
+    """
+    options = ["FORMAT JSON"]
+    if analyze:
+        options.insert(0, "ANALYZE")
+        if buffers:
+            options.insert(1, "BUFFERS")
+    prefix = "EXPLAIN (%s) " % ", ".join(options)
+    if "$1" in query:
+        name = "query_plans_explain_%d" % next(_statement_ids)
+        cur.execute("PREPARE %s AS %s" % (name, query))
+        placeholders = ", ".join(["%s"] * len(params or ()))
+        cur.execute(prefix + "EXECUTE %s (%s)" % (name, placeholders), params)
+        result = cur.fetchone()[0]
+        # If EXECUTE fails the transaction is aborted and DEALLOCATE would fail too,
+        # hiding the error. The statement then stays prepared until the connection
+        # closes, but its name is never reused.
+        cur.execute("DEALLOCATE %s" % name)
+    else:
+        cur.execute(prefix + query, params)
+        result = cur.fetchone()[0]
+    # psycopg2 decodes json columns, but EXPLAIN returns text on some versions.
+    if isinstance(result, str):
+        result = json.loads(result)
+    return result[0]
+
+
+def nodes(plan):
+    """ Yields every node of a plan, depth first.
+    """
+    stack = [plan.get("Plan", plan)]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.get("Plans", [])))
+
+
+def scans(plan):
+    """ Returns a dict per table scan in plan: node type, relation, index, filter,
+        estimated rows, and with ANALYZE actual rows and heap fetches.
+    """
+    result = []
+    for node in nodes(plan):
+        if "Relation Name" not in node:
+            continue
+        result.append(
+            {
+                "node": node["Node Type"],
+                "relation": node["Relation Name"],
+                "index": node.get("Index Name"),
+                "filter": node.get("Filter"),
+                "plan_rows": node.get("Plan Rows"),
+                "actual_rows": node.get("Actual Rows"),
+                "heap_fetches": node.get("Heap Fetches"),
+            }
+        )
+    return result
+
+
+def is_tasks(relation):
+    """ Whether relation is tasks or one of its partitions.
+    """
+    if relation in ("tasks", "tasks_default"):
+        return True
+    return relation.startswith("tasks_") and relation[6:].isdigit()
+
+
+def is_heap_scan(scan):
+    return scan["node"] in HEAP_SCANS or bool(scan["heap_fetches"])
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+""" refresh_rollup.py
+
+    Maintains tasks_monthly_rollup (see postgres/monthly_rollup.sql), the
+    per-month aggregates that monthly_tc_stats.py, cost_per_push.py and
+    platform_costs.py report from.
+
+    By default only months containing tasks whose `modified` timestamp is newer
+    than the last incremental or full refresh are recomputed. Use --month to force a
+    single month, or --full to rebuild every month in the tasks table. --month
+    doesn't move the watermark the next incremental refresh starts from.
+"""
+
+import argparse
+import sys
+
+import db_session
+import plan_capture
+import profiling
+
+from datetime import datetime
+from shared import log_ts, month_range, timeit
+
+# Rows are stamped with the start time of the transaction that wrote them, so a
+# transaction that was still in flight when the last refresh started can commit rows
+# that are older than that refresh. Re-check a little further back to catch them.
+REFRESH_OVERLAP = "10 minutes"
+
+ROLLUP_QUERY = (
+    "INSERT INTO tasks_monthly_rollup \
+        (year, month, grain, project, provisioner, worker_type, platform, state, \
+         num_tasks, total_duration, started_duration, num_revisions, num_workers) \
+    SELECT %(year)s, %(month)s, \
+        CASE GROUPING(project, provisioner, worker_type, platform, state) \
+            WHEN 0 THEN 'detail' \
+            WHEN 15 THEN 'project' \
+            ELSE 'month' \
+        END, \
+        project, provisioner, worker_type, platform, state, \
+        COUNT(*), \
+        SUM(duration), \
+        SUM(duration) FILTER (WHERE started IS NOT NULL), \
+        COUNT(DISTINCT revision), \
+        COUNT(DISTINCT worker_id) \
+    FROM tasks \
+    WHERE created >= %(start)s \
+    AND created < %(end)s \
+    GROUP BY GROUPING SETS ( \
+        (project, provisioner, worker_type, platform, state), \
+        (project), \
+        () \
+    )"
+)
+
+
+def is_month_rolled_up(year, month):
+    row = db_session.fetchone(
+        "SELECT refreshed FROM tasks_monthly_rollup_refreshes WHERE year = %s AND month = %s",
+        (year, month),
+    )
+    return row is not None
+
+
+def rollup_version(first, last=None):
+    """ Returns when the most recently refreshed month from first to last ((year,
+        month) pairs, last defaults to first) was rolled up, as a string, for result
+        cache keys (see result_cache.py). None if none of them have been.
+    """
+    last = last or first
+    row = db_session.fetchone(
+        "SELECT MAX(refreshed) FROM tasks_monthly_rollup_refreshes \
+            WHERE (year, month) >= (%s, %s) AND (year, month) <= (%s, %s)",
+        tuple(first) + tuple(last),
+    )
+    return str(row[0]) if row and row[0] else None
+
+
+def use_rollup(year, month, raw=False):
+    """ Returns True if reports for a month should read from the rollup, i.e. raw wasn't
+        requested and the month has been rolled up.
+    """
+    if raw:
+        return False
+    if not is_month_rolled_up(year, month):
+        print(
+            "No rollup for %d-%02d, run refresh_rollup.py. Querying tasks instead."
+            % (year, month)
+        )
+        return False
+    return True
+
+
+def get_watermark():
+    """ Returns when the last incremental or full refresh started. Installs that
+        predate the watermark table fall back to the oldest month's refresh, which
+        may recompute a few months too many but never misses one.
+    """
+    row = db_session.fetchone("SELECT scanned FROM tasks_monthly_rollup_watermark")
+    if row:
+        return row[0]
+    row = db_session.fetchone("SELECT MIN(refreshed) FROM tasks_monthly_rollup_refreshes")
+    return row[0] if row else None
+
+
+def set_watermark(scanned):
+    with db_session.cursor() as cur:
+        cur.execute(
+            "INSERT INTO tasks_monthly_rollup_watermark (id, scanned) VALUES (true, %s) \
+                ON CONFLICT (id) DO UPDATE SET scanned = EXCLUDED.scanned",
+            (scanned,),
+        )
+
+
+def get_now():
+    return db_session.fetchone("SELECT NOW()")[0]
+
+
+@timeit
+def get_changed_months(watermark):
+    """ Returns the (year, month) pairs with tasks modified since watermark, or every
+        month if the rollup has never been refreshed.
+    """
+    if watermark:
+        query = (
+            "SELECT DISTINCT DATE_PART('year', created)::int, DATE_PART('month', created)::int \
+                FROM tasks \
+                WHERE modified > %%s - interval '%s'" % REFRESH_OVERLAP
+        )
+        rows = db_session.fetchall(query, (watermark,))
+    else:
+        rows = get_all_months()
+    return sorted((year, month) for year, month in rows)
+
+
+def get_all_months():
+    query = (
+        "SELECT DISTINCT DATE_PART('year', created)::int, DATE_PART('month', created)::int \
+            FROM tasks"
+    )
+    return db_session.fetchall(query)
+
+
+@timeit
+def refresh_month(year, month):
+    """ Recomputes the rollup rows for one month in a single transaction.
+    """
+    month_start, month_end = month_range(year, month)
+    params = {"year": year, "month": month, "start": month_start, "end": month_end}
+    with db_session.cursor() as cur:
+        # Take the timestamp before aggregating, so that rows modified while we run
+        # are picked up by the next refresh.
+        cur.execute("SELECT NOW()")
+        refreshed = cur.fetchone()[0]
+        cur.execute(
+            "DELETE FROM tasks_monthly_rollup WHERE year = %(year)s AND month = %(month)s",
+            params,
+        )
+        cur.execute(ROLLUP_QUERY, params)
+        num_rows = cur.rowcount
+        cur.execute(
+            "INSERT INTO tasks_monthly_rollup_refreshes (year, month, refreshed) \
+                VALUES (%s, %s, %s) \
+                ON CONFLICT ON CONSTRAINT dup_rollup_month DO UPDATE \
+                SET refreshed = EXCLUDED.refreshed",
+            (year, month, refreshed),
+        )
+    return num_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--month", help="Only refresh this month, format: YYYY-MM", type=str
+    )
+    parser.add_argument(
+        "--full", help="Refresh every month in the tasks table", action="store_true"
+    )
+    profiling.add_profiling_arguments(parser)
+    plan_capture.add_explain_arguments(parser)
+    args = parser.parse_args()
+    profiling.configure_from_args(args)
+    plan_capture.configure_from_args(args)
+
+    if args.month:
+        try:
+            parsed = datetime.strptime(args.month, "%Y-%m")
+        except ValueError:
+            print("ERROR: unable to parse month")
+            sys.exit(1)
+        months = [(parsed.year, parsed.month)]
+        scanned = None
+    else:
+        # Taken before looking for changes, so rows modified while we run are picked
+        # up by the next refresh.
+        scanned = get_now()
+        if args.full:
+            months = sorted((year, month) for year, month in get_all_months())
+        else:
+            months = get_changed_months(get_watermark())
+
+    if not months:
+        print("[%s] Rollup is up to date" % log_ts())
+    for year, month in months:
+        print("[%s] Refreshing %d-%02d..." % (log_ts(), year, month))
+        num_rows = refresh_month(year, month)
+        print("[%s] Wrote %d rollup rows for %d-%02d" % (log_ts(), num_rows, year, month))
+    if scanned is not None:
+        set_watermark(scanned)
+
+    db_session.close_pool()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+""" Shared on-disk result cache for the report scripts.
+
+    Entries are keyed on a hash of the query text (SQL, a Cost Explorer request, a
+    URL, ...), its parameters and CACHE_VERSION, and stored as one JSON file per
+    entry under CACHE_DIR/<namespace>/. Writes are atomic (temp file + rename), so a
+    crashed run never leaves a half-written entry behind, and entries older than
+    their TTL are recomputed.
+
+    Results can't go stale within their TTL: callers pass a version that changes
+    whenever the underlying data does (e.g. when the rollup was last refreshed),
+    which becomes part of the key, and the end of the time range a query covers
+    (range_end). Ranges that end less than SETTLE_TIME ago, e.g. the current month,
+    are still changing, so their results are never cached.
+
+    Scripts wire up the standard switches with add_cache_arguments() and
+    configure_from_args():
+        --no-cache   neither read nor write the cache
+        --refresh    recompute everything and overwrite the cached entries
+        --cache-ttl  seconds before an entry is recomputed; 0 recomputes every
+                     entry and evicts the old ones
+"""
+
+import decimal
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import db_session
+import profiling
+
+from datetime import datetime, timedelta
+
+CACHE_DIR = "cache"
+
+# Bump this whenever a change to the scripts alters what a cached query or call
+# returns, e.g. a schema change. Entries written by other versions are ignored.
+CACHE_VERSION = 2
+
+DEFAULT_TTL = 30 * 24 * 60 * 60
+# Tasks keep changing until their deadline, at most 5 days after they were created,
+# and Cost Explorer finalizes a day's costs within a couple of days. Give a time range
+# this long after it ends before its results are cached.
+SETTLE_TIME = timedelta(days=7)
+MAX_ENTRIES = 1000
+
+_settings = {"enabled": True, "refresh": False, "ttl": DEFAULT_TTL}
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        action="store_true",
+        help="Don't read or write cached results",
+    )
+    parser.add_argument(
+        "--refresh",
+        dest="refresh_cache",
+        action="store_true",
+        help="Recompute cached results and overwrite them",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        dest="cache_ttl",
+        type=int,
+        default=DEFAULT_TTL,
+        help="Seconds before a cached result is recomputed (default: %d)" % DEFAULT_TTL,
+    )
+
+
+def configure(enabled=True, refresh=False, ttl=DEFAULT_TTL):
+    _settings["enabled"] = enabled
+    _settings["refresh"] = refresh
+    _settings["ttl"] = ttl
+    if enabled:
+        evict()
+
+
+def configure_from_args(args):
+    if args.cache_ttl < 0:
+        print("--cache-ttl can't be negative")
+        sys.exit(1)
+    configure(
+        enabled=not args.no_cache,
+        refresh=args.refresh_cache,
+        ttl=args.cache_ttl,
+    )
+
+
+def _json_default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return str(value)
+
+
+def to_json(value, **kwargs):
+    return json.dumps(value, default=_json_default, **kwargs)
+
+
+def write_json_atomic(filename, data, **kwargs):
+    """ Writes data as JSON to filename such that readers only ever see the old or the
+        complete new file.
+    """
+    directory = os.path.dirname(filename) or "."
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, tmpfile = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as outfile:
+            outfile.write(to_json(data, **kwargs))
+        os.replace(tmpfile, filename)
+    except BaseException:
+        os.unlink(tmpfile)
+        raise
+
+
+def cache_key(namespace, query, params=None, version=None):
+    material = [CACHE_VERSION, namespace, query, params]
+    if version is not None:
+        material.append(version)
+    material = to_json(material, sort_keys=True)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+def is_settled(range_end, now=None):
+    """ Returns True if a time range ending at range_end (a naive UTC datetime, or
+        None for no time range) is old enough that its results won't change.
+    """
+    if range_end is None:
+        return True
+    return range_end + SETTLE_TIME <= (now or datetime.utcnow())
+
+
+def _entry_path(namespace, key):
+    return os.path.join(CACHE_DIR, namespace, key + ".json")
+
+
+def load(namespace, key, ttl=None):
+    """ Returns (True, value) for a fresh entry, or (False, None).
+    """
+    if not _settings["enabled"] or _settings["refresh"]:
+        return False, None
+    path = _entry_path(namespace, key)
+    try:
+        with open(path) as infile:
+            entry = json.load(infile)
+    except (IOError, OSError, ValueError):
+        return False, None
+    if ttl is None:
+        ttl = _settings["ttl"]
+    if entry.get("version") != CACHE_VERSION:
+        return False, None
+    if time.time() - entry.get("created", 0) >= ttl:
+        return False, None
+    return True, entry["value"]
+
+
+def store(namespace, key, value):
+    if not _settings["enabled"]:
+        return
+    entry = {"version": CACHE_VERSION, "created": time.time(), "value": value}
+    write_json_atomic(_entry_path(namespace, key), entry)
+
+
+def cached(
+    namespace, query, params, compute, ttl=None, version=None, range_end=None
+):
+    """ Returns the cached result of compute() for (query, params, version),
+        computing and storing it on a miss. If the time range the result covers
+        ends at range_end and hasn't settled yet (see is_settled()), the cache is
+        bypassed. Results always come back in their JSON form (e.g. Decimal becomes
+        float) whether or not they were cached, so callers see the same types
+        either way.
+    """
+    with profiling.span("cache", profiling.CACHE, namespace=namespace) as span:
+        if not is_settled(range_end):
+            span.set(hit=False, settled=False)
+            return json.loads(to_json(compute()))
+        key = cache_key(namespace, query, params, version)
+        hit, value = load(namespace, key, ttl)
+        span.set(hit=hit)
+        if hit:
+            return value
+        value = json.loads(to_json(compute()))
+        store(namespace, key, value)
+        return value
+
+
+def cached_fetchall(
+    namespace, query, params=None, ttl=None, version=None, range_end=None
+):
+    return cached(
+        namespace,
+        query,
+        params,
+        lambda: db_session.fetchall(query, params),
+        ttl,
+        version,
+        range_end,
+    )
+
+
+def cached_fetchone(
+    namespace, query, params=None, ttl=None, version=None, range_end=None
+):
+    return cached(
+        namespace,
+        query,
+        params,
+        lambda: db_session.fetchone(query, params),
+        ttl,
+        version,
+        range_end,
+    )
+
+
+def evict(max_age=None, max_entries=MAX_ENTRIES):
+    """ Removes entries older than max_age (default: the configured TTL), then the
+        least recently written entries beyond max_entries.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return
+    if max_age is None:
+        max_age = _settings["ttl"]
+    now = time.time()
+    entries = []
+    for namespace in os.listdir(CACHE_DIR):
+        directory = os.path.join(CACHE_DIR, namespace)
+        if not os.path.isdir(directory):
+            continue
+        for filename in os.listdir(directory):
+            path = os.path.join(directory, filename)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if now - mtime >= max_age:
+                _remove(path)
+            else:
+                entries.append((mtime, path))
+    entries.sort(reverse=True)
+    for _, path in entries[max_entries:]:
+        _remove(path)
+
+
+def _remove(path):
+    # Another run may have evicted or replaced the entry already.
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
@@ -1,25 +1,42 @@
 #!/usr/bin/env python
 
-import time
+import functools
+
+import profiling
 
 from datetime import datetime
 
 
 def timeit(method):
+    """ Times every call of method as a profiling span (see profiling.py). The span
+        also records the peak RSS so far. Without profiling, how long the call took
+        is printed instead.
+    """
+
+    @functools.wraps(method)
     def timed(*args, **kw):
-        ts = time.time()
-        result = method(*args, **kw)
-        te = time.time()
-
-        if "log_time" in kw:
-            name = kw.get("log_name", method.__name__.upper())
-            kw["log_time"][name] = int((te - ts) * 1000)
-        else:
-            print("%r  %2.2f s" % (method.__name__, (te - ts)))
+        with profiling.span(method.__name__) as span:
+            result = method(*args, **kw)
+            if profiling.enabled():
+                span.set(peak_rss=profiling.peak_rss())
+        if not profiling.enabled():
+            print("%r  %2.2f s" % (method.__name__, span.duration))
         return result
 
     return timed
 
 
+def month_range(year, month):
+    """ Returns the [start, end) datetimes of a month, for sargable
+        "created >= start AND created < end" predicates.
+    """
+    start = datetime(year, month, 1)
+    if month == 12:
+        end = datetime(year + 1, 1, 1)
+    else:
+        end = datetime(year, month + 1, 1)
+    return start, end
+
+
 def log_ts():
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,723 @@
+#!/usr/bin/env python
+""" synthetic_data.py
+
+    Generates a month of synthetic tasks and worker_type_monthly_costs, so the
+    report scripts can be benchmarked (see benchmark.py) at sizes a development
+    database doesn't hold.
+
+    The data follows the shape of the real tables:
+      * worker types and projects are drawn from Zipf distributions, so a handful
+        of them account for most of the tasks
+      * tasks arrive in pushes, each a burst of tasks created within an hour of
+        the push, with push sizes spread over two orders of magnitude and more
+        pushes during the working day
+      * every run waits on its dependencies, then on a worker, then runs for a
+        log-normal duration, so runs overlap the way they do in production; some
+        fail, some are resolved as exception before a worker claims them and some
+        are retried as a second run
+      * worker_type_monthly_costs bills each worker type for its task time plus
+        idle time, so cost_per_push.py finds efficiencies below 100%
+
+    The month is written as an extract in the format of extract.py under
+    --output, which the report scripts read with --extract when run from that
+    directory. With --db its runs are COPYed into the tasks table of the
+    database in database.ini instead; only do that to a scratch database:
+
+        ./synthetic_data.py --month 2019-08 --rows 10M
+        ./synthetic_data.py --month 2019-08 --rows 10M --db --replace
+
+    The mozilla-central pushes are also written to a push log store under
+    --output (see pushlog.py), a share of them as merges, so monthly_tc_stats.py
+    finds merge changesets to compute end-to-end times for without syncing.
+"""
+
+import argparse
+import base64
+import calendar
+import csv
+import hashlib
+import io
+import os
+import struct
+import sys
+
+import numpy as np
+
+import db_session
+import extract
+import pushlog
+
+from concurrency import to_epoch
+from datetime import datetime
+from extract import MICROSECONDS, NULL_CODE, NULL_VALUE
+from numpy.lib.format import open_memmap
+from parse_monthly_stats import PROVIDER
+from psycopg2.extras import execute_values
+from shared import log_ts, month_range, timeit
+
+SYNTHETIC_DIR = "synthetic"
+DEFAULT_ROWS = 1000000
+DEFAULT_SEED = 1
+CHUNK_ROWS = 1000000
+
+ZIPF_EXPONENT = 1.2
+TASKS_PER_PUSH = 250
+PUSH_SIZE_SIGMA = 1.5
+RUNS_PER_WORKER = 100
+RETRY_RATE = 0.02
+MERGE_RATE = 0.2
+
+# Outcome of a run: completed, else failed, else exception.
+COMPLETED_RATE = 0.9
+FAILED_RATE = 0.06
+# Share of exceptions resolved before a worker claimed the run.
+UNCLAIMED_RATE = 0.3
+
+# Delays in microseconds, durations in milliseconds.
+CREATE_DELAY = 10 * 60 * MICROSECONDS
+MAX_CREATE_DELAY = 60 * 60 * MICROSECONDS
+SCHEDULE_DELAY = 15 * 60 * MICROSECONDS
+PENDING_TIME = 3 * 60 * MICROSECONDS
+MEDIAN_DURATION = 12 * 60 * 1000
+DURATION_SIGMA = 1.0
+MAX_DURATION = 24 * 60 * 60 * 1000
+
+# Relative number of pushes in each hour of the day (UTC).
+HOURLY_WEIGHTS = [
+    3, 2, 2, 2, 3, 4, 6, 8, 9, 10, 10, 10,
+    10, 10, 10, 10, 10, 9, 8, 7, 6, 5, 4, 3,
+]
+
+STATES = ["completed", "failed", "exception"]
+COMPLETED, FAILED, EXCEPTION = range(len(STATES))
+
+# In order of popularity.
+PROJECTS = [
+    "try",
+    "autoland",
+    "mozilla-central",
+    "mozilla-inbound",
+    "mozilla-beta",
+    "mozilla-release",
+    "comm-central",
+    "mozilla-esr68",
+    "comm-beta",
+    "mozilla-esr60",
+    "comm-esr68",
+    "ash",
+    "oak",
+    "larch",
+    "maple",
+    "cedar",
+]
+
+# (provisioner, worker type, platform, instance type, hourly cost, job kind), in
+# order of popularity. Numbered variants of these make up the rest of the worker
+# types.
+WORKER_TYPES = [
+    ("gecko-t", "t-linux-xlarge", "linux64", "m5.xlarge", 0.20, "test"),
+    ("gecko-t", "t-win10-64", "windows10-64", "c5.2xlarge", 0.45, "test"),
+    ("gecko-3", "b-linux", "linux64", "c5d.4xlarge", 0.90, "build"),
+    ("gecko-t", "t-win7-32", "windows7-32", "c5.xlarge", 0.25, "test"),
+    ("gecko-t", "t-linux-large", "linux64-qr", "m5.large", 0.10, "test"),
+    ("gecko-t", "t-win10-64-gpu", "windows10-64-qr", "g3.4xlarge", 1.40, "test"),
+    ("gecko-1", "b-linux-xlarge", "linux64", "c5d.4xlarge", 0.90, "build"),
+    ("gecko-t", "t-osx-1014", "osx-10-14", None, 0.30, "test"),
+    ("gecko-3", "b-win2012", "windows2012-64", "c5.4xlarge", 1.10, "build"),
+    ("gecko-t", "t-android-em-7", "android-em-7-0-x86_64", "c5d.18xlarge", 1.2, "test"),
+    ("gecko-1", "b-win2012-xlarge", "windows2012-64", "c5.4xlarge", 1.10, "build"),
+    ("gecko-t", "t-win10-64-gpu-s", "windows10-64", "g3s.xlarge", 0.75, "test"),
+    ("aws-provisioner-v1", "gecko-t-linux", "linux32", "m3.2xlarge", 0.30, "test"),
+    ("gecko-3", "images", "linux64", "m5d.2xlarge", 0.40, "build"),
+    ("gecko-t", "t-win10-64-hw", "windows10-64", "g2.2xlarge", 0.65, "test"),
+    ("gecko-t", "t-win7-32-gpu", "windows7-32", "c4.2xlarge", 0.40, "test"),
+]
+NUM_WORKER_TYPES = 64
+WORKER_GROUP = "us-east-1"
+
+COPY_COLUMNS = [
+    "task_id",
+    "run_id",
+    "state",
+    "exception_reason",
+    "created",
+    "scheduled",
+    "started",
+    "resolved",
+    "duration",
+    "source",
+    "owner",
+    "project",
+    "revision",
+    "push_id",
+    "scheduler",
+    "provisioner",
+    "worker_id",
+    "worker_type",
+    "worker_group",
+    "platform",
+    "job_kind",
+]
+
+COSTS_QUERY = (
+    "INSERT INTO worker_type_monthly_costs \
+        (year, month, provider, provisioner, worker_type, usage_hours, cost) \
+    VALUES %s \
+    ON CONFLICT ON CONSTRAINT dup_worker_type DO UPDATE \
+        SET usage_hours = EXCLUDED.usage_hours, \
+            cost = EXCLUDED.cost, \
+            modified = NOW()"
+)
+
+
+def parse_rows(value):
+    """ Parses a row count such as 250000, 10M or 1.5k.
+    """
+    value = value.strip().lower()
+    multiplier = 1
+    if value[-1:] in ("k", "m"):
+        multiplier = 1000 if value[-1] == "k" else 1000000
+        value = value[:-1]
+    rows = int(float(value) * multiplier)
+    if rows < 1:
+        raise ValueError("row count must be positive")
+    return rows
+
+
+def format_rows(rows):
+    if rows % 1000000 == 0:
+        return "%dM" % (rows // 1000000)
+    if rows % 1000 == 0:
+        return "%dk" % (rows // 1000)
+    return str(rows)
+
+
+def zipf_weights(count, exponent=ZIPF_EXPONENT):
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    return weights / weights.sum()
+
+
+def worker_type_catalog(count=NUM_WORKER_TYPES):
+    """ Returns count worker types as tuples like those in WORKER_TYPES: those, then
+        numbered variants of them.
+    """
+    catalog = []
+    for i in range(count):
+        provisioner, worker_type, platform, instance_type, rate, job_kind = (
+            WORKER_TYPES[i % len(WORKER_TYPES)]
+        )
+        variant = i // len(WORKER_TYPES)
+        if variant:
+            worker_type = "%s-%d" % (worker_type, variant)
+        catalog.append(
+            (provisioner, worker_type, platform, instance_type, rate, job_kind)
+        )
+    return catalog
+
+
+def task_id(seed, task):
+    """ A slugid-like task ID for (seed, task number). Like real ones, consecutive
+        task IDs are scattered across the dup_task_run index.
+    """
+    digest = hashlib.md5(struct.pack(">QQ", seed, task)).digest()
+    return base64.urlsafe_b64encode(digest)[:22].decode()
+
+
+def _labels(dictionary, codes):
+    # NULL_CODE (-1) indexes the trailing None.
+    return np.array(list(dictionary) + [None], dtype=object)[codes].tolist()
+
+
+def _timestamps(values):
+    strings = values.astype("datetime64[us]").astype(str).astype(object)
+    return np.where(values == NULL_VALUE, None, strings).tolist()
+
+
+class SyntheticMonth(object):
+    """ A month of synthetic task runs. The catalog of pushes, projects, worker types
+        and workers is drawn up front; blocks() then generates the runs in created
+        order.
+    """
+
+    def __init__(self, year, month, rows, seed=DEFAULT_SEED):
+        self.year = year
+        self.month = month
+        self.rows = rows
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        month_start, month_end = month_range(year, month)
+        self.start_us = to_epoch(month_start) * MICROSECONDS
+        self.end_us = to_epoch(month_end) * MICROSECONDS
+        self.retries = int(round(rows * RETRY_RATE))
+        self.tasks = rows - self.retries
+
+        self.worker_types = worker_type_catalog()
+        self.worker_type_p = zipf_weights(len(self.worker_types))
+        provisioners = sorted(set(wt[0] for wt in self.worker_types))
+        platforms = sorted(set(wt[2] for wt in self.worker_types))
+        self.worker_type_provisioner = np.array(
+            [provisioners.index(wt[0]) for wt in self.worker_types], dtype=np.int32
+        )
+        self.worker_type_platform = np.array(
+            [platforms.index(wt[2]) for wt in self.worker_types], dtype=np.int32
+        )
+        # Share of each worker type's billed time that was spent running tasks.
+        self.utilization = self.rng.uniform(0.6, 0.95, len(self.worker_types))
+        self.task_ms = np.zeros(len(self.worker_types))
+
+        # Workers are split between worker types in proportion to their tasks.
+        num_workers = max(len(self.worker_types), rows // RUNS_PER_WORKER)
+        self.worker_pool = np.maximum(
+            1, np.round(self.worker_type_p * num_workers)
+        ).astype(np.int64)
+        self.worker_offset = np.concatenate(([0], np.cumsum(self.worker_pool)[:-1]))
+        worker_ids = [
+            "%s-%05d" % (wt[1], k)
+            for wt, size in zip(self.worker_types, self.worker_pool)
+            for k in range(size)
+        ]
+
+        self.num_pushes = max(1, self.tasks // TASKS_PER_PUSH)
+        sizes = self.rng.lognormal(0, PUSH_SIZE_SIGMA, self.num_pushes)
+        counts = np.floor(sizes / sizes.sum() * self.tasks).astype(np.int64)
+        short = self.tasks - int(counts.sum())
+        counts[self.rng.choice(self.num_pushes, short, replace=False)] += 1
+        self.push_sizes = counts
+        self.push_times = np.sort(self._arrival_times(self.num_pushes))
+        self.push_project = self.rng.choice(
+            len(PROJECTS), self.num_pushes, p=zipf_weights(len(PROJECTS))
+        ).astype(np.int32)
+        revisions = [
+            hashlib.sha1(("%d-%d-%d" % (seed, rows, i)).encode()).hexdigest()
+            for i in range(self.num_pushes)
+        ]
+
+        self.dictionaries = {
+            "state": STATES,
+            "project": PROJECTS,
+            "revision": revisions,
+            "provisioner": provisioners,
+            "worker_type": [wt[1] for wt in self.worker_types],
+            "worker_id": worker_ids,
+            "platform": platforms,
+        }
+
+    def _arrival_times(self, count):
+        num_days = calendar.monthrange(self.year, self.month)[1]
+        hourly_p = np.array(HOURLY_WEIGHTS, dtype=float) / sum(HOURLY_WEIGHTS)
+        hours = self.rng.randint(0, num_days, count) * 24 + self.rng.choice(
+            24, count, p=hourly_p
+        )
+        seconds = hours * 3600 + self.rng.random_sample(count) * 3600
+        return self.start_us + (seconds * MICROSECONDS).astype(np.int64)
+
+    def _runs(self, scheduled, worker_type):
+        """ Returns (state, started, resolved, duration, worker) for runs scheduled
+            at the given times.
+        """
+        rng = self.rng
+        count = len(scheduled)
+        outcome = rng.random_sample(count)
+        state = np.full(count, EXCEPTION, dtype=np.int32)
+        state[outcome < COMPLETED_RATE + FAILED_RATE] = FAILED
+        state[outcome < COMPLETED_RATE] = COMPLETED
+        unclaimed = (state == EXCEPTION) & (rng.random_sample(count) < UNCLAIMED_RATE)
+        started = scheduled + rng.exponential(PENDING_TIME, count).astype(np.int64)
+        duration = np.clip(
+            rng.lognormal(np.log(MEDIAN_DURATION), DURATION_SIGMA, count),
+            1000,
+            MAX_DURATION,
+        ).astype(np.int64)
+        # Runs that never started are measured from when they were scheduled.
+        resolved = np.where(unclaimed, scheduled, started) + duration * 1000
+        started[unclaimed] = NULL_VALUE
+        worker = self.worker_offset[worker_type] + (
+            rng.random_sample(count) * self.worker_pool[worker_type]
+        ).astype(np.int64)
+        worker[unclaimed] = NULL_CODE
+        return state, started, resolved, duration, worker
+
+    def _generate(self, first, last, done):
+        """ Returns the runs of pushes [first, last), whose tasks are numbered from
+            done, in no particular order.
+        """
+        rng = self.rng
+        counts = self.push_sizes[first:last]
+        count = int(counts.sum())
+        push = np.repeat(np.arange(first, last), counts)
+        task = np.arange(done, done + count)
+        created = self.push_times[push] + np.minimum(
+            rng.exponential(CREATE_DELAY, count), MAX_CREATE_DELAY
+        ).astype(np.int64)
+        created = np.minimum(created, self.end_us - 1)
+        worker_type = rng.choice(
+            len(self.worker_types), count, p=self.worker_type_p
+        ).astype(np.int32)
+        scheduled = created + rng.exponential(SCHEDULE_DELAY, count).astype(np.int64)
+        state, started, resolved, duration, worker = self._runs(scheduled, worker_type)
+
+        # Spread the retries evenly over the month: a retried task's first run is
+        # resolved as exception and its second run is scheduled right after.
+        num_retries = (done + count) * self.retries // self.tasks - (
+            done * self.retries // self.tasks
+        )
+        retried = np.sort(rng.choice(count, num_retries, replace=False))
+        state[retried] = EXCEPTION
+        retry = self._runs(resolved[retried], worker_type[retried])
+
+        def both(first_runs, second_runs):
+            return np.concatenate((first_runs, second_runs))
+
+        runs = {
+            "created": both(created, created[retried]),
+            "scheduled": both(scheduled, resolved[retried]),
+            "started": both(started, retry[1]),
+            "resolved": both(resolved, retry[2]),
+            "run_id": both(np.zeros(count, np.int64), np.ones(num_retries, np.int64)),
+            "duration": both(duration, retry[3]),
+            "state": both(state, retry[0]),
+            "project": self.push_project[both(push, push[retried])],
+            "revision": both(push, push[retried]).astype(np.int32),
+            "worker_type": both(worker_type, worker_type[retried]),
+            "worker_id": both(worker, retry[4]).astype(np.int32),
+            "task": both(task, task[retried]),
+            "push": both(push, push[retried]),
+        }
+        runs["provisioner"] = self.worker_type_provisioner[runs["worker_type"]]
+        runs["platform"] = self.worker_type_platform[runs["worker_type"]]
+        claimed = runs["started"] != NULL_VALUE
+        self.task_ms += np.bincount(
+            runs["worker_type"][claimed],
+            weights=runs["duration"][claimed],
+            minlength=len(self.worker_types),
+        )
+        return runs
+
+    def blocks(self, chunk_rows=CHUNK_ROWS):
+        """ Yields the month's runs in created order, as dicts of column arrays of
+            roughly chunk_rows rows. Columns follow the NULL conventions of
+            extract.py; "task" is the run's task number and "push" its push.
+
+            Can only be iterated once, as it also tallies the task time that
+            worker_type_costs() bills.
+        """
+        ends = np.cumsum(self.push_sizes)
+        first = 0
+        done = 0
+        carry = None
+        while first < self.num_pushes:
+            last = int(np.searchsorted(ends, done + chunk_rows, "right"))
+            last = max(first + 1, last)
+            runs = self._generate(first, last, done)
+            done = int(ends[last - 1])
+            if carry is not None:
+                runs = {
+                    column: np.concatenate((carry[column], values))
+                    for column, values in runs.items()
+                }
+            # Stable, so each retry stays behind the run it retries.
+            order = np.argsort(runs["created"], kind="mergesort")
+            runs = {column: values[order] for column, values in runs.items()}
+            if last < self.num_pushes:
+                # Runs of later pushes are created after their push, so only the
+                # ones up to the next push are final.
+                cut = int(np.searchsorted(runs["created"], self.push_times[last]))
+                carry = {column: values[cut:] for column, values in runs.items()}
+                runs = {column: values[:cut] for column, values in runs.items()}
+            first = last
+            if len(runs["created"]):
+                yield runs
+
+    def worker_type_costs(self):
+        """ Returns the month's [provisioner, worker_type, usage_hours, cost] rows,
+            billing each worker type for its task time (tallied by blocks()) plus
+            idle time.
+        """
+        rows = []
+        for i, worker_type in enumerate(self.worker_types):
+            task_hours = self.task_ms[i] / 1000 / 60 / 60
+            if not task_hours:
+                continue
+            usage_hours = round(task_hours / self.utilization[i], 2)
+            rows.append(
+                [
+                    worker_type[0],
+                    worker_type[1],
+                    usage_hours,
+                    round(usage_hours * worker_type[4], 2),
+                ]
+            )
+        return rows
+
+    def worker_instance_mapping(self):
+        return {wt[1]: wt[3] for wt in self.worker_types if wt[3]}
+
+    def pushlog_pushes(self, project="mozilla-central"):
+        """ Returns (push_id, push) pairs for the pushes to project, in the form of
+            json-pushes version 2, with MERGE_RATE of them merges.
+        """
+        rng = np.random.RandomState(self.seed)
+        pushes = np.flatnonzero(self.push_project == PROJECTS.index(project))
+        merges = rng.random_sample(len(pushes)) < MERGE_RATE
+        result = []
+        for push_id, (push, merge) in enumerate(zip(pushes, merges), 1):
+            if merge:
+                description = "%s to %s. a=merge" % (pushlog.MERGE_PREFIX, project)
+            else:
+                description = "Bug %d - Synthetic change" % (1500000 + push)
+            result.append(
+                (
+                    push_id,
+                    {
+                        "date": int(self.push_times[push] // MICROSECONDS),
+                        "user": "synthetic@mozilla.com",
+                        "changesets": [
+                            {
+                                "node": self.dictionaries["revision"][push],
+                                "desc": description,
+                            }
+                        ],
+                    },
+                )
+            )
+        return result
+
+
+@timeit
+def write_extract(synth, directory, chunk_rows=CHUNK_ROWS):
+    """ Writes the month as an extract under directory. Returns its path.
+    """
+    integer_columns = extract.TIMESTAMP_COLUMNS + extract.INTEGER_COLUMNS
+    meta = extract.extract_meta(
+        synth.year,
+        synth.month,
+        synth.rows,
+        synth.dictionaries,
+        [],
+        synth.worker_instance_mapping(),
+    )
+    meta["synthetic"] = {"rows": synth.rows, "seed": synth.seed}
+
+    def write_columns(tmpdir):
+        columns = {}
+        for column in integer_columns + extract.STRING_COLUMNS:
+            columns[column] = open_memmap(
+                os.path.join(tmpdir, column + ".npy"),
+                mode="w+",
+                dtype=np.int64 if column in integer_columns else np.int32,
+                shape=(synth.rows,),
+            )
+        offset = 0
+        for runs in synth.blocks(chunk_rows):
+            size = len(runs["created"])
+            for column, values in columns.items():
+                values[offset:offset + size] = runs[column]
+            offset += size
+        for values in columns.values():
+            values.flush()
+        # The costs are billed from the generated runs, so they're only known now.
+        meta["worker_type_monthly_costs"] = synth.worker_type_costs()
+
+    path = extract.extract_path(synth.year, synth.month, directory)
+    extract.write_extract(path, meta, write_columns)
+    return path
+
+
+def copy_runs(cur, synth, runs):
+    """ COPYs a block of runs into tasks.
+    """
+    dictionaries = synth.dictionaries
+    state = runs["state"]
+    started = runs["started"]
+    exception_reason = np.where(
+        state == EXCEPTION,
+        np.where(started == NULL_VALUE, "deadline-exceeded", "worker-shutdown"),
+        None,
+    )
+    scheduler = np.where(
+        runs["project"] == PROJECTS.index("try"), "gecko-level-1", "gecko-level-3"
+    )
+    count = len(state)
+    columns = [
+        [task_id(synth.seed, task) for task in runs["task"].tolist()],
+        runs["run_id"].tolist(),
+        _labels(dictionaries["state"], state),
+        exception_reason.tolist(),
+        _timestamps(runs["created"]),
+        _timestamps(runs["scheduled"]),
+        _timestamps(started),
+        _timestamps(runs["resolved"]),
+        runs["duration"].tolist(),
+        ["hg.mozilla.org"] * count,
+        [None] * count,
+        _labels(dictionaries["project"], runs["project"]),
+        _labels(dictionaries["revision"], runs["revision"]),
+        (runs["push"] + 1).tolist(),
+        scheduler.tolist(),
+        _labels(dictionaries["provisioner"], runs["provisioner"]),
+        _labels(dictionaries["worker_id"], runs["worker_id"]),
+        _labels(dictionaries["worker_type"], runs["worker_type"]),
+        np.where(runs["worker_id"] == NULL_CODE, None, WORKER_GROUP).tolist(),
+        _labels(dictionaries["platform"], runs["platform"]),
+        _labels([wt[5] for wt in synth.worker_types], runs["worker_type"]),
+    ]
+    buf = io.StringIO()
+    # None is written as an empty unquoted field, which COPY reads as NULL.
+    csv.writer(buf).writerows(zip(*columns))
+    buf.seek(0)
+    cur.copy_expert(
+        "COPY tasks (%s) FROM STDIN WITH (FORMAT csv)" % ", ".join(COPY_COLUMNS), buf
+    )
+
+
+def prepare_month(year, month, replace=False):
+    """ Creates the month's tasks partition and returns its name, or None if it
+        already holds tasks and replace isn't set. With replace, they're deleted.
+    """
+    month_start, month_end = month_range(year, month)
+    with db_session.cursor() as cur:
+        cur.execute("SELECT create_tasks_partition(%s)", (month_start,))
+        partition = cur.fetchone()[0]
+        cur.execute(
+            "SELECT EXISTS (SELECT 1 FROM tasks WHERE created >= %s AND created < %s)",
+            (month_start, month_end),
+        )
+        if cur.fetchone()[0]:
+            if not replace:
+                return None
+            cur.execute("TRUNCATE %s" % partition)
+    return partition
+
+
+@timeit
+def load_db(synth, partition, chunk_rows=CHUNK_ROWS):
+    """ COPYs the month's runs into tasks, one transaction per block, then writes
+        its worker_type_monthly_costs and worker_instance_mapping rows. Returns the
+        number of rows loaded.
+    """
+    loaded = 0
+    for runs in synth.blocks(chunk_rows):
+        with db_session.cursor() as cur:
+            copy_runs(cur, synth, runs)
+        loaded += len(runs["created"])
+        print("[%s] Loaded %d of %d rows" % (log_ts(), loaded, synth.rows))
+
+    costs = [
+        (synth.year, synth.month, PROVIDER, provisioner, worker_type, hours, cost)
+        for provisioner, worker_type, hours, cost in synth.worker_type_costs()
+    ]
+    mapping = synth.worker_instance_mapping()
+    with db_session.cursor() as cur:
+        execute_values(cur, COSTS_QUERY, costs)
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS worker_instance_mapping \
+                (worker_type text, instance_type text)"
+        )
+        cur.execute(
+            "DELETE FROM worker_instance_mapping WHERE worker_type = ANY(%s)",
+            (list(mapping),),
+        )
+        execute_values(
+            cur,
+            "INSERT INTO worker_instance_mapping (worker_type, instance_type) \
+                VALUES %s",
+            list(mapping.items()),
+        )
+        cur.execute("ANALYZE %s" % partition)
+    return loaded
+
+
+def write_pushlog(synth, filename):
+    """ Replaces the push log store in filename with the month's mozilla-central
+        pushes.
+    """
+    if os.path.exists(filename):
+        os.remove(filename)
+    store = pushlog.PushlogStore(filename)
+    try:
+        pushes = synth.pushlog_pushes()
+        store.add_pushes(pushes)
+    finally:
+        store.close()
+    return len(pushes)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--month", help="Month to generate, format: YYYY-MM", required=True, type=str
+    )
+    parser.add_argument(
+        "--rows",
+        help="Number of task runs, e.g. 1M, 10M, 100M (default: %s)"
+        % format_rows(DEFAULT_ROWS),
+        default=str(DEFAULT_ROWS),
+    )
+    parser.add_argument(
+        "--seed",
+        help="Random seed (default: %(default)s)",
+        type=int,
+        default=DEFAULT_SEED,
+    )
+    parser.add_argument(
+        "--output",
+        help="Directory to write the extract and push log to (default: %(default)s)",
+        default=SYNTHETIC_DIR,
+    )
+    parser.add_argument(
+        "--db",
+        help="Load the runs into the tasks table of the database in database.ini "
+        "instead of writing an extract",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--replace",
+        help="With --db, delete the month's existing tasks first",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--chunk-rows",
+        help="Runs generated at a time (default: %(default)s)",
+        type=int,
+        default=CHUNK_ROWS,
+    )
+    args = parser.parse_args()
+
+    try:
+        parsed = datetime.strptime(args.month, "%Y-%m")
+    except ValueError:
+        print("ERROR: unable to parse month %s" % args.month)
+        sys.exit(1)
+    try:
+        rows = parse_rows(args.rows)
+    except ValueError:
+        print("ERROR: unable to parse --rows %s" % args.rows)
+        sys.exit(2)
+
+    synth = SyntheticMonth(parsed.year, parsed.month, rows, args.seed)
+    print(
+        "[%s] Generating %s runs in %d pushes for %d-%02d"
+        % (log_ts(), "{:,}".format(rows), synth.num_pushes, parsed.year, parsed.month)
+    )
+    if args.db:
+        db_session.init_pool()
+        partition = prepare_month(parsed.year, parsed.month, args.replace)
+        if partition is None:
+            print(
+                "ERROR: %d-%02d already has tasks, pass --replace to delete them"
+                % (parsed.year, parsed.month)
+            )
+            db_session.close_pool()
+            sys.exit(3)
+        load_db(synth, partition, args.chunk_rows)
+        db_session.close_pool()
+    else:
+        path = write_extract(
+            synth, os.path.join(args.output, extract.EXTRACT_DIR), args.chunk_rows
+        )
+        print("[%s] Wrote %s" % (log_ts(), path))
+    filename = os.path.join(args.output, pushlog.default_db_path())
+    print(
+        "[%s] Wrote %d pushes to %s"
+        % (log_ts(), write_pushlog(synth, filename), filename)
+    )
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+""" An in-process cache of task definitions for the ingestion worker.
+
+    Every task produces several events (pending, running, completed, ...), and each
+    one needs the task's definition. TaskDefinitionCache keeps recently used
+    definitions in a bounded LRU, with entries expiring after a TTL, so only the
+    first event of a task has to fetch its definition from the queue.
+
+    The cached_task_definitions table is an optional second tier: with use_db, the
+    cache is warmed from the table on start-up, misses are looked up there before
+    going to the queue, and newly fetched definitions are written back in batches
+    by persist(). Old rows are removed by a periodic batch job rather than a
+    trigger on every insert:
+
+        ./task_definitions.py --expire
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import db_session
+import profiling
+import requests
+
+from collections import OrderedDict
+from psycopg2.extras import execute_values
+from shared import log_ts
+
+DEFAULT_ROOT_URL = "https://firefox-ci-tc.services.mozilla.com"
+DEFAULT_MAX_SIZE = 20000
+# Matches the retention of the old expire_old_task_definitions trigger.
+DEFAULT_TTL = 3 * 60 * 60
+TIMEOUT = 60
+
+
+def fetch_task_definition(task_id, root_url=DEFAULT_ROOT_URL, session=None):
+    with profiling.span("queue.task", profiling.NETWORK, task_id=task_id) as span:
+        resp = (session or requests).get(
+            "%s/api/queue/v1/task/%s" % (root_url.rstrip("/"), task_id),
+            timeout=TIMEOUT,
+        )
+        span.set(status=resp.status_code, bytes=len(resp.content))
+        resp.raise_for_status()
+        return resp.json()
+
+
+def expire_table(max_age=DEFAULT_TTL):
+    """ Deletes cached_task_definitions rows older than max_age seconds. Returns the
+        number of rows deleted.
+    """
+    with db_session.cursor() as cur:
+        cur.execute(
+            "DELETE FROM cached_task_definitions \
+                WHERE timestamp < NOW() - %s * INTERVAL '1 second'",
+            (max_age,),
+        )
+        return cur.rowcount
+
+
+class TaskDefinitionCache(object):
+    """ A bounded LRU of task_id -> definition whose entries expire after ttl
+        seconds. fetch(task_id) is called on a miss.
+    """
+
+    def __init__(
+        self, fetch, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, use_db=False
+    ):
+        self.fetch = fetch
+        self.max_size = max_size
+        self.ttl = ttl
+        self.use_db = use_db
+        self._entries = OrderedDict()
+        self._unsaved = {}
+        self.hits = 0
+        self.db_hits = 0
+        self.fetches = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _put(self, task_id, definition, expires):
+        self._entries[task_id] = (expires, definition)
+        self._entries.move_to_end(task_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, task_id):
+        now = time.time()
+        entry = self._entries.get(task_id)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(task_id)
+                self.hits += 1
+                return entry[1]
+            del self._entries[task_id]
+            self.expirations += 1
+
+        definition = None
+        if self.use_db:
+            row = db_session.fetchone(
+                "SELECT definition FROM cached_task_definitions WHERE task_id = %s",
+                (task_id,),
+            )
+            if row:
+                definition = row[0]
+                self.db_hits += 1
+        if definition is None:
+            definition = self.fetch(task_id)
+            self.fetches += 1
+            if self.use_db:
+                self._unsaved[task_id] = definition
+        self._put(task_id, definition, now + self.ttl)
+        return definition
+
+    def warm_start(self):
+        """ Loads the most recent definitions in cached_task_definitions that are
+            younger than the TTL, up to max_size of them. Returns how many.
+        """
+        query = (
+            "SELECT task_id, definition, EXTRACT(EPOCH FROM NOW() - timestamp) \
+                FROM cached_task_definitions \
+                WHERE timestamp >= NOW() - %s * INTERVAL '1 second' \
+                ORDER BY timestamp DESC \
+                LIMIT %s"
+        )
+        rows = db_session.fetchall(query, (self.ttl, self.max_size))
+        now = time.time()
+        # Oldest first, so the most recent end up at the young end of the LRU.
+        for task_id, definition, age in reversed(rows):
+            self._put(task_id, definition, now + self.ttl - float(age))
+        return len(rows)
+
+    def persist(self):
+        """ Writes the definitions fetched since the last call to
+            cached_task_definitions in one statement. Returns how many.
+        """
+        if not self._unsaved:
+            return 0
+        rows = [
+            (task_id, json.dumps(definition))
+            for task_id, definition in self._unsaved.items()
+        ]
+        with db_session.cursor() as cur:
+            execute_values(
+                cur,
+                "INSERT INTO cached_task_definitions (task_id, definition) VALUES %s",
+                rows,
+                page_size=len(rows),
+            )
+        self._unsaved = {}
+        return len(rows)
+
+    def stats(self):
+        lookups = self.hits + self.db_hits + self.fetches
+        return {
+            "size": len(self._entries),
+            "lookups": lookups,
+            "hits": self.hits,
+            "db_hits": self.db_hits,
+            "fetches": self.fetches,
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def format_stats(self):
+        stats = self.stats()
+        stats["hit_rate"] *= 100
+        return (
+            "definitions: %(size)d cached, %(hit_rate).1f%% hit rate "
+            "(%(hits)d hits, %(db_hits)d db hits, %(fetches)d fetches), "
+            "%(evictions)d evicted, %(expirations)d expired" % stats
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--expire",
+        help="Delete cached_task_definitions rows older than --max-age",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--max-age",
+        help="Seconds to keep cached task definitions (default: %(default)s)",
+        type=int,
+        default=DEFAULT_TTL,
+    )
+    args = parser.parse_args()
+    if not args.expire:
+        print("Nothing to do, pass --expire")
+        sys.exit(1)
+
+    db_session.init_pool()
+    deleted = expire_table(args.max_age)
+    db_session.close_pool()
+    print("[%s] Deleted %d expired task definitions" % (log_ts(), deleted))
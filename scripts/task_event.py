@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+""" Parses Taskcluster queue task events into rows of the tasks table.
+
+    This is a port of src/task.js and src/util/route_parser.js, so the Python
+    ingestion worker (ingest.py) fills in source, project, revision, platform and
+    job kind exactly like the node handler does.
+
+    An event is a pulse message as JSON: its exchange, its routes and its payload
+    ({"status": ..., "runId": ...}). TaskEvent.upserts() returns the rows that the
+    node handler would write for it, each with the columns it updates on conflict.
+"""
+
+import re
+
+from datetime import datetime
+
+EVENT_STATES = {
+    "task-pending": "pending",
+    "task-running": "running",
+    "task-completed": "completed",
+    "task-failed": "failed",
+    "task-exception": "exception",
+}
+
+COLUMNS = [
+    "task_id",
+    "run_id",
+    "state",
+    "created",
+    "scheduled",
+    "source",
+    "owner",
+    "project",
+    "revision",
+    "push_id",
+    "scheduler",
+    "provisioner",
+    "worker_type",
+    "platform",
+    "job_kind",
+    "worker_id",
+    "worker_group",
+    "started",
+    "resolved",
+    "exception_reason",
+    "duration",
+]
+
+# The columns each kind of event overwrites when its run is already in tasks.
+# Pending events never overwrite anything (ON CONFLICT DO NOTHING).
+PENDING_UPDATES = frozenset()
+RUNNING_UPDATES = frozenset(
+    ["scheduled", "state", "started", "worker_id", "worker_group"]
+)
+COMPLETED_UPDATES = RUNNING_UPDATES | frozenset(["resolved", "duration"])
+EXCEPTION_UPDATES = COMPLETED_UPDATES | frozenset(["exception_reason"])
+
+DEFAULT_SOURCE = {
+    "origin": None,
+    "owner": None,
+    "project": None,
+    "revision": None,
+    "pushId": None,
+}
+
+# https://github.com/<owner>/<repo>, git@github.com:<owner>/<repo>.git, ...
+GITHUB_URL = re.compile(
+    r"^(?:[a-z+]+://)?(?:[^@/]+@)?github\.com[:/]+"
+    r"([^/]+)/([^/#?]+?)(?:\.git)?(?:[/#?].*)?$"
+)
+
+
+def event_state(exchange):
+    """ Returns the task state for a queue exchange, e.g.
+        exchange/taskcluster-queue/v1/task-completed -> completed.
+    """
+    name = exchange.rstrip("/").rsplit("/", 1)[-1]
+    if name not in EVENT_STATES:
+        raise ValueError("Unknown exchange: %s" % exchange)
+    return EVENT_STATES[name]
+
+
+def parse_route(route):
+    """ Parses a treeherder route. Routing keys are in the form:
+
+        treeherder.<version>.<user/project>|<project>.<revision>.<pushLogId/pullRequestId>
+
+        [0] routing key prefix used for listening to only treeherder relevant messages
+        [1] routing key version
+        [2] in the form of user/project for github repos and just project for hg.mozilla.org
+        [3] Top level revision for the push
+        [4] Pull Request ID (github) or Push Log ID (hg.mozilla.org) of the push
+            Note: pushes to a branch on github would not have a PR ID
+    """
+    project = revision = revision_hash = push_id = owner = parsed_project = None
+    parsed_route = route.split(".")
+    # Assume it's a version 1 routing key
+    if len(parsed_route) == 3:
+        version = "v1"
+    else:
+        version = parsed_route[1]
+
+    if version == "v1":
+        project = parsed_route[1]
+        revision_hash = parsed_route[2]
+        parsed_project = project
+    elif version == "v2":
+        project = parsed_route[2]
+        revision = parsed_route[3]
+        if len(project.split("/")) == 2:
+            owner, parsed_project = project.split("/")
+        else:
+            parsed_project = project
+        if len(parsed_route) == 5:
+            push_id = parsed_route[4]
+    else:
+        raise ValueError(
+            "Unrecognized treeherder routing key format. Possible formats are:\n"
+            "v1: <treeherder destination>.<project>.<revision>\n"
+            "v2: <treeherder destination>.<version>.<user/project>|<project>."
+            "<revision>.<pushLogId/pullRequestId> but received: %s" % route
+        )
+
+    parsed = {"pushId": _parse_int(push_id), "project": parsed_project}
+    if revision:
+        parsed["revision"] = revision
+    else:
+        parsed["revision_hash"] = revision_hash
+
+    # If both user and a project exist, treat as github, otherwise hg.mozilla.org
+    if owner and parsed_project:
+        parsed["owner"] = owner
+        parsed["origin"] = "github.com"
+    else:
+        parsed["origin"] = "hg.mozilla.org"
+    return parsed
+
+
+def _parse_int(value):
+    # Like parseInt(): the leading digits, or None.
+    m = re.match(r"^\s*([+-]?\d+)", value or "")
+    return int(m.group(1)) if m else None
+
+
+def parse_github_url(url):
+    """ Returns (owner, repo name) for a GitHub url, or (None, None).
+    """
+    m = GITHUB_URL.match(url or "")
+    if not m:
+        return None, None
+    return m.group(1), m.group(2)
+
+
+def _build_github_source(definition):
+    source = definition.get("metadata", {}).get("source")
+    revision = push_id = None
+    env = definition.get("payload", {}).get("env")
+    if env and env.get("GITHUB_BASE_REPO_URL"):
+        source = env["GITHUB_BASE_REPO_URL"]
+        revision = env.get("GITHUB_HEAD_SHA")
+        push_id = env.get("GITHUB_PULL_REQUEST")
+
+    owner, name = parse_github_url(source)
+    if not owner:
+        return DEFAULT_SOURCE
+    return {
+        "origin": "github.com",
+        "owner": owner,
+        "project": name,
+        "revision": revision,
+        "pushId": push_id,
+    }
+
+
+def _parse_route_info(routes, definition):
+    # Filters the task routes for the treeherder specific route.
+    matching_routes = [r for r in routes if r.split(".")[0] == "tc-treeherder"]
+    if len(matching_routes) != 1:
+        return DEFAULT_SOURCE
+    parsed_route = parse_route(matching_routes[0])
+    if not parsed_route.get("owner"):
+        parsed_route["owner"] = definition.get("metadata", {}).get("owner")
+    return parsed_route
+
+
+def _parse_ts(value):
+    value = value.rstrip("Z")
+    if "." in value:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+
+def _msecs_between(start, end):
+    """ resolved - started in msecs, like subtracting two JS Dates.
+    """
+    if not start or not end:
+        return None
+    delta = _parse_ts(end) - _parse_ts(start)
+    return int(round(delta.total_seconds() * 1000))
+
+
+class TaskEvent(object):
+    """ A queue task event together with its task definition.
+    """
+
+    def __init__(self, message, definition):
+        self.definition = definition or {}
+        self.routes = message.get("routes") or []
+        self.state = event_state(message["exchange"])
+        payload = message["payload"]
+        self.task_status = payload["status"]
+        self.task_id = self.task_status["taskId"]
+        self.run_id = payload["runId"]
+        self.runs = self.task_status["runs"]
+        self.current_run = self.runs[self.run_id]
+        self.source = self._source()
+
+    def _source(self):
+        if not self.definition:
+            return DEFAULT_SOURCE
+        if self.definition.get("schedulerId") == "taskcluster-github":
+            return _build_github_source(self.definition)
+        return _parse_route_info(self.routes, self.definition)
+
+    @property
+    def job_kind(self):
+        treeherder = (self.definition.get("extra") or {}).get("treeherder")
+        if treeherder:
+            return treeherder.get("jobKind")
+        return None
+
+    @property
+    def platform(self):
+        treeherder = (self.definition.get("extra") or {}).get("treeherder")
+        if not treeherder:
+            return None
+        labels = [
+            key for key, value in (treeherder.get("collection") or {}).items() if value
+        ]
+        platform = "unknown"
+        machine = treeherder.get("machine")
+        if machine and machine.get("platform"):
+            platform = machine["platform"]
+        if labels:
+            return platform + " " + " ".join(sorted(labels))
+        return platform
+
+    def _row(self, run_id, run):
+        return {
+            "task_id": self.task_id,
+            "run_id": run_id,
+            "state": run.get("state"),
+            "created": self.definition.get("created"),
+            "scheduled": run.get("scheduled"),
+            "source": self.source.get("origin"),
+            "owner": self.source.get("owner"),
+            "project": self.source.get("project"),
+            "revision": self.source.get("revision"),
+            "push_id": self.source.get("pushId"),
+            "scheduler": self.definition.get("schedulerId"),
+            "provisioner": self.definition.get("provisionerId"),
+            "worker_type": self.definition.get("workerType"),
+            "platform": self.platform,
+            "job_kind": self.job_kind,
+            "worker_id": None,
+            "worker_group": None,
+            "started": None,
+            "resolved": None,
+            "exception_reason": None,
+            "duration": None,
+        }
+
+    def _resolved_row(self, run_id, run, exception):
+        row = self._row(run_id, run)
+        row["worker_id"] = run.get("workerId")
+        row["worker_group"] = run.get("workerGroup")
+        row["started"] = run.get("started")
+        row["resolved"] = run.get("resolved")
+        if exception:
+            # Runs that never started are measured from when they were scheduled.
+            row["exception_reason"] = run.get("reasonResolved")
+            row["duration"] = _msecs_between(
+                run.get("started") or run.get("scheduled"), run.get("resolved")
+            )
+        else:
+            row["duration"] = _msecs_between(run.get("started"), run.get("resolved"))
+        return row
+
+    def upserts(self):
+        """ Returns a list of (row, columns updated on conflict) for this event.
+        """
+        run = self.current_run
+        if self.state == "pending":
+            upserts = []
+            # Task runs that were created due to automatic rerun (such as some
+            # task-exceptions) should have the previous run resolved properly. Task
+            # exception events are not published when a task is rerun.
+            if self.run_id > 0 and run.get("reasonCreated") == "retry":
+                previous = self.run_id - 1
+                upserts.append(
+                    (
+                        self._resolved_row(previous, self.runs[previous], True),
+                        EXCEPTION_UPDATES,
+                    )
+                )
+            upserts.append((self._row(self.run_id, run), PENDING_UPDATES))
+            return upserts
+        if self.state == "running":
+            row = self._row(self.run_id, run)
+            row["worker_id"] = run.get("workerId")
+            row["worker_group"] = run.get("workerGroup")
+            row["started"] = run.get("started")
+            return [(row, RUNNING_UPDATES)]
+        if self.state in ("completed", "failed"):
+            return [(self._resolved_row(self.run_id, run, False), COMPLETED_UPDATES)]
+        return [(self._resolved_row(self.run_id, run, True), EXCEPTION_UPDATES)]
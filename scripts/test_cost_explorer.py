@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+""" Checks cost_explorer.py against a recorded Cost Explorer session, without AWS:
+
+        python -m pytest scripts/test_cost_explorer.py
+
+    fixtures/cost_explorer_pages.json was written by RecordingClient for QUERY. The
+    response comes in two pages, and the request for the second page was throttled
+    once before it succeeded.
+"""
+
+import os
+
+import cost_explorer
+import pytest
+
+from botocore.exceptions import ClientError
+
+FIXTURE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures", "cost_explorer_pages.json"
+)
+
+QUERY = cost_explorer.build_query(
+    "2019-07-01",
+    "2019-09-01",
+    "INSTANCE_TYPE",
+    ["c5.xlarge", "m5.large"],
+    {"Type": "TAG", "Key": "Name"},
+)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    calls = []
+    monkeypatch.setattr(cost_explorer.time, "sleep", calls.append)
+    return calls
+
+
+def group_names(result):
+    return [group["Keys"][0] for group in result["Groups"]]
+
+
+def test_fetch_all_pages_merges_pages_by_time_period(sleeps):
+    response = cost_explorer.fetch_all_pages(
+        cost_explorer.ReplayClient(FIXTURE), QUERY
+    )
+    results = response["ResultsByTime"]
+    assert [result["TimePeriod"] for result in results] == [
+        {"Start": "2019-07-01", "End": "2019-08-01"},
+        {"Start": "2019-08-01", "End": "2019-09-01"},
+    ]
+    assert group_names(results[0]) == [
+        "Name$gecko-t-win10-64",
+        "Name$gecko-t-linux-large",
+    ]
+    # The second page's groups for August are appended to the first page's.
+    assert group_names(results[1]) == [
+        "Name$gecko-t-win10-64",
+        "Name$gecko-t-linux-large",
+        "Name$gecko-1-b-win2012",
+    ]
+    assert "NextPageToken" not in response
+    # The throttled request was retried once, after a backoff.
+    assert len(sleeps) == 1
+
+
+def test_replay_raises_recorded_throttling(sleeps):
+    client = cost_explorer.ReplayClient(FIXTURE)
+    request = dict(QUERY, NextPageToken="page-2")
+    with pytest.raises(ClientError) as error:
+        client.get_cost_and_usage(**request)
+    assert cost_explorer._is_throttled(error.value)
+    assert client.get_cost_and_usage(**request)["ResultsByTime"]
+
+
+def test_replay_rejects_unrecorded_requests():
+    client = cost_explorer.ReplayClient(FIXTURE)
+    with pytest.raises(KeyError):
+        client.get_cost_and_usage(**dict(QUERY, Granularity="DAILY"))
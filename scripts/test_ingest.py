@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+""" Checks how ingest.py batches rows and handles failing events, without a
+    database:
+
+        python -m pytest scripts/test_ingest.py
+"""
+
+import ingest
+import requests
+import task_event
+
+
+def row(run_id=0, **values):
+    result = {column: None for column in task_event.COLUMNS}
+    result.update(task_id="abc", run_id=run_id, created="2019-08-01T00:00:00.000Z")
+    result.update(values)
+    return result
+
+
+def test_add_merges_events_for_the_same_run():
+    batcher = ingest.UpsertBatcher()
+    batcher.add(row(state="pending", scheduled="s"), task_event.PENDING_UPDATES)
+    batcher.add(
+        row(state="running", scheduled="s", started="t", worker_id="w"),
+        task_event.RUNNING_UPDATES,
+    )
+    assert len(batcher) == 1
+    (batched, updates), = batcher.pending.values()
+    assert batched["state"] == "running"
+    assert batched["started"] == "t"
+    assert batched["worker_id"] == "w"
+    assert updates == task_event.RUNNING_UPDATES
+
+
+def test_add_only_overwrites_updated_columns():
+    batcher = ingest.UpsertBatcher()
+    batcher.add(
+        row(state="completed", resolved="r", duration=10),
+        task_event.COMPLETED_UPDATES,
+    )
+    # A late pending event updates nothing, so it must not undo the completion.
+    batcher.add(row(state="pending", resolved=None), task_event.PENDING_UPDATES)
+    (batched, updates), = batcher.pending.values()
+    assert batched["state"] == "completed"
+    assert batched["resolved"] == "r"
+    assert updates == task_event.COMPLETED_UPDATES
+
+
+def test_add_unions_updated_columns():
+    batcher = ingest.UpsertBatcher()
+    batcher.add(row(state="running", started="t"), task_event.RUNNING_UPDATES)
+    batcher.add(
+        row(state="exception", exception_reason="canceled"),
+        task_event.EXCEPTION_UPDATES,
+    )
+    (batched, updates), = batcher.pending.values()
+    assert batched["exception_reason"] == "canceled"
+    assert updates == task_event.RUNNING_UPDATES | task_event.EXCEPTION_UPDATES
+
+
+def test_add_keeps_runs_apart():
+    batcher = ingest.UpsertBatcher()
+    batcher.add(row(run_id=0), task_event.PENDING_UPDATES)
+    batcher.add(row(run_id=1), task_event.PENDING_UPDATES)
+    assert len(batcher) == 2
+
+
+def message():
+    return {
+        "exchange": "exchange/taskcluster-queue/v1/task-pending",
+        "routes": [],
+        "payload": {
+            "runId": 0,
+            "status": {
+                "taskId": "abc",
+                "runs": [{"state": "pending", "scheduled": "s"}],
+            },
+        },
+    }
+
+
+class FlakyDefinitions(object):
+    """ A TaskDefinitionCache stand-in that raises the given errors, in order,
+        before returning a definition.
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+
+    def get(self, task_id):
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"created": "2019-08-01T00:00:00.000Z"}
+
+    def format_stats(self):
+        return ""
+
+
+def run(events, definitions, monkeypatch):
+    monkeypatch.setattr(ingest, "flush", lambda batcher, definitions: 0)
+    batcher = ingest.UpsertBatcher()
+    retries = ingest.RetryQueue(max_attempts=3, base_delay=0)
+    counts = ingest.ingest(events, batcher, definitions, retries)
+    return counts, batcher
+
+
+def test_ingest_retries_transient_errors(monkeypatch):
+    definitions = FlakyDefinitions(
+        requests.ConnectionError("queue down"), requests.Timeout("slow")
+    )
+    counts, batcher = run([message()], definitions, monkeypatch)
+    assert counts == (1, 0)
+    assert len(batcher) == 1
+
+
+def test_ingest_gives_up_after_max_attempts(monkeypatch):
+    definitions = FlakyDefinitions(*[requests.ConnectionError("down")] * 3)
+    counts, batcher = run([message()], definitions, monkeypatch)
+    assert counts == (0, 1)
+    assert len(batcher) == 0
+
+
+def test_ingest_skips_unknown_tasks(monkeypatch):
+    response = requests.Response()
+    response.status_code = 404
+    definitions = FlakyDefinitions(requests.HTTPError(response=response))
+    counts, batcher = run([message()], definitions, monkeypatch)
+    assert counts == (0, 1)
+
+
+def test_ingest_skips_malformed_events(monkeypatch):
+    malformed = message()
+    del malformed["payload"]["runId"]
+    counts, batcher = run([malformed, message()], FlakyDefinitions(), monkeypatch)
+    assert counts == (1, 1)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+""" Checks result_cache.py's TTL handling against a temporary cache directory:
+
+        python -m pytest scripts/test_result_cache.py
+"""
+
+import pytest
+import result_cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(result_cache, "_settings", dict(result_cache._settings))
+    return tmp_path
+
+
+def test_load_returns_fresh_entries(cache_dir):
+    result_cache.store("test", "key", [1, 2])
+    assert result_cache.load("test", "key", ttl=60) == (True, [1, 2])
+
+
+def test_zero_ttl_always_recomputes(cache_dir):
+    result_cache.store("test", "key", [1, 2])
+    assert result_cache.load("test", "key", ttl=0) == (False, None)
+    result_cache.configure(ttl=0)
+    assert result_cache.load("test", "key") == (False, None)
+
+
+def test_zero_ttl_evicts_everything(cache_dir):
+    result_cache.store("test", "key", [1, 2])
+    result_cache.evict(max_age=0)
+    assert not list((cache_dir / "test").iterdir())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+""" Checks that task_event.py parses sources like src/util/route_parser.js and
+    src/task.js do:
+
+        python -m pytest scripts/test_task_event.py
+"""
+
+import pytest
+import task_event
+
+
+def test_parse_route_v1():
+    assert task_event.parse_route("tc-treeherder.mozilla-central.abcdef") == {
+        "pushId": None,
+        "project": "mozilla-central",
+        "revision_hash": "abcdef",
+        "origin": "hg.mozilla.org",
+    }
+
+
+def test_parse_route_v2_hg():
+    assert task_event.parse_route("tc-treeherder.v2.autoland.abcdef.12345") == {
+        "pushId": 12345,
+        "project": "autoland",
+        "revision": "abcdef",
+        "origin": "hg.mozilla.org",
+    }
+
+
+def test_parse_route_v2_github():
+    parsed = task_event.parse_route("tc-treeherder.v2.mozilla/gecko-dev.abcdef.42")
+    assert parsed == {
+        "pushId": 42,
+        "project": "gecko-dev",
+        "revision": "abcdef",
+        "owner": "mozilla",
+        "origin": "github.com",
+    }
+
+
+def test_parse_route_v2_without_push_id():
+    # Pushes to a branch on github have no pull request ID.
+    parsed = task_event.parse_route("tc-treeherder.v2.mozilla/gecko-dev.abcdef")
+    assert parsed["pushId"] is None
+    assert parsed["origin"] == "github.com"
+
+
+def test_parse_route_push_id_like_parse_int():
+    parsed = task_event.parse_route("tc-treeherder.v2.try.abcdef.12x")
+    assert parsed["pushId"] == 12
+    parsed = task_event.parse_route("tc-treeherder.v2.try.abcdef.x12")
+    assert parsed["pushId"] is None
+
+
+def test_parse_route_unknown_version():
+    with pytest.raises(ValueError):
+        task_event.parse_route("tc-treeherder.v3.try.abcdef.12")
+
+
+def github_definition(source, env=None):
+    definition = {"metadata": {"source": source}, "payload": {}}
+    if env is not None:
+        definition["payload"]["env"] = env
+    return definition
+
+
+def test_build_github_source_from_metadata():
+    definition = github_definition("https://github.com/mozilla/fxapom/tree/master")
+    assert task_event._build_github_source(definition) == {
+        "origin": "github.com",
+        "owner": "mozilla",
+        "project": "fxapom",
+        "revision": None,
+        "pushId": None,
+    }
+
+
+def test_build_github_source_from_env():
+    definition = github_definition(
+        "https://github.com/someone/fork",
+        {
+            "GITHUB_BASE_REPO_URL": "git@github.com:mozilla/fxapom.git",
+            "GITHUB_HEAD_SHA": "abcdef",
+            "GITHUB_PULL_REQUEST": "7",
+        },
+    )
+    assert task_event._build_github_source(definition) == {
+        "origin": "github.com",
+        "owner": "mozilla",
+        "project": "fxapom",
+        "revision": "abcdef",
+        "pushId": "7",
+    }
+
+
+def test_build_github_source_ignores_env_without_base_repo():
+    definition = github_definition(
+        "https://github.com/mozilla/fxapom", {"GITHUB_HEAD_SHA": "abcdef"}
+    )
+    source = task_event._build_github_source(definition)
+    assert source["project"] == "fxapom"
+    assert source["revision"] is None
+
+
+def test_build_github_source_not_github():
+    definition = github_definition("https://hg.mozilla.org/mozilla-central")
+    assert task_event._build_github_source(definition) == task_event.DEFAULT_SOURCE